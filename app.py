@@ -5,7 +5,10 @@ import uuid
 import requests
 from flask import Flask, request, jsonify, send_from_directory, Blueprint, Response
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError
+import httpx
+import asyncio
+import threading
 import random
 import string
 import time
@@ -18,6 +21,31 @@ import atexit
 import sys
 import faulthandler
 import signal
+import hashlib
+import base64
+import binascii
+import io
+import copy
+import queue
+import unicodedata
+from collections import OrderedDict, deque
+import contextlib
+import contextvars
+import functools
+import bisect
+import importlib.util
+import sqlite3
+from types import SimpleNamespace
+
+try:
+    from PIL import Image  # 可选依赖：感知哈希等图片处理功能需要 Pillow
+except ImportError:
+    Image = None
+
+try:
+    import numpy as np  # 可选依赖：批量冲突校验的向量化实现需要 NumPy
+except ImportError:
+    np = None
 
 # 加载 .env 文件中的环境变量
 load_dotenv()
@@ -236,13 +264,493 @@ if missing_ai_env_vars:
         "Please configure them in backend/.env."
     )
 
-client = OpenAI(
-    api_key=AI_API_KEY,
-    base_url=AI_BASE_URL,
-    timeout=AI_REQUEST_TIMEOUT,
-)
+# --- 异步 AI 上游 ---
+# 所有上游 AI 调用都在一个常驻的后台事件循环上执行。Flask 的 async 视图会为每个请求
+# 单独创建事件循环，而 AsyncOpenAI 的连接池不能跨事件循环共享，因此视图只负责把协程
+# 投递到该循环并等待结果：等待期间不占用任何上游连接之外的资源，单个进程即可同时
+# 挂起数百个进行中的 AI 请求。
+_ai_loop = None
+_ai_loop_lock = threading.Lock()
+upstream_http_client = None
+
+# 上游连接池：空闲一段时间后的第一个请求要重新做 DNS、TCP 和 TLS 握手，
+# 因此显式配置连接池和 keep-alive，并在启动时和定时任务中预热连接。
+# 连接数上限沿用 openai SDK 的默认值：上限过低时，超出的请求会在连接池里排队，共享事件循环挂起再多请求也没用。
+AI_HTTP_MAX_CONNECTIONS = int(os.getenv('AI_HTTP_MAX_CONNECTIONS', 1000))
+AI_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('AI_HTTP_MAX_KEEPALIVE_CONNECTIONS', 100))
+AI_HTTP_KEEPALIVE_EXPIRY = float(os.getenv('AI_HTTP_KEEPALIVE_EXPIRY', 120))
+AI_HTTP2 = os.getenv('AI_HTTP2', 'false').lower() == 'true'  # 需要安装 h2（pip install httpx[http2]）
+AI_PREWARM_CONNECTIONS = int(os.getenv('AI_PREWARM_CONNECTIONS', 2))
+AI_KEEPWARM_INTERVAL_SECONDS = int(os.getenv('AI_KEEPWARM_INTERVAL_SECONDS', 30))
+
+upstream_connection_stats = {"requests": 0, "new_connections": 0, "prewarm_runs": 0, "prewarm_failures": 0}
+
+async def _trace_upstream_connection(event_name, info):
+    if event_name == "connection.connect_tcp.complete":
+        upstream_connection_stats["new_connections"] += 1
+
+async def _on_upstream_request(request):
+    # httpcore 通过 trace 扩展报告连接事件：没有触发 connect_tcp 的请求复用了已有连接
+    upstream_connection_stats["requests"] += 1
+    request.extensions["trace"] = _trace_upstream_connection
+
+def _build_upstream_http_client():
+    http2 = AI_HTTP2
+    if http2 and importlib.util.find_spec("h2") is None:
+        logging.warning("AI_HTTP2 is enabled but the h2 package is not installed; falling back to HTTP/1.1.")
+        http2 = False
+    return httpx.AsyncClient(
+        http2=http2,
+        timeout=AI_REQUEST_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=AI_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=AI_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=AI_HTTP_KEEPALIVE_EXPIRY,
+        ),
+        event_hooks={"request": [_on_upstream_request]},
+    )
+
+def _get_ai_loop():
+    """返回（必要时启动）专用于上游 AI 调用的后台事件循环。"""
+    global _ai_loop
+    with _ai_loop_lock:
+        if _ai_loop is None or _ai_loop.is_closed():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="ai-upstream-loop", daemon=True)
+            thread.start()
+            _ai_loop = loop
+    return _ai_loop
+
+def _get_upstream_http_client():
+    """返回所有上游共享的 httpx 连接池。只能在 AI 事件循环内调用。"""
+    global upstream_http_client
+    if upstream_http_client is None:
+        upstream_http_client = _build_upstream_http_client()
+    return upstream_http_client
+
+async def prewarm_upstream_connections(count=None):
+    """
+    向每个未熔断的上游并发发起 count 个轻量请求（GET /models），让连接池里保持足够的已建立连接。
+    只关心连接是否建立，不关心响应状态码。
+    """
+    count = AI_PREWARM_CONNECTIONS if count is None else count
+    if count <= 0:
+        return
+    http_client = _get_upstream_http_client()
+    requests_to_send = []
+    for endpoint in upstream_router.endpoints:
+        if endpoint.state == "open":
+            continue
+        url = f"{endpoint.base_url.rstrip('/')}/models"
+        headers = {"Authorization": f"Bearer {endpoint.api_key}"} if endpoint.api_key else {}
+        requests_to_send.extend(http_client.get(url, headers=headers, timeout=10) for _ in range(count))
+    results = await asyncio.gather(*requests_to_send, return_exceptions=True)
+    upstream_connection_stats["prewarm_runs"] += 1
+    failures = [r for r in results if isinstance(r, BaseException)]
+    if failures:
+        upstream_connection_stats["prewarm_failures"] += 1
+        logging.warning(f"Upstream pre-warm: {len(failures)}/{len(results)} requests failed: {failures[0]}")
+
+def keep_upstream_warm():
+    """定时任务：在 AI 事件循环上预热上游连接。"""
+    future = asyncio.run_coroutine_threadsafe(prewarm_upstream_connections(), _get_ai_loop())
+    try:
+        future.result(timeout=30)
+    except Exception as e:
+        logging.warning(f"Upstream keep-warm failed: {e}")
+
+def upstream_connection_metrics():
+    stats = dict(upstream_connection_stats)
+    stats["reused_connections"] = max(0, stats["requests"] - stats["new_connections"])
+    stats["reuse_ratio"] = round(stats["reused_connections"] / stats["requests"], 4) if stats["requests"] else 0.0
+    stats["http2"] = AI_HTTP2 and importlib.util.find_spec("h2") is not None
+    return stats
+
+async def run_on_ai_loop(coro):
+    """在 AI 事件循环上运行协程，并在调用方自己的事件循环中等待其结果。"""
+    loop = _get_ai_loop()
+    try:
+        current = asyncio.get_running_loop()
+    except RuntimeError:
+        current = None
+    if current is loop:
+        return await coro
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    return await asyncio.wrap_future(future)
+
+# --- 多上游路由 ---
+# AI_ENDPOINTS 为 JSON 数组时启用多个 OpenAI 兼容的上游，例如：
+#   [{"name": "dashscope", "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1",
+#     "model": "qwen-vl-max", "api_key_env": "DASHSCOPE_API_KEY"},
+#    {"name": "backup", "base_url": "http://10.0.0.2:8000/v1", "model": "qwen2.5-vl-72b", "api_key": "..."}]
+# 可选的 fast_model 为该上游上与 AI_FAST_MODEL 对应的模型名（见输入复杂度模型路由）。
+# 未配置时只有一个由 AI_BASE_URL / AI_MODEL / DASHSCOPE_API_KEY 组成的上游。
+# 路由器用 EWMA 跟踪每个上游的延迟和错误率，优先选择最快的健康上游；连续失败或错误率过高的上游
+# 被熔断 AI_BREAKER_COOLDOWN_SECONDS 秒，之后放行一个探测请求，成功则恢复。
+# 所选上游出现连接错误、429 或 5xx 时换到次优上游重试一次。
+# 开启 AI_HEDGE_ENABLED 后，请求超过所选上游的 p95 延迟仍未返回时，向次优上游再发一份，
+# 先成功的结果生效、另一份被取消。流式调用的延迟以收到响应头为准。
+
+AI_ENDPOINTS = os.getenv('AI_ENDPOINTS', '')
+AI_ROUTER_EWMA_ALPHA = float(os.getenv('AI_ROUTER_EWMA_ALPHA', 0.2))
+AI_BREAKER_FAILURES = int(os.getenv('AI_BREAKER_FAILURES', 5))
+AI_BREAKER_ERROR_RATE = float(os.getenv('AI_BREAKER_ERROR_RATE', 0.5))
+AI_BREAKER_COOLDOWN_SECONDS = float(os.getenv('AI_BREAKER_COOLDOWN_SECONDS', 30))
+AI_HEDGE_ENABLED = os.getenv('AI_HEDGE_ENABLED', 'false').lower() == 'true'
+AI_HEDGE_DELAY_SECONDS = float(os.getenv('AI_HEDGE_DELAY_SECONDS', 10))  # 样本不足、还没有 p95 时使用
+AI_HEDGE_MIN_DELAY_SECONDS = float(os.getenv('AI_HEDGE_MIN_DELAY_SECONDS', 0.5))
+_ROUTER_LATENCY_WINDOW = 200
+_ROUTER_MIN_SAMPLES = 10
+
+class UpstreamEndpoint:
+    """一个 OpenAI 兼容的上游及其健康状态。状态只在 AI 事件循环内修改。"""
+    def __init__(self, name, base_url, model, api_key, fast_model=None):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.fast_model = fast_model
+        self.api_key = api_key
+        self._client = None
+        self.ewma_latency = None
+        self.ewma_error = 0.0
+        self.latencies = deque(maxlen=_ROUTER_LATENCY_WINDOW)
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.state = "closed"  # closed / open / half_open
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def client(self):
+        if self._client is None:
+            self._client = AsyncOpenAI(
+                api_key=self.api_key or "EMPTY",
+                base_url=self.base_url,
+                timeout=AI_REQUEST_TIMEOUT,
+                http_client=_get_upstream_http_client(),
+                # 多个上游时由路由器换上游重试，SDK 自带的重试会掩盖错误率并拉高延迟
+                max_retries=0 if len(upstream_router.endpoints) > 1 else 2,
+            )
+        return self._client
+
+    def available(self, now):
+        if self.state == "open" and now - self.opened_at >= AI_BREAKER_COOLDOWN_SECONDS:
+            self.state = "half_open"
+        if self.state == "half_open":
+            return not self.probe_in_flight
+        return self.state == "closed"
+
+    def score(self):
+        # 没有样本的上游优先尝试一次，以获得延迟数据
+        if self.ewma_latency is None:
+            return 0.0
+        return self.ewma_latency * (1 + 4 * self.ewma_error)
+
+    def p95(self):
+        if len(self.latencies) < _ROUTER_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def record_latency(self, latency):
+        self.latencies.append(latency)
+        alpha = AI_ROUTER_EWMA_ALPHA
+        self.ewma_latency = latency if self.ewma_latency is None else (1 - alpha) * self.ewma_latency + alpha * latency
+
+    def record(self, latency, ok):
+        alpha = AI_ROUTER_EWMA_ALPHA
+        self.requests += 1
+        self.ewma_error = (1 - alpha) * self.ewma_error + alpha * (0.0 if ok else 1.0)
+        if ok:
+            self.record_latency(latency)
+            self.consecutive_failures = 0
+            if self.state != "closed":
+                logging.info(f"Upstream endpoint '{self.name}' recovered; closing circuit breaker.")
+            self.state = "closed"
+            return
+        self.failures += 1
+        self.consecutive_failures += 1
+        too_many_errors = self.requests >= _ROUTER_MIN_SAMPLES and self.ewma_error >= AI_BREAKER_ERROR_RATE
+        if self.state == "half_open" or self.consecutive_failures >= AI_BREAKER_FAILURES or too_many_errors:
+            if self.state != "open":
+                logging.warning(f"Upstream endpoint '{self.name}' is unhealthy; opening circuit breaker.")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def stats(self):
+        p95 = self.p95()
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "model": self.model,
+            "state": self.state,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ewma_latency_seconds": round(self.ewma_latency, 3) if self.ewma_latency is not None else None,
+            "ewma_error_rate": round(self.ewma_error, 4),
+            "p95_latency_seconds": round(p95, 3) if p95 is not None else None,
+        }
+
+class UpstreamRouter:
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    def ranked(self):
+        """按得分从优到劣返回可用的上游；全部熔断时退而返回最早熔断的一个（总得有人去试）。"""
+        now = time.monotonic()
+        candidates = [e for e in self.endpoints if e.available(now)]
+        if not candidates:
+            candidates = [min(self.endpoints, key=lambda e: e.opened_at)]
+        return sorted(candidates, key=lambda e: e.score())
+
+    async def _attempt(self, endpoint, kwargs):
+        # 只有真正作为半开探测发出的请求才负责清除探测标记
+        is_probe = endpoint.state == "half_open" and not endpoint.probe_in_flight
+        if is_probe:
+            endpoint.probe_in_flight = True
+        started = time.monotonic()
+        try:
+            # 调用方使用默认/快速模型时换成该上游配置的对应模型名
+            if endpoint.model and kwargs.get("model") in (None, AI_MODEL):
+                kwargs = dict(kwargs, model=endpoint.model)
+            elif endpoint.fast_model and AI_FAST_MODEL and kwargs.get("model") == AI_FAST_MODEL:
+                kwargs = dict(kwargs, model=endpoint.fast_model)
+            result = await endpoint.client().chat.completions.create(**kwargs)
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            endpoint.record(time.monotonic() - started, ok=False)
+            raise
+        finally:
+            if is_probe:
+                endpoint.probe_in_flight = False
+        endpoint.record(time.monotonic() - started, ok=True)
+        return result
+
+    async def chat_completion(self, kwargs):
+        ranked = self.ranked()
+        primary = ranked[0]
+        if len(ranked) < 2:
+            return await self._attempt(primary, kwargs)
+        backup = ranked[1]
+
+        started = time.monotonic()
+        first = asyncio.ensure_future(self._attempt(primary, kwargs))
+        if AI_HEDGE_ENABLED:
+            delay = max(AI_HEDGE_MIN_DELAY_SECONDS, primary.p95() or AI_HEDGE_DELAY_SECONDS)
+            try:
+                done, _ = await asyncio.wait({first}, timeout=delay)
+            except asyncio.CancelledError:
+                # asyncio.wait 不会取消它等待的任务，调用方被取消时要自己收尾，否则 first 会变成孤儿请求
+                first.cancel()
+                first.add_done_callback(_close_abandoned_stream)
+                raise
+            if not done:
+                return await self._hedge(first, primary, started, backup, kwargs)
+        try:
+            return await first
+        except (APIConnectionError, APIStatusError) as e:
+            # 连接错误、429 和 5xx 换到次优上游重试一次；其他错误（如 400）换上游也没有用
+            if isinstance(e, APIStatusError) and e.status_code != 429 and e.status_code < 500:
+                raise
+            self.failovers += 1
+            logging.warning(f"Upstream endpoint '{primary.name}' failed ({e}); retrying on '{backup.name}'.")
+            return await self._attempt(backup, kwargs)
+
+    async def _hedge(self, first, primary, started, backup, kwargs):
+        """主请求超过 p95 仍未返回：向次优上游再发一份，先成功的生效，另一份取消。"""
+        self.hedged += 1
+        hedged_at = time.monotonic()
+        second = asyncio.ensure_future(self._attempt(backup, kwargs))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                # 落选的请求至少已经耗时这么久，记为延迟样本；否则总被对冲掉的慢上游永远测不出延迟
+                if task is first:
+                    primary.record_latency(time.monotonic() - started)
+                else:
+                    backup.record_latency(time.monotonic() - hedged_at)
+                task.cancel()
+                task.add_done_callback(_close_abandoned_stream)
+
+    def stats(self):
+        return {
+            "hedge_enabled": AI_HEDGE_ENABLED,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
+            "endpoints": [e.stats() for e in self.endpoints],
+        }
+
+def _close_abandoned_stream(task):
+    """被取消的对冲请求如果已经拿到了流式响应，要关闭它以释放连接。"""
+    if task.cancelled() or task.exception() is not None:
+        return
+    close = getattr(task.result(), "close", None)
+    if close is not None:
+        asyncio.ensure_future(close())
+
+def _load_upstream_endpoints():
+    if not AI_ENDPOINTS.strip():
+        return [UpstreamEndpoint("default", AI_BASE_URL, AI_MODEL, AI_API_KEY)]
+    try:
+        configs = json.loads(AI_ENDPOINTS)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"AI_ENDPOINTS is not valid JSON: {e}")
+    endpoints = []
+    for index, config in enumerate(configs):
+        api_key = config.get("api_key") or os.getenv(config.get("api_key_env", ""), "") or None
+        endpoints.append(UpstreamEndpoint(
+            name=config.get("name") or f"endpoint-{index}",
+            base_url=config["base_url"],
+            model=config.get("model") or AI_MODEL,
+            api_key=api_key,
+            fast_model=config.get("fast_model"),
+        ))
+    if not endpoints:
+        raise ValueError("AI_ENDPOINTS must contain at least one endpoint")
+    return endpoints
+
+upstream_router = UpstreamRouter(_load_upstream_endpoints())
+
+# --- 上游并发限制 ---
+
+class UpstreamBusyError(Exception):
+    """上游并发已满且等待队列已满 / 排队超时。status 为应返回给客户端的 HTTP 状态码。"""
+    def __init__(self, limiter_name, status, retry_after, message):
+        super().__init__(message)
+        self.limiter_name = limiter_name
+        self.status = status
+        self.retry_after = retry_after
+
+class UpstreamLimiter:
+    """
+    限制某一类接口同时进行的上游调用数。超出并发的调用进入有界的 FIFO 等待队列，
+    队列已满立即拒绝（429），排队超过 queue_timeout 秒则放弃（503），两者都带 Retry-After。
+    只能在 AI 事件循环内使用。
+    """
+    def __init__(self, name, max_concurrent, max_queue, queue_timeout):
+        self.name = name
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._waiters = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._avg_wait = 0.0
+        self._avg_service = None
+
+    def _retry_after(self):
+        """按平均调用耗时粗略估计排到队首需要的秒数。"""
+        service = self._avg_service or AI_REQUEST_TIMEOUT / 4
+        backlog = (len(self._waiters) + 1) / self.max_concurrent
+        return max(1, int(round(service * backlog)))
+
+    async def _acquire(self, new_request):
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            return
+        # 同一请求的后续调用（如修正轮次）不受队列长度限制，避免已经付出的上游开销作废
+        if new_request and len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise UpstreamBusyError(self.name, 429, self._retry_after(), "AI服务繁忙，请稍后重试。")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()  # 被取消（如并行候选中的落选者）时已分到的名额要还回去
+            raise
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()  # 超时的同时恰好轮到了它，把名额让给下一个
+            self.timeouts += 1
+            raise UpstreamBusyError(self.name, 503, self._retry_after(), "AI服务排队超时，请稍后重试。")
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def _release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # 名额直接移交，_active 不变
+                return
+        self._active -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, new_request=True):
+        queued_at = time.monotonic()
+        await self._acquire(new_request)
+        started = time.monotonic()
+        self.admitted += 1
+        self._avg_wait = 0.8 * self._avg_wait + 0.2 * (started - queued_at)
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            self._avg_service = elapsed if self._avg_service is None else 0.8 * self._avg_service + 0.2 * elapsed
+            self._release()
+
+    def stats(self):
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "active": self._active,
+            "queued": len(self._waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "avg_wait_seconds": round(self._avg_wait, 3),
+            "avg_service_seconds": round(self._avg_service, 3) if self._avg_service is not None else None,
+        }
+
+def _limiter_from_env(name, prefix, max_concurrent, max_queue, queue_timeout):
+    return UpstreamLimiter(
+        name,
+        max_concurrent=int(os.getenv(f'{prefix}_MAX_CONCURRENCY', max_concurrent)),
+        max_queue=int(os.getenv(f'{prefix}_MAX_QUEUE', max_queue)),
+        queue_timeout=float(os.getenv(f'{prefix}_QUEUE_TIMEOUT', queue_timeout)),
+    )
+
+text_limiter = _limiter_from_env("text", "AI_TEXT", 8, 32, 30)
+vision_limiter = _limiter_from_env("vision", "AI_VISION", 4, 16, 60)
+assistant_limiter = _limiter_from_env("assistant", "AI_ASSISTANT", 8, 32, 30)
+
+def _busy_response(e):
+    response = jsonify({"success": False, "message": str(e), "retry_after": e.retry_after})
+    response.status_code = e.status
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+async def _safe_chat_completion(limiter=None, **kwargs):
+    """
+    调用上游 chat completion。传入 limiter 时在其并发名额内完成调用；
+    流式调用需要在读完整个流之前一直占用名额，应由调用方自行持有 limiter.slot()。
+    """
+    if limiter is not None:
+        async with limiter.slot():
+            return await _safe_chat_completion(**kwargs)
 
-def _safe_chat_completion(**kwargs):
     extra_body = kwargs.get("extra_body")
     if not isinstance(extra_body, dict):
         extra_body = {}
@@ -253,17 +761,31 @@ def _safe_chat_completion(**kwargs):
     extra_body["enable_thinking"] = False
     kwargs["extra_body"] = extra_body
 
+    # 在持久化任务中执行时，重启前已经收到的上游响应直接重放，不再重复付费
+    journal = _current_job_journal.get()
+    if journal is not None:
+        journal_key = journal.key_for(await asyncio.to_thread(_upstream_call_fingerprint, kwargs))
+        replayed = journal.replay(journal_key, stream=bool(kwargs.get("stream")))
+        if replayed is not None:
+            return replayed
+
     try:
-        return client.chat.completions.create(**kwargs)
+        completion = await upstream_router.chat_completion(kwargs)
+    except asyncio.CancelledError:
+        raise
     except BaseException as e:
         logging.exception("AI chat completion failed")
         raise ConnectionError(f"AI chat completion failed: {e}") from e
+    if journal is not None:
+        return await journal.capture(journal_key, completion, stream=bool(kwargs.get("stream")))
+    return completion
 
-async def call_ai_model(user_input):
+async def call_ai_model(user_input, model=None):
     """
-    调用通义千问 Qwen3.5-Plus 模型来解析课程数据。
+    调用通义千问 Qwen3.5-Plus 模型来解析课程数据。model 为空时使用 AI_MODEL。
     """
-    print(f"调用 {AI_MODEL} AI 接口，处理用户输入...")
+    model = model or AI_MODEL
+    print(f"调用 {model} AI 接口，处理用户输入...")
 
     # 构建 few-shot 提示
     system_prompt = f"""
@@ -291,8 +813,9 @@ async def call_ai_model(user_input):
     """
 
     try:
-        completion = _safe_chat_completion(
-            model=AI_MODEL,
+        completion = await _safe_chat_completion(
+            limiter=text_limiter,
+            model=model,
             messages=[
                 {'role': 'system', 'content': system_prompt},
                 {'role': 'user', 'content': f"请解析以下课程数据: {user_input}"}
@@ -315,87 +838,1205 @@ async def call_ai_model(user_input):
             
         return parsed_data
 
+    except UpstreamBusyError:
+        raise
     except Exception as e:
         print(f"AI 接口调用或解析失败：{e}")
         raise ConnectionError(f"AI接口调用或解析失败: {e}")
 
-# --- 后端冲突检测与AI自我修正 ---
+# --- AI 结果缓存 ---
+
+class ResultCache:
+    """
+    两级（内存 LRU + 可选磁盘）结果缓存，按内容哈希寻址。
+    值以 JSON 形式保存，取出时总是返回新的副本，调用方可以放心修改。
+    内存层按条目数和字节数（JSON 的 UTF-8 编码长度）淘汰最久未使用的条目；磁盘层按总字节数淘汰最旧的文件。
+    在 AI 事件循环上使用 get_async/put_async，磁盘层的文件读写放到线程中执行，不阻塞其他进行中的调用。
+    """
+    def __init__(self, name, max_entries, max_bytes, ttl_seconds, disk_dir=None, disk_max_bytes=0):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir or None
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, payload_str, payload_bytes)
+        self._bytes = 0
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _expires_at(self):
+        return time.time() + self.ttl_seconds if self.ttl_seconds > 0 else -1
+
+    @staticmethod
+    def _is_expired(expires_at):
+        return expires_at != -1 and time.time() > expires_at
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _remember(self, key, expires_at, payload):
+        """写入内存层（调用方需持有锁）。"""
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old[2]
+        size = len(payload.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (expires_at, payload, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def _get_memory(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self._is_expired(entry[0]):
+                self._entries.pop(key)
+                self._bytes -= entry[2]
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return json.loads(entry[1])
+
+    def _get_disk(self, key):
+        payload = self._read_disk(key)
+        with self._lock:
+            if payload is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, payload[0], payload[1])
+        return json.loads(payload[1])
+
+    def _put_memory(self, key, value):
+        payload = json.dumps(value, ensure_ascii=False)
+        expires_at = self._expires_at()
+        with self._lock:
+            self._remember(key, expires_at, payload)
+            self.stores += 1
+        return expires_at, payload
+
+    def get(self, key):
+        value = self._get_memory(key)
+        return value if value is not None else self._get_disk(key)
+
+    def put(self, key, value):
+        expires_at, payload = self._put_memory(key, value)
+        self._write_disk(key, expires_at, payload)
+
+    async def get_async(self, key):
+        value = self._get_memory(key)
+        if value is not None or not self.disk_dir:
+            return value if value is not None else self._get_disk(key)
+        return await asyncio.to_thread(self._get_disk, key)
+
+    async def put_async(self, key, value):
+        expires_at, payload = self._put_memory(key, value)
+        if self.disk_dir and self.disk_max_bytes > 0:
+            await asyncio.to_thread(self._write_disk, key, expires_at, payload)
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            expires_at = data.get("expires_at", -1)
+            if self._is_expired(expires_at):
+                self._remove_disk_file(path)
+                return None
+            os.utime(path, None)  # 刷新 mtime，作为磁盘层的 LRU 依据
+            return expires_at, json.dumps(data.get("value"), ensure_ascii=False)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning(f"Cache '{self.name}': failed to read {os.path.basename(path)}: {e}")
+            self._remove_disk_file(path)
+            return None
+
+    def _write_disk(self, key, expires_at, payload):
+        if not self.disk_dir or self.disk_max_bytes <= 0:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(f'{{"expires_at": {json.dumps(expires_at)}, "value": {payload}}}')
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            with self._lock:
+                if self._disk_bytes is None:
+                    self._disk_bytes = self._scan_disk_bytes()
+                else:
+                    self._disk_bytes += os.path.getsize(path) - old_size
+                over_limit = self._disk_bytes > self.disk_max_bytes
+            if over_limit:
+                self._evict_disk()
+        except OSError as e:
+            logging.warning(f"Cache '{self.name}': failed to write {os.path.basename(path)}: {e}")
+            self._remove_disk_file(tmp_path)
+
+    def _scan_disk_bytes(self):
+        total = 0
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith('.json'):
+                try:
+                    total += entry.stat().st_size
+                except OSError:
+                    continue
+        return total
+
+    def _evict_disk(self):
+        """按 mtime 从旧到新删除磁盘缓存，直到总大小降到上限的 90% 以下。"""
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith('.json'):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, entry.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        target = self.disk_max_bytes * 0.9
+        for _, size, path in files:
+            if total <= target:
+                break
+            if self._remove_disk_file(path):
+                total -= size
+                self.evictions += 1
+        with self._lock:
+            self._disk_bytes = total
+
+    @staticmethod
+    def _remove_disk_file(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "disk_bytes": self._disk_bytes if self.disk_dir else None,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "hit_ratio": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+AI_RESULT_CACHE_ENABLED = os.getenv('AI_RESULT_CACHE_ENABLED', 'true').lower() == 'true'
+AI_RESULT_CACHE_TTL_SECONDS = int(os.getenv('AI_RESULT_CACHE_TTL_SECONDS', 7 * 24 * 3600))
+AI_RESULT_CACHE_MAX_ENTRIES = int(os.getenv('AI_RESULT_CACHE_MAX_ENTRIES', 1024))
+AI_RESULT_CACHE_MAX_MB = float(os.getenv('AI_RESULT_CACHE_MAX_MB', 32))
+# 留空则不启用磁盘层
+AI_RESULT_CACHE_DIR = os.getenv('AI_RESULT_CACHE_DIR', '')
+AI_RESULT_CACHE_DISK_MAX_MB = float(os.getenv('AI_RESULT_CACHE_DISK_MAX_MB', 256))
+
+text_result_cache = ResultCache(
+    name="process-data",
+    max_entries=AI_RESULT_CACHE_MAX_ENTRIES,
+    max_bytes=int(AI_RESULT_CACHE_MAX_MB * 1024 * 1024),
+    ttl_seconds=AI_RESULT_CACHE_TTL_SECONDS,
+    disk_dir=os.path.join(AI_RESULT_CACHE_DIR, 'text') if AI_RESULT_CACHE_DIR else None,
+    disk_max_bytes=int(AI_RESULT_CACHE_DISK_MAX_MB * 1024 * 1024),
+)
+
+# --- 相同请求合并 (single-flight) ---
+
+AI_REQUEST_COALESCING_ENABLED = os.getenv('AI_REQUEST_COALESCING_ENABLED', 'true').lower() == 'true'
+
+class SingleFlight:
+    """
+    合并并发的相同请求：同一个键同时只有一个上游调用在进行，其余请求等待并共享其结果。
+    只能在 AI 事件循环内使用（单线程，无需加锁）。
+    """
+    def __init__(self, name):
+        self.name = name
+        self._inflight = {}   # key -> asyncio.Task
+        self._listeners = {}  # key -> [on_event, ...]
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key, factory, on_event=None):
+        """
+        factory(broadcast) 返回要执行的协程；broadcast(event, data) 会把进度事件转发给
+        当前所有等待该键的请求（后加入的请求收不到加入之前的事件）。
+        """
+        if not AI_REQUEST_COALESCING_ENABLED:
+            return await factory(on_event)
+
+        if on_event is not None:
+            self._listeners.setdefault(key, []).append(on_event)
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            print(f"合并相同的进行中请求 {key[:12]}（{self.name}）。")
+        else:
+            self.leaders += 1
+            task = asyncio.ensure_future(factory(lambda event, data: self._broadcast(key, event, data)))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._forget(key, task))
+        try:
+            # shield: 单个等待者被取消时不影响其他共享该调用的请求
+            return copy.deepcopy(await asyncio.shield(task))
+        finally:
+            if on_event is not None and on_event in self._listeners.get(key, []):
+                self._listeners[key].remove(on_event)
+
+    def _broadcast(self, key, event, data):
+        for listener in list(self._listeners.get(key, [])):
+            listener(event, data)
+
+    def _forget(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            self._listeners.pop(key, None)
+
+    def stats(self):
+        return {
+            "enabled": AI_REQUEST_COALESCING_ENABLED,
+            "inflight": len(self._inflight),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
+
+text_singleflight = SingleFlight("process-data")
+image_singleflight = SingleFlight("process-image")
+
+def _normalize_user_input(user_input):
+    """统一全角/半角字符和空白，使仅有排版差异的相同粘贴内容得到同一个缓存键。"""
+    normalized = unicodedata.normalize('NFKC', str(user_input))
+    return re.sub(r'\s+', ' ', normalized).strip()
+
+def text_cache_key(user_input, model=None):
+    raw = f"{model or AI_MODEL}\n{_normalize_user_input(user_input)}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+text_parse_paths = {"local": 0, "cache": 0, "ai": 0}
+
+# --- 输入复杂度模型路由 ---
+# 配置 AI_FAST_MODEL 后，粘贴文本按估算的 token 数和结构复杂度分流：短小、规整（大部分课程行
+# 本地规则能看懂）的输入交给快速廉价的模型，长的或杂乱的输入交给 AI_MODEL。
+# 快速模型调用失败或输出无法解析时自动升级到 AI_MODEL 重试。
+
+AI_FAST_MODEL = os.getenv('AI_FAST_MODEL', '')
+AI_FAST_MODEL_MAX_TOKENS = int(os.getenv('AI_FAST_MODEL_MAX_TOKENS', 400))
+AI_FAST_MODEL_MAX_LINES = int(os.getenv('AI_FAST_MODEL_MAX_LINES', 5))
+AI_FAST_MODEL_MIN_LOCAL_RATIO = float(os.getenv('AI_FAST_MODEL_MIN_LOCAL_RATIO', 0.5))
+_CJK_RE = re.compile(r'[\u3400-\u9fff\uf900-\ufaff]')
+
+def estimate_tokens(text):
+    """粗略估算 token 数：汉字约 1 字 1 token，其余字符约 4 个 1 token。"""
+    text = str(text)
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def estimate_input_complexity(user_input):
+    """返回 {"tokens", "lines", "course_lines", "local_parsed", "local_ratio"}。"""
+    lines = [unicodedata.normalize('NFKC', line).strip() for line in str(user_input).splitlines()]
+    lines = [line for line in lines if line]
+    course_lines = 0
+    local_parsed = 0
+    for line in lines:
+        is_course_like, course = _parse_course_line(line)
+        if is_course_like:
+            course_lines += 1
+            local_parsed += int(course is not None)
+    return {
+        "tokens": estimate_tokens(user_input),
+        "lines": len(lines),
+        "course_lines": course_lines,
+        "local_parsed": local_parsed,
+        "local_ratio": round(local_parsed / course_lines, 3) if course_lines else 0.0,
+    }
+
+def choose_text_model(user_input):
+    """返回 (tier, model, complexity)，tier 为 "fast" 或 "strong"。"""
+    if not AI_FAST_MODEL:
+        return "strong", AI_MODEL, None
+    complexity = estimate_input_complexity(user_input)
+    simple = (
+        complexity["tokens"] <= AI_FAST_MODEL_MAX_TOKENS
+        and complexity["course_lines"] <= AI_FAST_MODEL_MAX_LINES
+        and (complexity["course_lines"] == 0 or complexity["local_ratio"] >= AI_FAST_MODEL_MIN_LOCAL_RATIO)
+    )
+    return ("fast", AI_FAST_MODEL, complexity) if simple else ("strong", AI_MODEL, complexity)
+
+class ModelTierStats:
+    """按模型档位统计路由次数、失败/升级次数和调用延迟。只在 AI 事件循环内更新。"""
+    def __init__(self):
+        self.tiers = {}
+
+    def _tier(self, tier):
+        if tier not in self.tiers:
+            self.tiers[tier] = {"requests": 0, "failures": 0, "escalations": 0, "latencies": deque(maxlen=500)}
+        return self.tiers[tier]
+
+    def record(self, tier, latency, ok):
+        entry = self._tier(tier)
+        entry["requests"] += 1
+        if ok:
+            entry["latencies"].append(latency)
+        else:
+            entry["failures"] += 1
+
+    def record_escalation(self, tier):
+        self._tier(tier)["escalations"] += 1
+
+    def stats(self):
+        result = {"fast_model": AI_FAST_MODEL or None, "strong_model": AI_MODEL, "tiers": {}}
+        for tier, entry in list(self.tiers.items()):
+            latencies = sorted(entry["latencies"])
+            result["tiers"][tier] = {
+                "requests": entry["requests"],
+                "failures": entry["failures"],
+                "escalations": entry["escalations"],
+                "avg_latency_seconds": round(sum(latencies) / len(latencies), 3) if latencies else None,
+                "p95_latency_seconds": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3) if latencies else None,
+            }
+        return result
+
+text_model_routing = ModelTierStats()
+
+async def _call_ai_model_routed(user_input, tier, model, complexity):
+    """按 choose_text_model 的选择调用模型，返回 (courses, 实际提供结果的模型)。"""
+    if complexity is not None:
+        print(f"输入复杂度 {complexity}，使用 {tier} 档模型 {model}。")
+    started = time.monotonic()
+    try:
+        courses = await call_ai_model(user_input, model=model)
+    except UpstreamBusyError:
+        raise
+    except ConnectionError:
+        text_model_routing.record(tier, time.monotonic() - started, ok=False)
+        if tier != "fast":
+            raise
+        print(f"快速模型 {model} 解析失败，升级到 {AI_MODEL} 重试。")
+        text_model_routing.record_escalation(tier)
+        tier, model = "strong", AI_MODEL
+        started = time.monotonic()
+        try:
+            courses = await call_ai_model(user_input, model=AI_MODEL)
+        except ConnectionError:
+            text_model_routing.record(tier, time.monotonic() - started, ok=False)
+            raise
+    text_model_routing.record(tier, time.monotonic() - started, ok=True)
+    return courses, model
+
+async def parse_courses_from_text(user_input):
+    """
+    解析粘贴的课程文本，返回 (courses, source)，source 为实际提供结果的路径：
+    - "local": 本地规则解析器（置信度足够时，不访问上游）
+    - "cache": 结果缓存（相同的规范化输入，按实际提供结果的模型分开缓存；快速档的输入也会命中强模型的结果）
+    - "ai":    call_ai_model，按输入复杂度选择模型（并发的相同请求合并为一次上游调用）
+    """
+    if LOCAL_PARSER_ENABLED:
+        started = time.perf_counter()
+        local = parse_courses_locally(user_input)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if local is not None and local[1] >= LOCAL_PARSER_MIN_CONFIDENCE:
+            print(f"本地解析器 {local[2]} 解析成功（置信度 {local[1]:.2f}，耗时 {elapsed_ms:.1f}ms），跳过 AI 调用。")
+            text_parse_paths["local"] += 1
+            return local[0], "local"
+
+    tier, model, complexity = choose_text_model(user_input)
+    key = text_cache_key(user_input, model)
+    if AI_RESULT_CACHE_ENABLED:
+        # 快速模型失败升级后的结果缓存在强模型的键下
+        for lookup_key in ([key] if model == AI_MODEL else [key, text_cache_key(user_input, AI_MODEL)]):
+            cached = await text_result_cache.get_async(lookup_key)
+            if cached is not None:
+                print(f"命中课程解析缓存 {lookup_key[:12]}，跳过 AI 调用。")
+                text_parse_paths["cache"] += 1
+                return cached, "cache"
+
+    async def fetch(_broadcast):
+        courses, served_by = await _call_ai_model_routed(user_input, tier, model, complexity)
+        if AI_RESULT_CACHE_ENABLED and isinstance(courses, list) and courses:
+            await text_result_cache.put_async(text_cache_key(user_input, served_by), courses)
+        return courses
+
+    courses = await text_singleflight.do(key, fetch)
+    text_parse_paths["ai"] += 1
+    return courses, "ai"
+
+# --- 周数表达式 ---
+# 周数字符串（"1-16"、"1-16周"、"第3周"、"1-15(单)"、"1-8周,9-16双周"、"1-5,7-15周(单)" ...）
+# 被编译成不可变的 WeekSet，内部是整数位集（第 w 位表示第 w 周）。编译结果按字符串做 LRU 缓存，
+# 位集相同的 WeekSet 共享同一个实例。冲突检测、课程规范化和本地解析器都基于它。
+#
+# 单双周标记的作用范围：紧跟在区间后面（"9-16单周"、"1-15(单)"）只作用于该区间；
+# 跟在 "周" 后面（"1-5,7-15周(单)"）作用于该 "周" 之前的整组区间；出现在数字之前（"单周1-15"）
+# 作用于随后的一组区间。单双周只筛选区间，不影响单独的周数。
+
+WEEK_LIMIT = 128  # 更大的周数不进入位集，避免 "1-99999999" 之类的输入生成巨大的位集；这样的字符串不做规范化
+
+_PLAIN_WEEKS_RE = re.compile(r'\d+(?:-\d+)?(?:,\d+(?:-\d+)?)*')  # AI 输出的规范写法，走快速路径
+_WEEK_TOKEN_RE = re.compile(r'(\d+)(?:\s*-\s*(\d+))?|([单双])|(周)')
+_WEEK_NUMBER_RE = re.compile(r'\d+')
+_WEEK_CONNECTORS = str.maketrans({'~': '-', '至': '-', '到': '-', '—': '-', '–': '-'})
+_ODD_WEEKS = sum(1 << w for w in range(1, WEEK_LIMIT + 1, 2))
+_EVEN_WEEKS = sum(1 << w for w in range(0, WEEK_LIMIT + 1, 2))
+
+class WeekSet:
+    """
+    不可变的周数集合。mask 的第 w 位表示第 w 周，intervals 是升序的闭区间元组 ((start, end), ...)。
+    通过 compile_weeks 或 WeekSet.of(mask) 获取，相同的位集共享同一个实例。
+    """
+    __slots__ = ("mask", "intervals", "_weeks")
+
+    def __init__(self, mask):
+        weeks = []
+        remaining = mask
+        while remaining:
+            lowest = remaining & -remaining
+            weeks.append(lowest.bit_length() - 1)
+            remaining ^= lowest
+        intervals = []
+        for week in weeks:
+            if intervals and intervals[-1][1] == week - 1:
+                intervals[-1][1] = week
+            else:
+                intervals.append([week, week])
+        object.__setattr__(self, "mask", mask)
+        object.__setattr__(self, "intervals", tuple((a, b) for a, b in intervals))
+        object.__setattr__(self, "_weeks", tuple(weeks))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def of(mask):
+        return WeekSet(mask)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("WeekSet is immutable")
+
+    def __iter__(self):
+        return iter(self._weeks)
+
+    def __len__(self):
+        return len(self._weeks)
+
+    def __bool__(self):
+        return bool(self.mask)
+
+    def __contains__(self, week):
+        return isinstance(week, int) and week >= 0 and bool(self.mask >> week & 1)
+
+    def __eq__(self, other):
+        return isinstance(other, WeekSet) and other.mask == self.mask
+
+    def __hash__(self):
+        return hash(self.mask)
+
+    def __and__(self, other):
+        return WeekSet.of(self.mask & other.mask)
+
+    def __or__(self, other):
+        return WeekSet.of(self.mask | other.mask)
+
+    def __repr__(self):
+        return f"WeekSet({self.format()!r})"
+
+    def format(self):
+        """紧凑写法，如 "1-7(单),9-10"，可被 compile_weeks 解析回同一个集合。"""
+        return format_week_ranges(self._weeks)
+
+EMPTY_WEEKS = WeekSet.of(0)
+
+def _week_range_mask(start, end, parity):
+    end = min(end, WEEK_LIMIT)
+    if start > end:
+        return 0
+    mask = ((1 << (end - start + 1)) - 1) << start
+    if parity == '单':
+        mask &= _ODD_WEEKS
+    elif parity == '双':
+        mask &= _EVEN_WEEKS
+    return mask
+
+@functools.lru_cache(maxsize=4096)
+def _compile_weeks(text):
+    if _PLAIN_WEEKS_RE.fullmatch(text):
+        mask = 0
+        for part in text.split(','):
+            start, _, end = part.partition('-')
+            mask |= _week_range_mask(int(start), int(end or start), None)
+        return WeekSet.of(mask)
+
+    normalized = unicodedata.normalize('NFKC', text).translate(_WEEK_CONNECTORS)
+    group = []        # 当前这组区间，元素为 [start, end, parity]；单独的周数 end 为 None
+    closed = None     # 上一个 "周" 结束的那组区间，等待可能紧随其后的单双周标记
+    prefix = None     # 出现在数字之前的单双周标记
+    previous = None   # 上一个记号的类型
+    previous_end = 0
+    ranges = []
+    for m in _WEEK_TOKEN_RE.finditer(normalized):
+        adjacent = not normalized[previous_end:m.start()].strip(' ([【')
+        if m.group(1):
+            start = int(m.group(1))
+            end = int(m.group(2)) if m.group(2) else None
+            group.append([start, end, prefix if end is not None else None])
+            ranges.append(group[-1])
+            previous = "range"
+        elif m.group(3):
+            parity = m.group(3)
+            if previous == "range" and adjacent:
+                if group[-1][1] is not None:
+                    group[-1][2] = parity
+            elif previous == "week" and closed and adjacent:
+                for item in closed:
+                    if item[1] is not None and item[2] is None:
+                        item[2] = parity
+            else:
+                prefix = parity
+            previous = "parity"
+        elif previous == "parity" and not group and adjacent:
+            pass  # "单周1-15" 里的 "周" 属于单双周标记本身
+        else:
+            closed, group, prefix = group, [], None
+            previous = "week"
+        previous_end = m.end()
+
+    mask = 0
+    for start, end, parity in ranges:
+        if end is None:
+            if start <= WEEK_LIMIT:
+                mask |= 1 << start
+        else:
+            mask |= _week_range_mask(start, end, parity)
+    return WeekSet.of(mask)
+
+def compile_weeks(weeks_str):
+    """把周数表达式编译成 WeekSet；不是字符串时返回空集合。"""
+    if isinstance(weeks_str, WeekSet):
+        return weeks_str
+    if not isinstance(weeks_str, str):
+        return EMPTY_WEEKS
+    return _compile_weeks(weeks_str)
 
 def parse_weeks(weeks_str):
     """从字符串解析周数，返回一个周数的集合。"""
-    if not isinstance(weeks_str, str):
-        return set()
-    
-    weeks = set()
-    parts = weeks_str.replace('，', ',').split(',')
-    for part in parts:
-        part = part.strip()
-        single_match = re.match(r'(\d+)-(\d+)\(单\)', part)
-        double_match = re.match(r'(\d+)-(\d+)\(双\)', part)
-        range_match = re.match(r'(\d+)-(\d+)', part)
+    return set(compile_weeks(weeks_str))
 
-        try:
-            if single_match:
-                start, end = map(int, single_match.groups())
-                for i in range(start, end + 1):
-                    if i % 2 != 0: weeks.add(i)
-            elif double_match:
-                start, end = map(int, double_match.groups())
-                for i in range(start, end + 1):
-                    if i % 2 == 0: weeks.add(i)
-            elif range_match:
-                start, end = map(int, range_match.groups())
-                for i in range(start, end + 1):
-                    weeks.add(i)
-            elif part.isdigit():
-                weeks.add(int(part))
-        except ValueError:
-            continue # 忽略无法解析的部分
-    return weeks
+def format_week_ranges(weeks):
+    """
+    把周数集合压缩成与 parse_weeks 兼容的紧凑写法，如 {1,2,3,4,6} -> "1-4,6"，
+    {1,3,5,7} -> "1-7(单)"。
+    """
+    weeks = sorted(weeks)
+    parts = []
+    i = 0
+    while i < len(weeks):
+        j = i
+        while j + 1 < len(weeks) and weeks[j + 1] == weeks[j] + 1:
+            j += 1
+        if j > i:
+            parts.append(f"{weeks[i]}-{weeks[j]}")
+            i = j + 1
+            continue
+        while j + 1 < len(weeks) and weeks[j + 1] == weeks[j] + 2:
+            j += 1
+        if j - i >= 2:
+            parts.append(f"{weeks[i]}-{weeks[j]}({'单' if weeks[i] % 2 else '双'})")
+        else:
+            j = i
+            parts.append(str(weeks[i]))
+        i = j + 1
+    return ",".join(parts)
+
+def _format_week_set(weeks):
+    """把周数集合格式化为与 AI 解析一致的字符串：连续周为 "a-b"，否则为逗号分隔列表。"""
+    ordered = sorted(weeks)
+    if not ordered:
+        return ""
+    if len(ordered) > 1 and ordered[-1] - ordered[0] == len(ordered) - 1:
+        return f"{ordered[0]}-{ordered[-1]}"
+    return ",".join(str(w) for w in ordered)
+
+def exceeds_week_limit(weeks_str):
+    """周数表达式中是否出现大于 WEEK_LIMIT 的周数（这些周数在 WeekSet 中被丢弃）。"""
+    return isinstance(weeks_str, str) and any(int(n) > WEEK_LIMIT for n in _WEEK_NUMBER_RE.findall(weeks_str))
+
+def normalize_weeks(weeks_str):
+    """
+    把周数表达式规范化为 AI 解析和前端都能识别的格式（"1-16" 或 "1,3,5"），
+    如 "1-16周" -> "1-16"、"1-7周(单)" -> "1,3,5,7"。无法解析出任何周数，
+    或含有超出 WEEK_LIMIT 的周数（规范化会改变用户输入的内容）时原样返回。
+    """
+    weeks = compile_weeks(weeks_str)
+    if not weeks or exceeds_week_limit(weeks_str):
+        return weeks_str
+    return _format_week_set(weeks)
 
-def detect_backend_conflicts(courses):
+# --- 后端冲突检测与AI自我修正 ---
+
+# 冲突对检测与批量校验把每条上课安排在其星期内表示为一个整数，第 week * stride + slot 位表示
+# “第 week 周的第 slot 节”，两条安排是否重叠只需一次按位与。周数位集到单元格位集的展开会被缓存，
+# 修正轮次之间重复出现的字符串不必重新计算。
+
+@functools.lru_cache(maxsize=4096)
+def _week_cells(weeks_str, stride):
+    """周数字符串 -> 每个上课周在第 week * stride 位上置 1 的整数。"""
+    weeks = compile_weeks(weeks_str)
+    if stride == 1:
+        return weeks.mask
+    cells = 0
+    for week in weeks:
+        cells |= 1 << (week * stride)
+    return cells
+
+@functools.lru_cache(maxsize=1024)
+def _slot_range(time_slot):
+    """'3-4' -> (3, 4)；无法解析时返回 None。"""
+    if '-' not in time_slot:
+        return None
+    try:
+        start_slot, end_slot = map(int, time_slot.split('-'))
+    except ValueError:
+        return None
+    return start_slot, end_slot
+
+def _iter_schedule_entries(courses):
     """
-    在后端对课程列表进行冲突检测。
-    返回一个元组 (has_conflict: bool, conflict_report: str)。
+    逐条产出可参与冲突检测的上课安排：(course_index, course_name, schedule_index, weeks, day, start_slot, end_slot)。
+    周数、星期或节次无法解析的安排被跳过。
     """
-    calendar = {}  # key: f"{week}-{day}-{slot}", value: course_name
-    conflict_pairs = set()
     if not isinstance(courses, list):
-        return False, ""
-
-    for course in courses:
+        return
+    for course_index, course in enumerate(courses):
+        if not isinstance(course, dict):
+            continue
         course_name = course.get("name", "未知课程")
         schedules = course.get("schedules", [])
         if not isinstance(schedules, list): continue
-        for schedule in schedules:
+        for schedule_index, schedule in enumerate(schedules):
+            if not isinstance(schedule, dict):
+                continue
+            weeks = schedule.get("weeks", "")
+            time_slot = schedule.get("time_slot", "")
+            if not isinstance(weeks, str) or not isinstance(time_slot, str):
+                continue
+            slots = _slot_range(time_slot)
+            if slots is None or slots[0] > slots[1]:
+                continue
             try:
-                weeks = parse_weeks(schedule.get("weeks", ""))
                 day = int(schedule.get("day", 0))
-                time_slot = schedule.get("time_slot", "")
-                if not time_slot or '-' not in time_slot: continue
-                start_slot, end_slot = map(int, time_slot.split('-'))
-
-                for week in weeks:
-                    for slot in range(start_slot, end_slot + 1):
-                        key = f"{week}-{day}-{slot}"
-                        if key in calendar:
-                            conflicting_course_name = calendar[key]
-                            if conflicting_course_name != course_name:
-                                pair = tuple(sorted((course_name, conflicting_course_name)))
-                                conflict_pairs.add(pair)
-                        else:
-                            calendar[key] = course_name
-            except (ValueError, TypeError, AttributeError):
+            except (ValueError, TypeError):
                 continue
+            yield course_index, course_name, schedule_index, weeks, day, slots[0], slots[1]
 
-    if not conflict_pairs:
-        return False, ""
+def find_backend_conflict_pairs(courses):
+    """
+    返回存在时间重叠的课程名称对集合 {(name_a, name_b), ...}，每对按名称排序。
+    判定与 find_backend_conflicts 相同（两门不同名课程的任意两条安排有重叠的 周 x 节次 即构成冲突对），
+    结果等于 conflict_pairs_of(find_backend_conflicts(courses))，但不生成冲突详情：
+    每门课程在每个星期的全部安排合并为一个单元格位集，只有与当天已出现的位集相交时才逐个比较。
+    """
+    conflict_pairs = set()
+    parsed = list(_iter_schedule_entries(courses))
+    stride = max(16, max((entry[6] for entry in parsed), default=0) + 1)
+    by_day = {}  # day -> {course_name: 该课程当天占用的全部单元格}
+    for _, course_name, _, weeks, day, start_slot, end_slot in parsed:
+        week_cells = _week_cells(weeks, stride)
+        if week_cells:
+            # 节次范围的位段乘以周位集：各周的位段互不重叠，乘法不会产生进位
+            cells = week_cells * (((1 << (end_slot - start_slot + 1)) - 1) << start_slot)
+            day_cells = by_day.setdefault(day, {})
+            day_cells[course_name] = day_cells.get(course_name, 0) | cells
+
+    for day_cells in by_day.values():
+        seen = 0
+        earlier = []
+        for course_name, cells in day_cells.items():
+            if cells & seen:
+                for other_name, other_cells in earlier:
+                    if cells & other_cells:
+                        conflict_pairs.add((course_name, other_name) if str(course_name) <= str(other_name) else (other_name, course_name))
+            seen |= cells
+            earlier.append((course_name, cells))
+    return conflict_pairs
+
+_WEEKDAY_NAMES = {1: "周一", 2: "周二", 3: "周三", 4: "周四", 5: "周五", 6: "周六", 7: "周日"}
+
+def find_backend_conflicts(courses):
+    """
+    返回结构化的冲突列表，每项形如:
+        {"courses": [name_a, name_b], "day": 3, "weeks": "1-8", "slots": "3-4",
+         "entries": [{"course": 0, "schedule": 1}, {"course": 4, "schedule": 0}]}
+    weeks/slots 是两条安排实际重叠的周数与节次，entries 是两条安排在 courses 中的下标（与 courses 的顺序对应）。
+    按星期分组后沿节次做扫描线，只比较节次区间相交的安排，周数重叠用位集按位与计算，
+    开销与安排条数（及相交的安排对数）成正比，而与 周 x 节次 无关。
+    同名课程之间不算冲突。
+    """
+    by_day = {}
+    for course_index, course_name, schedule_index, weeks, day, start_slot, end_slot in _iter_schedule_entries(courses):
+        week_mask = compile_weeks(weeks).mask
+        if week_mask:
+            by_day.setdefault(day, []).append((start_slot, end_slot, week_mask, course_name, course_index, schedule_index))
+
+    conflicts = []
+    for day, entries in by_day.items():
+        entries.sort(key=lambda entry: entry[0])
+        active = []
+        for entry in entries:
+            start_slot, end_slot, week_mask, course_name = entry[:4]
+            active = [other for other in active if other[1] >= start_slot]
+            for other in active:
+                if other[3] == course_name:
+                    continue
+                overlap = week_mask & other[2]
+                if not overlap:
+                    continue
+                first, second = (other, entry) if _entry_order(other[3], other[4]) <= _entry_order(course_name, entry[4]) else (entry, other)
+                conflicts.append({
+                    "courses": [first[3], second[3]],
+                    "day": day,
+                    "weeks": WeekSet.of(overlap).format(),
+                    "slots": f"{start_slot}-{min(end_slot, other[1])}",
+                    "entries": [{"course": first[4], "schedule": first[5]}, {"course": second[4], "schedule": second[5]}],
+                })
+            active.append(entry)
+
+    conflicts.sort(key=_conflict_sort_key)
+    return conflicts
+
+def _entry_order(course_name, course_key):
+    """冲突中两门课程的先后顺序：按名称，再按课程 key（下标或 id；整数排在字符串之前）。"""
+    return str(course_name), (0, course_key) if isinstance(course_key, int) else (1, str(course_key))
+
+def _conflict_sort_key(conflict):
+    return ([str(name) for name in conflict["courses"]], conflict["day"], _slot_range(conflict["slots"]),
+            [(_entry_order("", e["course"])[1], e["schedule"]) for e in conflict["entries"]])
+
+def conflict_pairs_of(conflicts):
+    """结构化冲突列表 -> 课程名称对集合，与 find_backend_conflict_pairs 的返回形式相同。"""
+    return {tuple(conflict["courses"]) for conflict in conflicts}
+
+class ConflictIndex:
+    """
+    可增量更新的冲突索引。课程以调用方给定的 key 标识（列表下标、课程 id 等）；
+    add/remove/alter 只重新检查被改动课程的上课安排（通过 (星期, 节次) 桶找到可能重叠的安排），
+    返回冲突增量 {"added": [...], "resolved": [...]}。冲突的格式与 find_backend_conflicts 相同，
+    entries 中的 course 为课程 key。conflicts() 给出当前全部冲突，与对同一课程列表调用
+    find_backend_conflicts 的结果一致；排好序的结果跨调用保留，add/remove/alter 记下受影响的冲突，
+    下次 conflicts() 只重新定位这些冲突。
+    """
+    def __init__(self, courses=None, key_field=None):
+        self._courses = {}    # key -> course
+        self._entries = {}    # key -> {schedule_index: (name, day, start_slot, end_slot, week_mask)}
+        self._buckets = {}    # (day, slot) -> {(key, schedule_index)}
+        self._conflicts = {}  # conflict_id -> (day, weeks, first_slot, last_slot)
+        self._by_course = {}  # key -> {conflict_id}
+        self._presented = {}  # conflict_id -> (对外 key, 冲突 dict, 排序键)，对外 key 不变时复用
+        self._positions = None  # sync() 模式下 key -> 课程在最新列表中的下标
+        self._object_keys = {}  # id(课程 dict) -> key，sync() 据此跳过未被替换的课程
+        self._sort_keys = []    # 已排序冲突的排序键，与 _ordered 一一对应
+        self._ordered = []      # 已排序的 conflict_id
+        self._ordered_keys = {}  # conflict_id -> 它在 _sort_keys 中的排序键
+        self._dirty = set()     # 上次 conflicts() 之后新增、移除或对外 key 变化的 conflict_id
+        for position, course in enumerate(courses or []):
+            key = position if key_field is None else _coerce_int(course.get(key_field)) if isinstance(course, dict) else None
+            if key is not None:
+                self.add(key, course)
+
+    def __len__(self):
+        return len(self._conflicts)
+
+    def course(self, key):
+        return self._courses.get(key)
+
+    def approximate_bytes(self):
+        """粗略估计索引占用的内存（按 tracemalloc 实测：每条安排约 400 字节，每个桶成员约 100 字节，每个冲突约 2KB）。"""
+        cells = sum(len(bucket) for bucket in self._buckets.values())
+        entries = sum(len(entries) for entries in self._entries.values())
+        return 400 * entries + 100 * cells + 2048 * len(self._conflicts)
+
+    def _public_key(self, key):
+        return key if self._positions is None else self._positions.get(key, key)
+
+    def _present_keyed(self, conflict_id):
+        (key_a, index_a), (key_b, index_b) = conflict_id
+        public = (self._public_key(key_a), self._public_key(key_b))
+        cached = self._presented.get(conflict_id)
+        if cached is not None and cached[0] == public:
+            return cached[1], cached[2]
+        day, weeks, first_slot, last_slot = self._conflicts[conflict_id]
+        name_a, name_b = self._entries[key_a][index_a][0], self._entries[key_b][index_b][0]
+        a = (name_a, public[0], index_a)
+        b = (name_b, public[1], index_b)
+        first, second = (a, b) if _entry_order(a[0], a[1]) <= _entry_order(b[0], b[1]) else (b, a)
+        conflict = {
+            "courses": [first[0], second[0]],
+            "day": day,
+            "weeks": weeks,
+            "slots": f"{first_slot}-{last_slot}",
+            "entries": [{"course": first[1], "schedule": first[2]}, {"course": second[1], "schedule": second[2]}],
+        }
+        sort_key = _conflict_sort_key(conflict)
+        self._presented[conflict_id] = (public, conflict, sort_key)
+        return conflict, sort_key
+
+    def _present(self, conflict_id):
+        return self._present_keyed(conflict_id)[0]
+
+    def conflicts(self):
+        """当前全部冲突（已排序）。返回的冲突 dict 会在之后的调用中复用，调用方不应修改。"""
+        for conflict_id in self._dirty:
+            sort_key = self._ordered_keys.pop(conflict_id, None)
+            if sort_key is not None:
+                i = bisect.bisect_left(self._sort_keys, sort_key)
+                while self._ordered[i] != conflict_id:
+                    i += 1
+                del self._sort_keys[i]
+                del self._ordered[i]
+        for conflict_id in self._dirty:
+            if conflict_id in self._conflicts:
+                sort_key = self._present_keyed(conflict_id)[1]
+                i = bisect.bisect_right(self._sort_keys, sort_key)
+                self._sort_keys.insert(i, sort_key)
+                self._ordered.insert(i, conflict_id)
+                self._ordered_keys[conflict_id] = sort_key
+        self._dirty.clear()
+        return [self._presented[conflict_id][1] for conflict_id in self._ordered]
+
+    def add(self, key, course):
+        """加入（或替换）一门课程，返回冲突增量。"""
+        if key in self._courses:
+            return self.alter(key, course)
+        self._courses[key] = course
+        self._object_keys[id(course)] = key
+        entries = self._entries[key] = {}
+        added = []
+        for _, course_name, schedule_index, weeks, day, start_slot, end_slot in _iter_schedule_entries([course]):
+            week_mask = compile_weeks(weeks).mask
+            if not week_mask:
+                continue
+            entries[schedule_index] = (course_name, day, start_slot, end_slot, week_mask)
+            candidates = set()
+            for slot in range(start_slot, end_slot + 1):
+                bucket = self._buckets.setdefault((day, slot), set())
+                candidates |= bucket
+                bucket.add((key, schedule_index))
+            for other_key, other_index in candidates:
+                if other_key == key:
+                    continue
+                other_name, _, other_start, other_end, other_mask = self._entries[other_key][other_index]
+                overlap = week_mask & other_mask
+                if other_name == course_name or not overlap:
+                    continue
+                conflict_id = tuple(sorted(((key, schedule_index), (other_key, other_index)), key=repr))
+                self._conflicts[conflict_id] = (day, WeekSet.of(overlap).format(),
+                                                max(start_slot, other_start), min(end_slot, other_end))
+                self._by_course.setdefault(key, set()).add(conflict_id)
+                self._by_course.setdefault(other_key, set()).add(conflict_id)
+                self._dirty.add(conflict_id)
+                added.append(conflict_id)
+        return {"added": sorted((self._present(c) for c in added), key=_conflict_sort_key), "resolved": []}
+
+    def remove(self, key):
+        """移除一门课程，返回冲突增量；key 不存在时增量为空。"""
+        if key not in self._courses:
+            return {"added": [], "resolved": []}
+        resolved = []
+        for conflict_id in self._by_course.pop(key, ()):
+            resolved.append(self._present(conflict_id))
+            del self._conflicts[conflict_id]
+            self._presented.pop(conflict_id, None)
+            # 从未排入结果的冲突（例如 preview 中试加又撤销的）直接丢弃，不留到下次 conflicts()
+            if conflict_id in self._ordered_keys:
+                self._dirty.add(conflict_id)
+            else:
+                self._dirty.discard(conflict_id)
+            for other_key, _ in conflict_id:
+                if other_key != key:
+                    self._by_course.get(other_key, set()).discard(conflict_id)
+        for schedule_index, (_, day, start_slot, end_slot, _) in self._entries.pop(key).items():
+            for slot in range(start_slot, end_slot + 1):
+                bucket = self._buckets[(day, slot)]
+                bucket.discard((key, schedule_index))
+                if not bucket:
+                    del self._buckets[(day, slot)]
+        if self._object_keys.get(id(self._courses[key])) == key:
+            del self._object_keys[id(self._courses[key])]
+        del self._courses[key]
+        return {"added": [], "resolved": sorted(resolved, key=_conflict_sort_key)}
+
+    def alter(self, key, course):
+        """替换一门课程，返回冲突增量；修改前后都存在且完全相同的冲突不出现在增量中。"""
+        before = self.remove(key)["resolved"]
+        after = self.add(key, course)["added"]
+        unchanged = [c for c in after if c in before]
+        return {"added": [c for c in after if c not in unchanged], "resolved": [c for c in before if c not in unchanged]}
+
+    def apply_id_delta(self, delta):
+        """应用会话增量（见 _apply_id_delta）：upsert 中的课程加入或替换，remove 中的 id 移除。"""
+        if not delta:
+            return
+        for course_id in delta.get("remove") or []:
+            self.remove(_coerce_int(course_id))
+        for course in delta.get("upsert") or []:
+            self.add(_coerce_int(course["id"]), course)
+
+    def preview(self, operations):
+        """
+        逐个试应用 AI 助手的 add/remove/alter 操作并立即撤销，返回每个操作单独应用时的冲突增量；
+        用户可以只接受其中一部分操作，因此每个增量都相对于当前索引计算，互不叠加。索引最终保持不变。
+        新增课程在增量中的 course 为 "new-<操作下标>"。
+        """
+        deltas = []
+        for i, op in enumerate(operations):
+            kind = op.get("operation")
+            key = f"new-{i}" if kind == "add" else op.get("id")
+            previous = self._courses.get(key)
+            if kind != "add" and previous is None:
+                deltas.append({"added": [], "resolved": []})
+                continue
+            try:
+                if kind == "add":
+                    deltas.append(self.add(key, op.get("course")))
+                elif kind == "remove":
+                    deltas.append(self.remove(key))
+                else:
+                    deltas.append(self.alter(key, dict(previous, **op.get("changes", {}))))
+            finally:
+                if previous is None:
+                    self.remove(key)
+                else:
+                    self.add(key, previous)
+        return deltas
+
+    @staticmethod
+    def _fingerprint(course):
+        if not isinstance(course, dict):
+            return "", repr(course)
+        schedules = course.get("schedules")
+        return repr(course.get("name", "未知课程")), repr([
+            (s.get("weeks"), s.get("day"), s.get("time_slot")) if isinstance(s, dict) else repr(s)
+            for s in (schedules if isinstance(schedules, list) else [])
+        ])
+
+    def sync(self, courses):
+        """
+        让索引与新的课程列表一致，返回冲突增量。课程按影响冲突检测的字段（名称及各安排的周数、星期、节次）
+        匹配，只有真正变化的课程会被重新检查；之后冲突中的 course 为课程在新列表中的下标
+        （resolved 中为旧列表的下标）。
+        上一轮已索引的课程 dict 原样出现在新列表中时（例如针对性修正合并回来的未改动课程）沿用它的指纹，
+        因此课程 dict 不应被原地修改，修改课程时请换成新的 dict。
+        """
+        keys = []
+        seen = {}
+        for course in courses if isinstance(courses, list) else []:
+            key = self._object_keys.get(id(course))
+            fingerprint = key[0] if key is not None and self._courses.get(key) is course else self._fingerprint(course)
+            occurrence = seen[fingerprint] = seen.get(fingerprint, -1) + 1
+            keys.append((fingerprint, occurrence))
+
+        current = set(keys)
+        resolved = []
+        for key in [k for k in self._courses if k not in current]:
+            resolved.extend(self.remove(key)["resolved"])
+        previous = self._positions
+        self._positions = {key: position for position, key in enumerate(keys)}
+        # 下标变化的课程，其冲突的对外 key 和排序位置都要更新
+        for key in self._courses:
+            if (key if previous is None else previous.get(key, key)) != self._positions[key]:
+                self._dirty.update(self._by_course.get(key, ()))
+        added = []
+        for key, course in zip(keys, courses if isinstance(courses, list) else []):
+            if key not in self._courses:
+                added.extend(self.add(key, course)["added"])
+        # 被移除课程与新增课程之间的冲突会在两边各出现一次（下标不同），各自保留
+        return {"added": sorted(added, key=_conflict_sort_key), "resolved": sorted(resolved, key=_conflict_sort_key)}
 
-    report_lines = ["检测到以下课程对之间存在时间冲突:"]
-    for pair in conflict_pairs:
-        report_lines.append(f"- 课程 '{pair[0]}' 与 '{pair[1]}' 存在时间重叠。")
+def detect_backend_conflicts(courses):
+    """
+    在后端对课程列表进行冲突检测。
+    返回一个元组 (has_conflict: bool, conflict_report: str, conflicts: list)，conflicts 见 find_backend_conflicts。
+    """
+    conflicts = find_backend_conflicts(courses)
+    if not conflicts:
+        return False, "", []
+    return True, format_conflict_report(conflicts), conflicts
+
+def format_conflict_report(conflicts):
+    report_lines = ["检测到以下课程之间存在时间冲突:"]
+    for conflict in conflicts:
+        name_a, name_b = conflict["courses"]
+        day = _WEEKDAY_NAMES.get(conflict["day"], f"星期{conflict['day']}")
+        report_lines.append(f"- 课程 '{name_a}' 与 '{name_b}'：第{conflict['weeks']}周 {day} 第{conflict['slots']}节 重叠。")
     
-    return True, "\n".join(report_lines)
+    return "\n".join(report_lines)
+
+class StreamingCourseParser:
+    """
+    从流式返回的 JSON 文本中增量地提取课程对象。
+    每次 feed() 一段增量文本，返回其中新闭合的课程对象列表。
+    课程对象指顶层数组（或顶层对象中某个键，如 "courses"，对应的数组）的直接子对象。
+    输出被截断或中途损坏时，self.courses 即为可恢复的有效前缀。
+    """
+    def __init__(self):
+        self.courses = []
+        self.started = False   # 是否已遇到根容器
+        self.complete = False  # 根容器是否已闭合（输出没有被截断）
+        self.root_span = None  # 根容器闭合后为它在输入文本中的 (start, end)
+        self._offset = 0       # 已处理的字符数
+        self._root_start = None
+        self.malformed = 0     # 无法解析而被丢弃的课程对象数
+        self._stack = []       # 尚未闭合的容器，元素为 '[' 或 '{'
+        self._in_string = False
+        self._escape = False
+        self._buffer = []      # 当前课程对象的原始文本
+        self._capturing = False
+        self._capture_depth = 0
+
+    def feed(self, chunk):
+        completed = []
+        for ch in chunk:
+            if self.complete:
+                break
+            self._offset += 1
+            if self._capturing:
+                self._buffer.append(ch)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+
+            if ch == '"':
+                self._in_string = True
+            elif ch in '[{':
+                if not self.started:
+                    self._root_start = self._offset - 1
+                self.started = True
+                if ch == '{' and not self._capturing and self._stack and self._stack[-1] == '[' and len(self._stack) <= 2:
+                    self._capturing = True
+                    self._capture_depth = len(self._stack)
+                    self._buffer = ['{']
+                self._stack.append(ch)
+            elif ch in ']}':
+                if self._stack:
+                    self._stack.pop()
+                    if not self._stack:
+                        self.complete = True
+                        self.root_span = (self._root_start, self._offset)
+                if self._capturing and ch == '}' and len(self._stack) == self._capture_depth:
+                    self._capturing = False
+                    course = self._load_buffer()
+                    if course is not None:
+                        self.courses.append(course)
+                        completed.append(course)
+        return completed
+
+    def _load_buffer(self):
+        try:
+            course = json.loads(''.join(self._buffer))
+        except ValueError:
+            self.malformed += 1
+            return None
+        finally:
+            self._buffer = []
+        return course if isinstance(course, dict) else None
+
+def _strip_json_fence(text):
+    cleaned = str(text).strip()
+    cleaned = re.sub(r"^```(?:json)?", "", cleaned, flags=re.IGNORECASE).strip()
+    cleaned = re.sub(r"```$", "", cleaned).strip()
+    return cleaned
+
+def parse_course_response(text):
+    """
+    解析模型返回的课程 JSON，返回 (courses, complete)。
+    整体解析失败时用 StreamingCourseParser 扫描：根容器已经闭合（只是前后多了说明文字）时解析这一段，
+    仍视为完整输出；否则退回到恢复出的有效前缀，此时 complete=False；
+    连一个完整的课程对象都恢复不出来则抛出 ValueError。
+    """
+    cleaned = _strip_json_fence(text)
+    try:
+        return _unwrap_courses(json.loads(cleaned)), True
+    except ValueError as e:
+        parser = StreamingCourseParser()
+        parser.feed(cleaned)
+        if parser.complete:
+            start, end = parser.root_span
+            try:
+                return _unwrap_courses(json.loads(cleaned[start:end])), True
+            except ValueError:
+                pass
+        if not parser.courses:
+            raise ValueError(f"无法解析AI返回的JSON: {e}") from e
+        return parser.courses, False
+
+def _unwrap_courses(courses):
+    # 兼容模型返回 {"courses": [...]} 的情况
+    if isinstance(courses, dict) and 'courses' in courses:
+        return courses['courses']
+    return courses
+
+def _course_identity(course):
+    return (str(course.get("code", "")).strip(), str(course.get("name", "")).strip())
+
+def _schedule_identity(schedule):
+    if not isinstance(schedule, dict):
+        return None
+    return tuple(str(schedule.get(k, "")).strip() for k in ("weeks", "day", "time_slot", "campus", "building", "classroom"))
+
+def merge_course_lists(*course_lists):
+    """
+    合并多份课程列表：按 (code, name) 去重，同一课程的 schedules 取并集（保持首次出现的顺序）。
+    """
+    merged = OrderedDict()
+    for courses in course_lists:
+        if not isinstance(courses, list):
+            continue
+        for course in courses:
+            if not isinstance(course, dict):
+                continue
+            key = _course_identity(course)
+            schedules = course.get("schedules", [])
+            schedules = schedules if isinstance(schedules, list) else []
+            if key not in merged:
+                merged[key] = dict(course)
+                merged[key]["schedules"] = []
+                merged[key]["_seen"] = set()
+            target = merged[key]
+            for schedule in schedules:
+                ident = _schedule_identity(schedule)
+                if ident is None or ident in target["_seen"]:
+                    continue
+                target["_seen"].add(ident)
+                target["schedules"].append(schedule)
+            if not target.get("teachers") and course.get("teachers"):
+                target["teachers"] = course["teachers"]
+    result = []
+    for course in merged.values():
+        course.pop("_seen", None)
+        result.append(course)
+    return result
 
 def build_correction_prompt(original_prompt, last_json_response, conflict_report):
     """构建用于修正错误的Prompt。"""
@@ -410,7 +2051,7 @@ def build_correction_prompt(original_prompt, last_json_response, conflict_report
     
     这是你上次返回的、包含错误的JSON数据：
     ---
-    {json.dumps(last_json_response, ensure_ascii=False, indent=2)}
+    {json.dumps(last_json_response, ensure_ascii=False, separators=(',', ':'))}
     ---
 
     这是基于你的回复生成的冲突报告：
@@ -424,9 +2065,196 @@ def build_correction_prompt(original_prompt, last_json_response, conflict_report
     如果缺少任何关键信息之一或更多（周数、星期、节次），请直接忽略该门课程，不要包含在结果中!!!
     """
 
-async def call_vision_model_with_correction(base64_images):
+# targeted: 修正轮次只发送冲突涉及的课程并把模型的修正合并回上次结果；full: 要求模型重新生成整份课程表
+AI_CORRECTION_MODE = os.getenv('AI_CORRECTION_MODE', 'targeted').lower()
+
+def _conflicting_course_names(conflict_pairs):
+    return {name for pair in conflict_pairs for name in pair}
+
+def build_targeted_correction_prompt(conflicting_courses, conflict_report):
+    """
+    构建只针对冲突课程的修正Prompt：不再附带整份课程表和原始长Prompt，
+    只发送冲突涉及的课程（紧凑JSON）和冲突报告。
+    """
+    return f"""
+    你上次从这些课程表图片中识别出的结果里，以下课程之间存在时间冲突：
+    ---
+    {conflict_report}
+    ---
+
+    这是冲突涉及的课程（其余课程已经确认无误，不要输出）：
+    ---
+    {json.dumps(conflicting_courses, ensure_ascii=False, separators=(',', ':'))}
+    ---
+
+    请对照图片逐一核实这些课程的 weeks（周数）、day（星期，1-7）和 time_slot（节次，如 "1-2"），
+    只输出修正后的这些课程，格式与上面相同（一个JSON数组），'code' 和 'name' 保持不变。
+    如果某门课程确实是误识别或缺少周数/星期/节次，请把它的 'schedules' 设为 []。
+    最终的输出必须是纯粹的、格式正确的JSON字符串，不包含任何额外的解释或标记。
+    """
+
+def merge_corrected_courses(previous_courses, patched_courses, conflicting_names):
+    """
+    把针对性修正的结果合并回上次的课程列表：
+    - 与冲突课程 (code, name) 相同的修正条目原位替换；schedules 为空表示删除该课程；
+    - 模型漏掉的冲突课程保持原样（下一轮仍会被检测到）；
+    - 其余新出现的课程追加到末尾。
+    """
+    patched_by_identity = OrderedDict()
+    if isinstance(patched_courses, list):
+        for course in patched_courses:
+            if isinstance(course, dict):
+                patched_by_identity[_course_identity(course)] = course
+
+    merged = []
+    for course in previous_courses:
+        identity = _course_identity(course)
+        if course.get("name", "未知课程") in conflicting_names and identity in patched_by_identity:
+            patched = patched_by_identity.pop(identity)
+            if patched.get("schedules"):
+                merged.append(patched)
+            continue
+        merged.append(course)
+    merged.extend(c for c in patched_by_identity.values() if c.get("schedules"))
+    return merged
+
+_STREAM_PROGRESS_INTERVAL_SECONDS = 0.5
+
+def _emit(on_event, event, **data):
+    """向进度回调发送事件；回调异常不影响识别流程。"""
+    if on_event is None:
+        return
+    try:
+        on_event(event, data)
+    except Exception as e:
+        logging.warning(f"Progress callback failed for event '{event}': {e}")
+
+def build_continuation_prompt(original_prompt, recovered_courses):
+    """构建续写Prompt：上次输出被截断时，只要求模型补齐缺失的课程。"""
+    recovered = [{"code": c.get("code", ""), "name": c.get("name", "")} for c in recovered_courses]
+    return f"""
+    你上次的回复在输出过程中被截断或格式损坏。以下课程已经被成功解析，请不要重复输出它们：
+    ---
+    {json.dumps(recovered, ensure_ascii=False, separators=(',', ':'))}
+    ---
+
+    这是我的原始请求：
+    ---
+    {original_prompt}
+    ---
+
+    请只输出上述列表之外、图片中剩余的课程，格式与原始请求的要求完全相同（一个JSON数组）。
+    如果没有剩余的课程，请输出 []。
+    最终的输出必须是纯粹的、格式正确的JSON字符串，不包含任何额外的解释或标记。
+    """
+
+async def _stream_vision_completion(content, attempt, on_event=None, new_request=True, **kwargs):
+    """在视觉并发名额内流式调用模型，边接收边推送 course/tokens 事件，返回完整的输出文本。"""
+    async with vision_limiter.slot(new_request=new_request):
+        return await _read_vision_stream(content, attempt, on_event, **kwargs)
+
+async def _read_vision_stream(content, attempt, on_event=None, **kwargs):
+    """流式调用视觉模型并读完整个输出；调用方负责持有视觉并发名额。"""
+    answer_content = ""
+    stream_parser = StreamingCourseParser()
+    last_progress_at = 0.0
+
+    completion = await _safe_chat_completion(
+        model=AI_MODEL,
+        messages=[{"role": "user", "content": content}],
+        stream=True,
+        **kwargs,
+    )
+
+    async for chunk in completion:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content is not None:
+            answer_content += delta.content
+            if on_event is not None:
+                for course in stream_parser.feed(delta.content):
+                    _emit(on_event, "course", attempt=attempt, index=len(stream_parser.courses) - 1, course=course)
+                now = time.monotonic()
+                if now - last_progress_at >= _STREAM_PROGRESS_INTERVAL_SECONDS:
+                    last_progress_at = now
+                    _emit(on_event, "tokens", attempt=attempt, chars=len(answer_content))
+
+    return answer_content
+
+# --- 并行候选（best-of-N） ---
+# 顺序修正最坏要等三次完整的模型调用。开启后首轮同时发起 N 个候选，谁先给出无冲突的结果就用谁，
+# 其余候选立即取消；全部有冲突时挑冲突最少的一个进入常规修正流程。
+# 整个候选阶段只占用一个视觉并发名额（AI_VISION_MAX_CONCURRENCY），一次上传不会挤占其他用户；
+# 同一请求内同时进行的候选数由 AI_VISION_CANDIDATE_CONCURRENCY 限制，单次请求的上游成本最多为 N 倍。
+
+AI_VISION_CANDIDATES = max(1, int(os.getenv('AI_VISION_CANDIDATES', 1)))
+AI_VISION_CANDIDATE_CONCURRENCY = max(1, int(os.getenv('AI_VISION_CANDIDATE_CONCURRENCY', 2)))
+AI_VISION_CANDIDATE_TEMPERATURE = float(os.getenv('AI_VISION_CANDIDATE_TEMPERATURE', 0.7))
+
+def _candidate_score(courses, complete, conflict_pairs):
+    """候选排序：完整输出优先，其次冲突越少越好，最后课程越多越好。"""
+    return (complete, -len(conflict_pairs), len(courses))
+
+async def _generate_vision_candidate(content, index, on_event, gate):
+    # 第一个候选保持默认采样，其余候选提高温度以获得不同的识别结果
+    kwargs = {"temperature": AI_VISION_CANDIDATE_TEMPERATURE} if index > 0 else {}
+    # 落选候选的流式课程会和胜出者混在一起，因此候选阶段不推送 course 事件
+    async with gate:
+        full_response = await _read_vision_stream(content, 1, None, **kwargs)
+    courses, complete = parse_course_response(full_response)
+    # 与修正循环使用同一套冲突判定（结果等于 conflict_pairs_of(find_backend_conflicts(...))），只是不生成冲突详情
+    conflict_pairs = find_backend_conflict_pairs(courses) if complete else set()
+    _emit(on_event, "candidate_finished", candidate=index, courses=len(courses), complete=complete, conflicts=len(conflict_pairs))
+    return courses, complete, conflict_pairs
+
+async def run_vision_candidates(content, on_event=None, n=None):
+    """
+    并发生成 n 个候选并用后端冲突检测打分。返回第一个完整且无冲突的候选，同时取消其余候选；
+    没有这样的候选时返回得分最高的一个。返回 (courses, complete, conflict_pairs)，全部失败时抛出最后的异常。
+    整个候选阶段只申请一个视觉并发名额，同时进行的候选数不超过 AI_VISION_CANDIDATE_CONCURRENCY。
+    """
+    n = n or AI_VISION_CANDIDATES
+    async with vision_limiter.slot(new_request=True):
+        return await _run_vision_candidates(content, on_event, n)
+
+async def _run_vision_candidates(content, on_event, n):
+    _emit(on_event, "candidates_started", candidates=n)
+    gate = asyncio.Semaphore(AI_VISION_CANDIDATE_CONCURRENCY)
+    tasks = [asyncio.ensure_future(_generate_vision_candidate(content, index, on_event, gate)) for index in range(n)]
+    best = None
+    last_error = None
+    try:
+        for finished in asyncio.as_completed(tasks):
+            try:
+                courses, complete, conflict_pairs = await finished
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                last_error = e
+                print(f"候选识别失败: {e}")
+                _emit(on_event, "candidate_failed", error=str(e))
+                continue
+            if complete and courses and not conflict_pairs:
+                return courses, complete, conflict_pairs
+            if best is None or _candidate_score(*best) < _candidate_score(courses, complete, conflict_pairs):
+                best = (courses, complete, conflict_pairs)
+    finally:
+        cancelled = 0
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+                cancelled += 1
+        if cancelled:
+            print(f"已取消 {cancelled} 个落选的候选识别。")
+    if best is None:
+        raise last_error
+    return best
+
+async def call_vision_model_with_correction(base64_images, on_event=None):
     """
     调用视觉模型，并内建一个自我修正循环来处理冲突。
+    on_event(event, data) 可选，用于实时接收进度事件（见 /api/process-image/stream）。
     """
     initial_prompt = """
     你是一个专业的课程表图片解析助手。请仔细识别用户上传的所有课程表图片中的全部课程信息，并将它们合并、去重后，解析为单一的、严格的JSON格式。
@@ -456,66 +2284,92 @@ async def call_vision_model_with_correction(base64_images):
     - 请确保识别的课程名称、教师姓名、上课时间等信息与图片内容完全一致。
     """
     
+    image_content = [{"type": "image_url", "image_url": {"url": _image_data_url(img)}} for img in base64_images]
     max_retries = 2
     last_courses_response = None
+    last_conflict_pairs = set()
+    last_conflicts = []
+    conflict_index = ConflictIndex()  # 跨轮次复用：每轮只重新检查与上一轮不同的课程
+    recovered_prefix = None  # 上次被截断的输出中恢复出的课程，下一次只请求缺失的部分
     
     for i in range(max_retries + 1):
         print(f"--- 开始第 {i+1} 次尝试 ---")
         
         # 1. 构建 Prompt 和 Content
         prompt_to_use = initial_prompt
-        if i > 0 and last_courses_response:
+        mode = "initial"
+        if i > 0 and recovered_prefix:
+            mode = "continuation"
+            prompt_to_use = build_continuation_prompt(initial_prompt, recovered_prefix)
+        elif i > 0 and last_conflict_pairs and AI_CORRECTION_MODE == "targeted":
+            mode = "targeted_correction"
+            conflicting_names = _conflicting_course_names(last_conflict_pairs)
+            conflicting_courses = [c for c in last_courses_response if c.get("name", "未知课程") in conflicting_names]
+            prompt_to_use = build_targeted_correction_prompt(conflicting_courses, last_conflict_report)
+        elif i > 0 and last_courses_response:
+            mode = "correction"
             prompt_to_use = build_correction_prompt(initial_prompt, last_courses_response, last_conflict_report)
+        _emit(on_event, "attempt_started", attempt=i + 1, max_attempts=max_retries + 1, mode=mode)
+        if mode in ("correction", "targeted_correction"):
+            _emit(on_event, "correction_started", attempt=i + 1, conflict_report=last_conflict_report, mode=mode)
 
-        content = []
-        for base64_image in base64_images:
-            if ',' in base64_image: img_data = base64_image.split(',')[1]
-            else: img_data = base64_image
-            content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_data}"}})
+        content = list(image_content)
         content.append({"type": "text", "text": prompt_to_use})
 
         # 2. 调用AI模型
         try:
-            answer_content = ""
-
-            completion = _safe_chat_completion(
-                model=AI_MODEL,
-                messages=[{"role": "user", "content": content}],
-                stream=True,
-            )
-
-            for chunk in completion:
-                if not chunk.choices:
-                    continue
-                delta = chunk.choices[0].delta
-                if delta.content is not None:
-                    answer_content += delta.content
-
-            full_response = answer_content
-            print(f"第 {i+1} 次尝试，AI返回: {full_response[:200]}...")
-
-            if full_response.strip().startswith("```json"):
-                cleaned_response = full_response.strip()[7:-3].strip()
+            if i == 0 and AI_VISION_CANDIDATES > 1:
+                courses, complete, _ = await run_vision_candidates(content, on_event)
+                print(f"第 1 次尝试从 {AI_VISION_CANDIDATES} 个并行候选中选出 {len(courses)} 门课程。")
+                for index, course in enumerate(courses):
+                    _emit(on_event, "course", attempt=1, index=index, course=course)
             else:
-                cleaned_response = full_response.strip()
-            
-            courses = json.loads(cleaned_response)
-            # 兼容模型返回 {"courses": [...]} 的情况
-            if isinstance(courses, dict) and 'courses' in courses:
-                courses = courses['courses']
-
+                full_response = await _stream_vision_completion(content, i + 1, on_event, new_request=(i == 0))
+                print(f"第 {i+1} 次尝试，AI返回: {full_response[:200]}...")
+                courses, complete = parse_course_response(full_response)
+            if mode == "continuation":
+                courses = merge_course_lists(recovered_prefix, courses)
+            elif mode == "targeted_correction":
+                # 未被修正到的课程保留上次的结果，因此即使修正输出被截断，合并结果也是完整的
+                courses = merge_corrected_courses(last_courses_response, courses, conflicting_names)
+                complete = True
+
+        except UpstreamBusyError:
+            raise
         except Exception as e:
             print(f"第 {i+1} 次尝试失败: {e}")
+            _emit(on_event, "attempt_failed", attempt=i + 1, error=str(e))
             if i == max_retries: # 如果是最后一次尝试失败，则抛出异常
                  raise ConnectionError(f"AI在第{i+1}次尝试中调用或解析失败: {e}")
-            last_courses_response = {"error": "AI response parsing failed"}
-            last_conflict_report = "AI响应格式错误，无法解析JSON。"
+            if mode != "targeted_correction":
+                last_courses_response = {"error": "AI response parsing failed"}
+                last_conflict_report = "AI响应格式错误，无法解析JSON。"
+                last_conflict_pairs = set()
+                last_conflicts = []
             continue # 继续下一次重试
 
         last_courses_response = courses
 
+        if not complete:
+            # 输出被截断：保留已恢复的有效前缀，下一次只请求缺失的尾部
+            recovered_prefix = courses
+            print(f"第 {i+1} 次尝试的输出不完整，已恢复 {len(courses)} 门课程。")
+            _emit(on_event, "partial_recovered", attempt=i + 1, recovered=len(courses))
+            if i == max_retries:
+                return {
+                    "success": False,
+                    "courses": courses,
+                    "message": f"AI返回的数据不完整，仅恢复了 {len(courses)} 门课程，请手动检查并补充。",
+                }
+            continue
+        recovered_prefix = None
+
         # 3. 冲突检测
-        has_conflict, conflict_report = detect_backend_conflicts(courses)
+        conflict_delta = conflict_index.sync(courses)
+        last_conflicts = conflict_index.conflicts()
+        last_conflict_pairs = conflict_pairs_of(last_conflicts)
+        has_conflict = bool(last_conflicts)
+        conflict_report = format_conflict_report(last_conflicts) if has_conflict else ""
         last_conflict_report = conflict_report
 
         # 4. 判断结果
@@ -524,11 +2378,783 @@ async def call_vision_model_with_correction(base64_images):
             return {"success": True, "courses": courses}
         
         print(f"第 {i+1} 次尝试后发现冲突: {conflict_report}")
+        _emit(on_event, "conflicts_found", attempt=i + 1, conflict_report=conflict_report, conflicts=last_conflicts,
+              added=len(conflict_delta["added"]), resolved=len(conflict_delta["resolved"]))
 
     # 如果循环结束仍有冲突
     print("达到最大重试次数，修正失败。")
     final_message = f"AI自动修正失败，请根据以下报告手动检查：\n\n{last_conflict_report}"
-    return {"success": False, "courses": last_courses_response, "message": final_message}
+    return {"success": False, "courses": last_courses_response, "message": final_message, "conflicts": last_conflicts}
+
+# --- 多图并行识别 ---
+# 多页课表默认放在同一个请求里识别，耗时随图片总量增长。开启后每张图片单独并发识别，
+# 课程在本地按 (code, name) 合并，总耗时取决于最慢的一页。
+
+AI_VISION_FANOUT_ENABLED = os.getenv('AI_VISION_FANOUT_ENABLED', 'false').lower() == 'true'
+
+def _page_event_callback(on_event, page):
+    if on_event is None:
+        return None
+    return lambda event, data: on_event(event, dict(data, page=page))
+
+async def call_vision_model_fanout(base64_images, on_event=None):
+    """
+    把每张图片单独交给 call_vision_model_with_correction 并发识别，合并各页课程后统一做冲突检测。
+    进度事件额外带有 page 字段（从 0 开始）。任一页遇到 UpstreamBusyError 时立即取消其余页面，
+    不再为注定被丢弃的结果消耗上游调用，并把该异常抛给调用方。
+    """
+    tasks = [asyncio.ensure_future(call_vision_model_with_correction([img], on_event=_page_event_callback(on_event, page)))
+             for page, img in enumerate(base64_images)]
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if isinstance(task.exception(), UpstreamBusyError):
+                    raise task.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    page_courses = []
+    messages = []
+    for page, task in enumerate(tasks):
+        result = task.exception() or task.result()
+        if isinstance(result, BaseException):
+            print(f"第 {page+1} 张图片识别失败: {result}")
+            messages.append(f"第 {page+1} 张图片识别失败：{result}")
+            continue
+        page_courses.append(result.get("courses") or [])
+        if not result.get("success"):
+            messages.append(f"第 {page+1} 张图片：{result.get('message', '识别结果需要检查')}")
+
+    if not page_courses:
+        raise ConnectionError("；".join(messages))
+
+    courses = merge_course_lists(*page_courses)
+    has_conflict, conflict_report, conflicts = detect_backend_conflicts(courses)
+    print(f"多图并行识别完成：{len(base64_images)} 张图片，合并后 {len(courses)} 门课程。")
+    if has_conflict:
+        print(f"合并后发现跨页冲突: {conflict_report}")
+        _emit(on_event, "conflicts_found", attempt=0, conflict_report=conflict_report, conflicts=conflicts)
+        messages.append(f"合并各页结果后发现冲突，请根据以下报告手动检查：\n\n{conflict_report}")
+
+    if messages:
+        return {"success": False, "courses": courses, "message": "\n".join(messages), "conflicts": conflicts}
+    return {"success": True, "courses": courses}
+
+# --- 图片预处理 ---
+# 手机上传的往往是全分辨率截图。调用视觉模型前先解码、识别真实格式、裁掉四周的纯色边距、
+# 缩放到不超过 IMAGE_MAX_EDGE 并重新压缩，以减小上游请求体积和模型延迟。
+# 缩放/裁剪/重压缩需要 Pillow；未安装时只做格式识别。
+
+IMAGE_PREPROCESS_ENABLED = os.getenv('IMAGE_PREPROCESS_ENABLED', 'true').lower() == 'true'
+IMAGE_MAX_EDGE = int(os.getenv('IMAGE_MAX_EDGE', 2048))
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', 85))
+IMAGE_CROP_MARGINS = os.getenv('IMAGE_CROP_MARGINS', 'true').lower() == 'true'
+_MARGIN_TOLERANCE = 12
+_MARGIN_PADDING = 8
+
+_IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+)
+
+image_preprocess_stats = {"images": 0, "original_bytes": 0, "processed_bytes": 0, "resized": 0, "cropped": 0}
+_image_preprocess_lock = threading.Lock()
+
+if IMAGE_PREPROCESS_ENABLED and Image is None:
+    logging.warning("Pillow is not installed; image preprocessing will only detect image formats.")
+
+def _split_base64_image(base64_image):
+    return base64_image.split(',', 1)[1] if ',' in base64_image else base64_image
+
+def _decode_base64_image(base64_image):
+    """把（可能带 data URL 前缀的）base64 图片解码为字节，失败返回 None。"""
+    if not isinstance(base64_image, str) or not base64_image:
+        return None
+    try:
+        return base64.b64decode(_split_base64_image(base64_image))
+    except (binascii.Error, ValueError):
+        return None
+
+@functools.lru_cache(maxsize=32)
+def _image_digest(base64_image):
+    """解码后图片字节的 SHA-256，无法解码时返回 None。修正轮次会反复发送同一张图片，结果被缓存。"""
+    image_bytes = _decode_base64_image(base64_image)
+    return hashlib.sha256(image_bytes).hexdigest() if image_bytes else None
+
+def _sniff_image_mime(image_bytes):
+    """按文件头识别图片的真实格式，无法识别时按 JPEG 处理（与旧行为一致）。"""
+    for signature, mime in _IMAGE_SIGNATURES:
+        if image_bytes.startswith(signature):
+            return mime
+    if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'image/jpeg'
+
+def _image_data_url(base64_image):
+    """构建带真实 MIME 类型的 data URL（只解码开头几个字节用于识别格式）。"""
+    img_data = _split_base64_image(base64_image)
+    try:
+        head = base64.b64decode(img_data[:24])
+    except (binascii.Error, ValueError):
+        head = b''
+    return f"data:{_sniff_image_mime(head)};base64,{img_data}"
+
+def _crop_uniform_margins(img):
+    """裁掉与左上角颜色相近的四周边距，返回 (图片, 是否裁剪)。"""
+    gray = img.convert('L')
+    background = gray.getpixel((0, 0))
+    mask = gray.point(lambda p: 255 if abs(p - background) > _MARGIN_TOLERANCE else 0)
+    bbox = mask.getbbox()
+    if not bbox:
+        return img, False
+    left = max(0, bbox[0] - _MARGIN_PADDING)
+    top = max(0, bbox[1] - _MARGIN_PADDING)
+    right = min(img.width, bbox[2] + _MARGIN_PADDING)
+    bottom = min(img.height, bbox[3] + _MARGIN_PADDING)
+    if (left, top, right, bottom) == (0, 0, img.width, img.height):
+        return img, False
+    return img.crop((left, top, right, bottom)), True
+
+def preprocess_image(base64_image):
+    """
+    预处理单张图片，返回 (data_url, info)。处理失败或结果反而更大时保留原图（仍修正 MIME 类型）。
+    info: {"mime", "original_bytes", "processed_bytes", "resized", "cropped"}
+    """
+    image_bytes = _decode_base64_image(base64_image)
+    if not image_bytes:
+        return _image_data_url(base64_image), None
+
+    mime = _sniff_image_mime(image_bytes)
+    info = {"mime": mime, "original_bytes": len(image_bytes), "processed_bytes": len(image_bytes), "resized": False, "cropped": False}
+    original_url = f"data:{mime};base64,{_split_base64_image(base64_image)}"
+    if Image is None:
+        return original_url, info
+
+    try:
+        from PIL import ImageOps
+        with Image.open(io.BytesIO(image_bytes)) as opened:
+            img = ImageOps.exif_transpose(opened)
+            if img.mode in ('RGBA', 'LA', 'P'):
+                rgba = img.convert('RGBA')
+                img = Image.new('RGB', rgba.size, (255, 255, 255))
+                img.paste(rgba, mask=rgba.split()[-1])
+            elif img.mode != 'RGB':
+                img = img.convert('RGB')
+
+            if IMAGE_CROP_MARGINS:
+                img, info["cropped"] = _crop_uniform_margins(img)
+            if max(img.size) > IMAGE_MAX_EDGE:
+                img.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+                info["resized"] = True
+
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+            processed = buffer.getvalue()
+    except Exception as e:
+        logging.warning(f"Image preprocessing failed, sending original image: {e}")
+        return original_url, info
+
+    if len(processed) >= len(image_bytes) and not (info["resized"] or info["cropped"]):
+        return original_url, info
+    info["mime"] = 'image/jpeg'
+    info["processed_bytes"] = len(processed)
+    return f"data:image/jpeg;base64,{base64.b64encode(processed).decode('ascii')}", info
+
+def preprocess_images(base64_images):
+    """
+    预处理一组图片，返回 (data_urls, report)。CPU 密集，应放到线程中执行。
+    report 汇总本次请求的原始/处理后字节数和节省的字节数。
+    """
+    if not IMAGE_PREPROCESS_ENABLED:
+        return [_image_data_url(img) for img in base64_images], None
+
+    urls = []
+    report = {"images": 0, "original_bytes": 0, "processed_bytes": 0, "resized": 0, "cropped": 0}
+    for base64_image in base64_images:
+        url, info = preprocess_image(base64_image)
+        urls.append(url)
+        if info is None:
+            continue
+        report["images"] += 1
+        report["original_bytes"] += info["original_bytes"]
+        report["processed_bytes"] += info["processed_bytes"]
+        report["resized"] += int(info["resized"])
+        report["cropped"] += int(info["cropped"])
+    report["saved_bytes"] = report["original_bytes"] - report["processed_bytes"]
+
+    with _image_preprocess_lock:
+        for key in ("images", "original_bytes", "processed_bytes", "resized", "cropped"):
+            image_preprocess_stats[key] += report[key]
+    if report["images"]:
+        print(f"图片预处理：{report['images']} 张，{report['original_bytes']} -> {report['processed_bytes']} 字节，节省 {report['saved_bytes']} 字节。")
+    return urls, report
+
+# --- 图片结果缓存 ---
+
+AI_IMAGE_CACHE_MAX_ENTRIES = int(os.getenv('AI_IMAGE_CACHE_MAX_ENTRIES', 256))
+AI_IMAGE_CACHE_MAX_MB = float(os.getenv('AI_IMAGE_CACHE_MAX_MB', 16))
+# 感知哈希可以命中被重新压缩过的同一张截图，但同一教务系统导出的不同课表版式非常相似，
+# 阈值过大会把别人的课表返回给用户，因此默认关闭。需要安装 Pillow。
+AI_IMAGE_CACHE_PERCEPTUAL = os.getenv('AI_IMAGE_CACHE_PERCEPTUAL', 'false').lower() == 'true'
+AI_IMAGE_CACHE_PERCEPTUAL_MAX_DISTANCE = int(os.getenv('AI_IMAGE_CACHE_PERCEPTUAL_MAX_DISTANCE', 12))
+_PERCEPTUAL_HASH_SIZE = 32
+
+def _perceptual_hash(image_bytes):
+    """
+    计算差值哈希（dHash），返回 (宽高比, 哈希整数)。
+    缩放到 (N+1)xN 的灰度图，比较每行相邻像素的明暗得到 N*N 位。
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            aspect = round(img.width / img.height, 2) if img.height else 0
+            small = img.convert('L').resize((_PERCEPTUAL_HASH_SIZE + 1, _PERCEPTUAL_HASH_SIZE))
+            pixels = list(small.getdata())
+    except Exception:
+        return None
+    bits = 0
+    width = _PERCEPTUAL_HASH_SIZE + 1
+    for row in range(_PERCEPTUAL_HASH_SIZE):
+        offset = row * width
+        for col in range(_PERCEPTUAL_HASH_SIZE):
+            bits = (bits << 1) | (1 if pixels[offset + col] > pixels[offset + col + 1] else 0)
+    return aspect, bits
+
+class ImageResultCache:
+    """
+    视觉解析结果缓存。精确层以解码后图片字节的 SHA-256（加模型名）为键，存放在 ResultCache 中；
+    可选的感知层在内存里维护 感知哈希 -> 精确键 的索引，用于识别重新压缩过的相同截图。
+    """
+    def __init__(self, cache, perceptual=False, max_distance=0):
+        self.cache = cache
+        self.perceptual = perceptual and Image is not None
+        self.max_distance = max_distance
+        self._index = OrderedDict()  # exact_key -> tuple of (aspect, hash)
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.lookup_hits = 0
+        self.perceptual_hits = 0
+
+    def fingerprint(self, base64_images):
+        """
+        计算一组图片的 (精确键, 感知哈希元组)。任意一张图片无法解码时返回 (None, None)。
+        图片顺序不影响结果。CPU 密集，应放到线程中执行。
+        """
+        digests = []
+        perceptual = []
+        for base64_image in base64_images:
+            digest = _image_digest(base64_image)
+            if digest is None:
+                return None, None
+            digests.append(digest)
+            if self.perceptual:
+                phash = _perceptual_hash(_decode_base64_image(base64_image))
+                if phash is not None:
+                    perceptual.append(phash)
+        raw = AI_MODEL + "\n" + "\n".join(sorted(digests))
+        exact_key = hashlib.sha256(raw.encode('utf-8')).hexdigest()
+        phashes = tuple(sorted(perceptual)) if self.perceptual and len(perceptual) == len(digests) else None
+        return exact_key, phashes
+
+    def _is_near(self, a, b):
+        if len(a) != len(b):
+            return False
+        for (aspect_a, hash_a), (aspect_b, hash_b) in zip(a, b):
+            if aspect_a != aspect_b or bin(hash_a ^ hash_b).count('1') > self.max_distance:
+                return False
+        return True
+
+    async def get_async(self, exact_key, phashes=None):
+        value = await self.cache.get_async(exact_key)
+        perceptual_hit = False
+        if value is None and phashes:
+            with self._lock:
+                candidates = [key for key, known in self._index.items() if key != exact_key and self._is_near(known, phashes)]
+            for key in candidates:
+                value = await self.cache.get_async(key)
+                if value is not None:
+                    perceptual_hit = True
+                    break
+        with self._lock:
+            self.lookups += 1
+            if value is not None:
+                self.lookup_hits += 1
+            if perceptual_hit:
+                self.perceptual_hits += 1
+        return value
+
+    async def put_async(self, exact_key, phashes, value):
+        await self.cache.put_async(exact_key, value)
+        if phashes:
+            with self._lock:
+                self._index.pop(exact_key, None)
+                self._index[exact_key] = phashes
+                while len(self._index) > self.cache.max_entries:
+                    self._index.popitem(last=False)
+
+    def stats(self):
+        stats = self.cache.stats()
+        with self._lock:
+            # 按请求统计命中率：一次感知命中在底层缓存中表现为一次未命中加一次命中
+            stats["hit_ratio"] = round(self.lookup_hits / self.lookups, 4) if self.lookups else 0.0
+            stats["perceptual_enabled"] = self.perceptual
+            stats["perceptual_hits"] = self.perceptual_hits
+        return stats
+
+image_result_cache = ImageResultCache(
+    ResultCache(
+        name="process-image",
+        max_entries=AI_IMAGE_CACHE_MAX_ENTRIES,
+        max_bytes=int(AI_IMAGE_CACHE_MAX_MB * 1024 * 1024),
+        ttl_seconds=AI_RESULT_CACHE_TTL_SECONDS,
+        disk_dir=os.path.join(AI_RESULT_CACHE_DIR, 'image') if AI_RESULT_CACHE_DIR else None,
+        disk_max_bytes=int(AI_RESULT_CACHE_DISK_MAX_MB * 1024 * 1024),
+    ),
+    perceptual=AI_IMAGE_CACHE_PERCEPTUAL,
+    max_distance=AI_IMAGE_CACHE_PERCEPTUAL_MAX_DISTANCE,
+)
+if AI_IMAGE_CACHE_PERCEPTUAL and Image is None:
+    logging.warning("AI_IMAGE_CACHE_PERCEPTUAL is enabled but Pillow is not installed; using exact hashes only.")
+
+async def _preprocess_and_call_vision_model(base64_images, on_event):
+    image_urls, report = await asyncio.to_thread(preprocess_images, base64_images)
+    if report is not None:
+        _emit(on_event, "preprocessed", **report)
+    if AI_VISION_FANOUT_ENABLED and len(image_urls) > 1:
+        result = await call_vision_model_fanout(image_urls, on_event=on_event)
+    else:
+        result = await call_vision_model_with_correction(image_urls, on_event=on_event)
+    if report is not None:
+        result["preprocess"] = report
+    return result
+
+async def call_vision_model_cached(base64_images, on_event=None):
+    """
+    带结果缓存的 call_vision_model_with_correction：只缓存无冲突的最终结果，
+    重复上传的同一组截图直接返回，跳过所有识别与修正轮次；并发的相同上传共享同一次识别。
+    """
+    exact_key, phashes = await asyncio.to_thread(image_result_cache.fingerprint, base64_images)
+    if exact_key is None:
+        return await _preprocess_and_call_vision_model(base64_images, on_event)
+
+    if AI_RESULT_CACHE_ENABLED:
+        cached = await image_result_cache.get_async(exact_key, phashes)
+        if cached is not None:
+            print(f"命中图片解析缓存 {exact_key[:12]}，跳过 AI 调用。")
+            for index, course in enumerate(cached):
+                _emit(on_event, "course", attempt=0, index=index, course=course)
+            return {"success": True, "courses": cached}
+
+    async def fetch(broadcast):
+        result = await _preprocess_and_call_vision_model(base64_images, broadcast)
+        if AI_RESULT_CACHE_ENABLED and result.get("success") and isinstance(result.get("courses"), list) and result["courses"]:
+            await image_result_cache.put_async(exact_key, phashes, result["courses"])
+        return result
+
+    return await image_singleflight.do(exact_key, fetch, on_event=on_event)
+
+# --- 异步任务 ---
+# 图片识别加上修正轮次可能超过反向代理的超时时间，连接一断，已经付出的上游开销就白费了。
+# /api/process-image、/api/process-data 和 /api/ai-assistant 支持任务模式（?async=1 或请求体
+# "async": true）：立即返回 202 和 job_id，任务在 AI 事件循环上由有界的工作池执行，
+# 与客户端连接无关；结果通过 GET /api/jobs/<job_id>?wait=秒 轮询或长轮询获取，保留 AI_JOB_RESULT_TTL_SECONDS 秒。
+
+AI_JOB_WORKERS = int(os.getenv('AI_JOB_WORKERS', 8))
+AI_JOB_MAX_PENDING = int(os.getenv('AI_JOB_MAX_PENDING', 200))
+AI_JOB_RESULT_TTL_SECONDS = int(os.getenv('AI_JOB_RESULT_TTL_SECONDS', 600))
+AI_JOB_MAX_WAIT_SECONDS = float(os.getenv('AI_JOB_MAX_WAIT_SECONDS', 30))
+# 任务持久化：看门狗可能随时 SIGKILL 并重启进程。任务和任务中已经收到的上游响应记录在
+# SQLite（WAL 模式）里，重启后未完成的任务重新排队，已经收到的上游响应直接重放。
+AI_JOB_STORE_PATH = os.getenv('AI_JOB_STORE_PATH', os.path.join(SCRIPT_DIR, 'data', 'ai_jobs.sqlite3'))
+AI_JOB_STORE_ENABLED = os.getenv('AI_JOB_STORE_ENABLED', 'true').lower() == 'true'
+AI_JOB_MAX_ATTEMPTS = int(os.getenv('AI_JOB_MAX_ATTEMPTS', 3))
+
+JOB_HANDLERS = {}
+
+class JobStore:
+    """
+    SQLite 任务存储。WAL + synchronous=NORMAL：进程被杀不会丢失已提交的事务。
+    方法都是同步的；在 AI 事件循环上使用时要放到线程中执行（asyncio.to_thread）。
+    """
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL, status TEXT NOT NULL,
+                    created_at REAL NOT NULL, started_at REAL, finished_at REAL,
+                    result TEXT, http_status INTEGER, attempts INTEGER NOT NULL DEFAULT 0
+                )""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS upstream_responses (
+                    job_id TEXT NOT NULL, call_key TEXT NOT NULL, content TEXT NOT NULL, created_at REAL NOT NULL,
+                    PRIMARY KEY (job_id, call_key)
+                )""")
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._connection().execute(sql, params).fetchall()
+
+    def insert(self, job):
+        self._execute(
+            "INSERT INTO jobs (id, kind, payload, status, created_at, attempts) VALUES (?, ?, ?, ?, ?, ?)",
+            (job.id, job.kind, json.dumps(job.payload, ensure_ascii=False), job.status, job.created_at, job.attempts),
+        )
+
+    def mark_running(self, job):
+        self._execute("UPDATE jobs SET status = ?, started_at = ?, attempts = ? WHERE id = ?",
+                      (job.status, job.started_at, job.attempts, job.id))
+
+    def finish(self, job):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN")
+            conn.execute("UPDATE jobs SET status = ?, finished_at = ?, result = ?, http_status = ? WHERE id = ?",
+                         (job.status, job.finished_at, json.dumps(job.result, ensure_ascii=False), job.http_status, job.id))
+            conn.execute("DELETE FROM upstream_responses WHERE job_id = ?", (job.id,))
+            conn.execute("COMMIT")
+
+    def record_response(self, job_id, call_key, content):
+        self._execute("INSERT OR REPLACE INTO upstream_responses (job_id, call_key, content, created_at) VALUES (?, ?, ?, ?)",
+                      (job_id, call_key, content, time.time()))
+
+    def load_responses(self, job_id):
+        return dict(self._execute("SELECT call_key, content FROM upstream_responses WHERE job_id = ?", (job_id,)))
+
+    def load_jobs(self, finished_after):
+        return self._execute(
+            "SELECT id, kind, payload, status, created_at, started_at, finished_at, result, http_status, attempts "
+            "FROM jobs WHERE finished_at IS NULL OR finished_at > ? ORDER BY created_at", (finished_after,))
+
+    def purge(self, finished_before):
+        self._execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at <= ?", (finished_before,))
+
+_current_job_journal = contextvars.ContextVar("current_job_journal", default=None)
+
+def _upstream_call_fingerprint(kwargs):
+    """
+    上游调用参数的指纹。图片只计入解码后字节的摘要（与图片结果缓存相同的 _image_digest），
+    不再把数 MB 的 base64 整段序列化再哈希。CPU 密集，应放到线程中执行。
+    """
+    parts = [f"{key}={json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)}"
+             for key, value in sorted(kwargs.items()) if key != "messages"]
+    for message in kwargs.get("messages") or []:
+        parts.append(f"role={message.get('role')}")
+        content = message.get("content")
+        for item in content if isinstance(content, list) else [content]:
+            if isinstance(item, dict) and item.get("type") == "image_url":
+                url = (item.get("image_url") or {}).get("url", "")
+                parts.append(f"image={_image_digest(url) or hashlib.sha256(str(url).encode('utf-8')).hexdigest()}")
+            else:
+                parts.append(f"part={json.dumps(item, sort_keys=True, ensure_ascii=False, default=str)}")
+    return hashlib.sha256("\n".join(parts).encode('utf-8')).hexdigest()
+
+class JobJournal:
+    """
+    记录一个任务中每次上游调用的输出文本。调用键为请求参数指纹（_upstream_call_fingerprint）加上相同请求的序号，
+    任务重跑时相同的调用序列得到相同的键，已记录的调用直接重放。写入存储在线程中进行，不阻塞 AI 事件循环。
+    """
+    def __init__(self, job_id, store, responses):
+        self.job_id = job_id
+        self.store = store
+        self.responses = responses
+        self._ordinals = {}
+        self.replayed = 0
+
+    def key_for(self, digest):
+        ordinal = self._ordinals.get(digest, 0)
+        self._ordinals[digest] = ordinal + 1
+        return f"{digest}:{ordinal}"
+
+    def replay(self, key, stream):
+        content = self.responses.get(key)
+        if content is None:
+            return None
+        self.replayed += 1
+        if stream:
+            return _replay_stream(content)
+        message = SimpleNamespace(content=content, role="assistant")
+        return SimpleNamespace(choices=[SimpleNamespace(index=0, message=message, finish_reason="stop")])
+
+    async def capture(self, key, completion, stream):
+        if stream:
+            return self._capture_stream(key, completion)
+        await self._record(key, completion.choices[0].message.content or "")
+        return completion
+
+    async def _record(self, key, content):
+        try:
+            await asyncio.to_thread(self.store.record_response, self.job_id, key, content)
+        except Exception as e:
+            logging.warning(f"Failed to journal upstream response for job {self.job_id}: {e}")
+
+    async def _capture_stream(self, key, completion):
+        # 只有完整读完的流才记录；中途断开的流重跑时需要重新请求
+        parts = []
+        async for chunk in completion:
+            if chunk.choices and chunk.choices[0].delta.content is not None:
+                parts.append(chunk.choices[0].delta.content)
+            yield chunk
+        await self._record(key, "".join(parts))
+
+async def _replay_stream(content):
+    delta = SimpleNamespace(content=content, role="assistant")
+    yield SimpleNamespace(choices=[SimpleNamespace(index=0, delta=delta, finish_reason="stop")])
+
+def job_handler(kind):
+    """
+    注册任务处理函数：async handler(payload) -> (响应体, HTTP 状态码)。
+    payload 必须可以 JSON 序列化；UpstreamBusyError 由调用方统一处理。
+    """
+    def decorator(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return decorator
+
+class JobQueueFull(Exception):
+    pass
+
+class AIJob:
+    def __init__(self, job_id, kind, payload):
+        self.id = job_id
+        self.kind = kind
+        self.payload = payload
+        self.status = "queued"  # queued / running / done / failed
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.http_status = None
+        self.attempts = 0
+        self.done_event = threading.Event()
+
+    def to_dict(self):
+        data = {
+            "success": True,
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "attempts": self.attempts,
+        }
+        if self.done_event.is_set():
+            data["http_status"] = self.http_status
+            data["result"] = self.result
+        return data
+
+class AIJobManager:
+    """
+    保存任务并在 AI 事件循环上执行，同时运行的任务数不超过 workers，排队的任务数不超过 max_pending。
+    提供 store 时任务持久化到磁盘，进程重启后调用 recover() 恢复。
+    """
+    def __init__(self, workers, max_pending, ttl_seconds, store=None):
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.ttl_seconds = ttl_seconds
+        self.store = store
+        self.recovered = 0
+        self.replayed_responses = 0
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._semaphore = None  # 在 AI 事件循环内创建
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _purge(self):
+        now = time.time()
+        for job_id in [k for k, job in self._jobs.items() if job.finished_at and now - job.finished_at > self.ttl_seconds]:
+            del self._jobs[job_id]
+
+    def _pending(self):
+        return sum(1 for job in self._jobs.values() if not job.done_event.is_set())
+
+    def submit(self, kind, payload):
+        if kind not in JOB_HANDLERS:
+            raise ValueError(f"unknown job kind: {kind}")
+        with self._lock:
+            self._purge()
+            if self._pending() >= self.max_pending:
+                self.rejected += 1
+                raise JobQueueFull("Too many pending jobs")
+            job = AIJob(uuid.uuid4().hex, kind, payload)
+            if self.store is not None:
+                self.store.insert(job)
+            self._jobs[job.id] = job
+            self.submitted += 1
+        asyncio.run_coroutine_threadsafe(self._run(job), _get_ai_loop())
+        return job
+
+    def recover(self):
+        """
+        从持久化存储恢复任务：已完成且未过期的任务恢复为可查询状态，未完成的任务重新排队
+        （已经尝试 AI_JOB_MAX_ATTEMPTS 次的任务标记为失败，避免反复导致崩溃的任务无限重跑）。
+        """
+        if self.store is None:
+            return
+        requeue = []
+        with self._lock:
+            for row in self.store.load_jobs(time.time() - self.ttl_seconds):
+                job_id, kind, payload, status, created_at, started_at, finished_at, result, http_status, attempts = row
+                if job_id in self._jobs:
+                    continue
+                job = AIJob(job_id, kind, json.loads(payload))
+                job.status, job.created_at, job.started_at, job.attempts = status, created_at, started_at, attempts
+                self._jobs[job_id] = job
+                if finished_at is not None:
+                    job.finished_at, job.result, job.http_status = finished_at, json.loads(result), http_status
+                    job.done_event.set()
+                else:
+                    job.status = "queued"
+                    requeue.append(job)
+        for job in requeue:
+            if job.kind not in JOB_HANDLERS:
+                # 重启后的版本里已经没有这种任务（被移除或改名）
+                self._finish(job, {"success": False, "message": f"Unknown job kind: {job.kind}"}, 500)
+                continue
+            if job.attempts >= AI_JOB_MAX_ATTEMPTS:
+                self._finish(job, {"success": False, "message": "Job was interrupted too many times"}, 500)
+                continue
+            self.recovered += 1
+            asyncio.run_coroutine_threadsafe(self._run(job), _get_ai_loop())
+        if requeue:
+            logging.info(f"Recovered {len(requeue)} unfinished AI jobs from {self.store.path}.")
+
+    async def _run(self, job):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        async with self._semaphore:
+            job.status = "running"
+            job.started_at = time.time()
+            job.attempts += 1
+            journal = None
+            if self.store is not None:
+                await asyncio.to_thread(self.store.mark_running, job)
+                responses = await asyncio.to_thread(self.store.load_responses, job.id)
+                journal = JobJournal(job.id, self.store, responses)
+            token = _current_job_journal.set(journal)
+            try:
+                result, http_status = await JOB_HANDLERS[job.kind](job.payload)
+            except UpstreamBusyError as e:
+                result = {"success": False, "message": str(e), "retry_after": e.retry_after}
+                http_status = e.status
+            except Exception as e:
+                logging.exception(f"Job {job.id} ({job.kind}) failed")
+                result, http_status = {"success": False, "message": str(e)}, 500
+            finally:
+                _current_job_journal.reset(token)
+            if journal is not None and journal.replayed:
+                self.replayed_responses += journal.replayed
+                print(f"任务 {job.id} 重放了 {journal.replayed} 个重启前已收到的上游响应。")
+            await asyncio.to_thread(self._finish, job, result, http_status)
+
+    def _finish(self, job, result, http_status):
+        with self._lock:
+            job.result = result
+            job.http_status = http_status
+            job.status = "done" if http_status < 400 else "failed"
+            job.finished_at = time.time()
+            if job.status == "done":
+                self.completed += 1
+            else:
+                self.failed += 1
+        if self.store is not None:
+            try:
+                self.store.finish(job)
+            except Exception as e:
+                logging.warning(f"Failed to persist result of job {job.id}: {e}")
+        job.done_event.set()
+
+    def get(self, job_id, wait=0):
+        """返回任务；wait > 0 时最多等待这么多秒直到任务结束（长轮询）。"""
+        with self._lock:
+            self._purge()
+            job = self._jobs.get(job_id)
+        if job is not None and wait > 0:
+            job.done_event.wait(min(wait, AI_JOB_MAX_WAIT_SECONDS))
+        return job
+
+    def cleanup(self):
+        with self._lock:
+            self._purge()
+        if self.store is not None:
+            self.store.purge(time.time() - self.ttl_seconds)
+
+    def stats(self):
+        with self._lock:
+            statuses = {}
+            for job in self._jobs.values():
+                statuses[job.status] = statuses.get(job.status, 0) + 1
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "ttl_seconds": self.ttl_seconds,
+                "jobs": statuses,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+                "persistent": self.store is not None,
+                "recovered": self.recovered,
+                "replayed_responses": self.replayed_responses,
+            }
+
+ai_jobs = AIJobManager(
+    AI_JOB_WORKERS, AI_JOB_MAX_PENDING, AI_JOB_RESULT_TTL_SECONDS,
+    store=JobStore(AI_JOB_STORE_PATH) if AI_JOB_STORE_ENABLED else None,
+)
+
+def _wants_job(req_data):
+    flag = request.args.get('async', '')
+    return str(flag).lower() in ('1', 'true') or req_data.get('async') is True
+
+async def _run_job_or_now(kind, payload, req_data):
+    """任务模式下提交任务并返回 202，否则直接执行并返回结果。"""
+    if _wants_job(req_data):
+        try:
+            job = ai_jobs.submit(kind, payload)
+        except JobQueueFull as e:
+            return jsonify({"success": False, "message": str(e)}), 429
+        return jsonify({"success": True, "job_id": job.id, "status": job.status, "status_url": f"/api/jobs/{job.id}"}), 202
+    try:
+        body, status = await run_on_ai_loop(JOB_HANDLERS[kind](payload))
+    except UpstreamBusyError as e:
+        return _busy_response(e)
+    return jsonify(body), status
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """查询任务状态；?wait=秒 时长轮询，任务结束或超时后返回。"""
+    try:
+        wait = float(request.args.get('wait', 0) or 0)
+    except ValueError:
+        wait = 0
+    job = ai_jobs.get(job_id, wait=wait)
+    if job is None:
+        return jsonify({"success": False, "message": "Job not found or expired"}), 404
+    return jsonify(job.to_dict())
 
 @app.route('/api/process-image', methods=['POST'])
 async def process_image():
@@ -544,12 +3170,74 @@ async def process_image():
     if not base64_images or not isinstance(base64_images, list) or len(base64_images) == 0:
         return jsonify({"success": False, "message": "没有提供图片数据"}), 400
 
+    return await _run_job_or_now("process-image", {"images": base64_images}, req_data)
+
+@job_handler("process-image")
+async def _process_image_job(payload):
     try:
-        result = await call_vision_model_with_correction(base64_images)
-        return jsonify(result)
+        return await call_vision_model_cached(payload["images"]), 200
+    except UpstreamBusyError:
+        raise
     except Exception as e:
         print(f"处理图片时发生严重错误：{e}")
-        return jsonify({"success": False, "message": str(e)}), 500
+        return {"success": False, "message": str(e)}, 500
+
+SSE_KEEPALIVE_SECONDS = 15
+
+def _format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/api/process-image/stream', methods=['POST'])
+def process_image_stream():
+    """
+    /api/process-image 的 SSE 版本：识别过程中实时推送进度事件和已解析出的课程。
+    事件: preprocessed, attempt_started, candidates_started, candidate_finished, candidate_failed, tokens, course,
+    attempt_failed, partial_recovered, conflicts_found, correction_started，最后以 result（与非流式接口的返回体相同）或 error 结束。
+    开启 AI_VISION_FANOUT_ENABLED 且上传多张图片时，各页的事件带有 page 字段。
+    """
+    if not ENABLE_IMAGE_PROCESSING:
+        return jsonify({"success": False, "message": "当前图片处理功能已经禁用，请前往env修改配置"}), 403
+
+    req_data = request.get_json()
+    base64_images = req_data.get('images')
+
+    if not base64_images or not isinstance(base64_images, list) or len(base64_images) == 0:
+        return jsonify({"success": False, "message": "没有提供图片数据"}), 400
+
+    events = queue.Queue()
+
+    def on_event(event, data):
+        events.put((event, data))
+
+    # 客户端断开后任务仍会跑完，结果写入缓存，重新上传即可直接命中
+    future = asyncio.run_coroutine_threadsafe(
+        call_vision_model_cached(base64_images, on_event=on_event), _get_ai_loop()
+    )
+    future.add_done_callback(lambda f: events.put(("_done", None)))
+
+    def generate():
+        while True:
+            try:
+                event, data = events.get(timeout=SSE_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if event != "_done":
+                yield _format_sse(event, data)
+                continue
+            try:
+                yield _format_sse("result", future.result())
+            except UpstreamBusyError as e:
+                yield _format_sse("error", {"success": False, "message": str(e), "status": e.status, "retry_after": e.retry_after})
+            except Exception as e:
+                print(f"处理图片时发生严重错误：{e}")
+                yield _format_sse("error", {"success": False, "message": str(e)})
+            return
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
 
 @app.route('/api/feature-flags', methods=['GET'])
 def feature_flags():
@@ -588,6 +3276,34 @@ def health_check():
     return jsonify({"status": "ok"}), 200
 
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """返回 AI 相关的运行指标（缓存命中率等）。"""
+    return jsonify({
+        "success": True,
+        "caches": {
+            "process_data": text_result_cache.stats(),
+            "process_image": image_result_cache.stats(),
+        },
+        "process_data_paths": dict(text_parse_paths),
+        "process_data_models": text_model_routing.stats(),
+        "image_preprocess": dict(image_preprocess_stats),
+        "assistant_sessions": assistant_sessions.stats(),
+        "assistant_context": dict(assistant_context_stats),
+        "jobs": ai_jobs.stats(),
+        "upstream_connections": upstream_connection_metrics(),
+        "upstream_router": upstream_router.stats(),
+        "upstream_limits": {
+            "text": text_limiter.stats(),
+            "vision": vision_limiter.stats(),
+            "assistant": assistant_limiter.stats(),
+        },
+        "coalescing": {
+            "process_data": text_singleflight.stats(),
+            "process_image": image_singleflight.stats(),
+        },
+    })
+
 @app.route('/api/process-data', methods=['POST'])
 async def process_data():
     """
@@ -605,16 +3321,20 @@ async def process_data():
         print("用户输入为空")
         return jsonify({"success": False, "message": "用户输入为空"}), 400
 
+    return await _run_job_or_now("process-data", {"userInput": user_input}, req_data)
+
+@job_handler("process-data")
+async def _process_data_job(payload):
     try:
         # 覆盖模式
         print("覆盖模式：忽略现有课程数据，准备解析新数据...")
         print("开始 AI 解析课程表...")
-        courses = await call_ai_model(user_input)
-        print("AI 解析课程表完成，返回课程数据：", courses)
-        return jsonify({"success": True, "courses": courses})
+        courses, source = await parse_courses_from_text(payload["userInput"])
+        print(f"解析课程表完成（{source}），返回课程数据：", courses)
+        return {"success": True, "courses": courses, "source": source}, 200
     except (ValueError, ConnectionError) as e:
         print(f"处理用户输入时发生错误：{e}")
-        return jsonify({"success": False, "message": str(e)}), 500
+        return {"success": False, "message": str(e)}, 500
 
 # --- AI Assistant (per-course operations, with optional timeConfig change) ---
 
@@ -768,7 +3488,7 @@ def _normalize_schedule(schedule):
     if not isinstance(schedule, dict):
         return None
     return {
-        "weeks": str(schedule.get("weeks", "")).strip(),
+        "weeks": normalize_weeks(str(schedule.get("weeks", "")).strip()),
         "day": str(schedule.get("day", "")).strip(),
         "time_slot": str(schedule.get("time_slot", "")).strip(),
         "campus": str(schedule.get("campus", "")).strip(),
@@ -789,7 +3509,7 @@ def _normalize_schedule_entries(schedule):
         return []
 
     base = {
-        "weeks": str(schedule.get("weeks", "")).strip(),
+        "weeks": normalize_weeks(str(schedule.get("weeks", "")).strip()),
         "time_slot": str(schedule.get("time_slot", "")).strip(),
         "campus": str(schedule.get("campus", "")).strip(),
         "building": str(schedule.get("building", "")).strip(),
@@ -910,6 +3630,201 @@ def _normalize_time_config(time_config):
         "time_slots": normalized_slots,
     }
 
+# --- 本地规则解析（process-data 快速路径） ---
+# 大部分粘贴内容来自少数几个教务系统，格式固定，例如 "1-16周, 周三, 3-4节"。
+# 本地解析器先尝试这些已知格式，只有置信度不足时才回退到 call_ai_model。
+
+LOCAL_PARSER_ENABLED = os.getenv('LOCAL_PARSER_ENABLED', 'true').lower() == 'true'
+# 置信度 = 成功解析的"类课程行"占全部类课程行的比例。默认要求全部解析成功，避免漏课。
+LOCAL_PARSER_MIN_CONFIDENCE = float(os.getenv('LOCAL_PARSER_MIN_CONFIDENCE', 1.0))
+
+LOCAL_COURSE_PARSERS = []
+
+def register_local_parser(func):
+    """
+    注册一个本地课程解析器。解析器接收原始文本，返回 (courses, confidence)，
+    无法处理时返回 None。
+    """
+    LOCAL_COURSE_PARSERS.append(func)
+    return func
+
+_LOCAL_WEEKS_RE = re.compile(
+    r'第?\s*(\d{1,2}(?:\s*[-~至到]\s*\d{1,2})?(?:\s*[,，、]\s*\d{1,2}(?:\s*[-~至到]\s*\d{1,2})?)*)\s*周'
+    r'(?:\s*[\(（]\s*([单双])\s*周?\s*[\)）]|\s*([单双])周?)?'
+)
+_LOCAL_SLOT_RE = re.compile(r'第?\s*(\d{1,2})\s*(?:[-~至到]\s*(\d{1,2})\s*)?节')
+_LOCAL_DAY_RE = re.compile(r'(?:星期|礼拜|周)\s*([一二三四五六日天七1-7])')
+_LOCAL_LABEL_RE = re.compile(
+    r'(课程代码|课程编号|课程号|代码|课程名称|课程名|名称|授课教师|任课教师|教师|老师|上课安排|上课时间|时间|上课地点|地点|教室)\s*[:：]\s*'
+)
+_LOCAL_SPLIT_RE = re.compile(r'[,，;；、\s]+')
+# "线性代数(MATH202)" 里的课程代码。只认至少 3 个字符且含数字的代码，"高等数学(A)"、"(上)" 之类的分班/分册标记留在名称里
+_LOCAL_CODE_IN_NAME_RE = re.compile(r'^(.+?)\s*[\(（]\s*((?=[A-Za-z0-9_.\-]*\d)[A-Za-z0-9][A-Za-z0-9_.\-]{2,})\s*[\)）]$')
+_LOCAL_ROOM_RE = re.compile(r'[A-Za-z]?\d+[A-Za-z]?室?')
+_LOCAL_TEACHER_RE = re.compile(r'^[一-龥·]{2,4}$')
+_LOCAL_LOCATION_HINTS = ('校区', '楼', '馆', '院', '中心', '堂', '室', '场')
+
+def _mask_spans(text, matches):
+    chars = list(text)
+    for m in matches:
+        for i in range(m.start(), m.end()):
+            chars[i] = ' '
+    return ''.join(chars)
+
+def _strip_local_token(token):
+    """去掉 token 两端的标点和不成对的括号（如被遮盖掉的 "(1-8周)" 留下的括号）。"""
+    token = token.strip('[]【】:：')
+    while token and token[0] in '(（' and not any(c in token for c in ')）'):
+        token = token[1:].strip()
+    while token and token[-1] in ')）' and not any(c in token for c in '(（'):
+        token = token[:-1].strip()
+    return token
+
+def _parse_course_line(line):
+    """
+    解析一行课程文本，返回 (is_course_like, course)。
+    一行中有多个星期时，节次/周数要么一一对应（按出现顺序），要么只有一个供所有星期共用。
+    """
+    week_matches = list(_LOCAL_WEEKS_RE.finditer(line))
+    masked = _mask_spans(line, week_matches)
+    slot_matches = list(_LOCAL_SLOT_RE.finditer(masked))
+    masked = _mask_spans(masked, slot_matches)
+    day_matches = list(_LOCAL_DAY_RE.finditer(masked))
+    masked = _mask_spans(masked, day_matches)
+
+    if not (week_matches or slot_matches or day_matches):
+        return False, None
+    if not (week_matches and slot_matches and day_matches):
+        return True, None
+
+    days = [_parse_day_token(m.group(1)) for m in day_matches]
+    if any(d is None for d in days):
+        return True, None
+    n = len(days)
+    if len(slot_matches) not in (1, n) or len(week_matches) not in (1, n):
+        return True, None
+
+    fields = {"code": "", "name": "", "teachers": [], "location": []}
+    label = None
+    residual = []
+    pos = 0
+    # 先按 "标签: 值" 切分，再把剩下的文本按分隔符切成 token
+    for m in _LOCAL_LABEL_RE.finditer(masked):
+        residual.append((label, masked[pos:m.start()]))
+        label = m.group(1)
+        pos = m.end()
+    residual.append((label, masked[pos:]))
+
+    plain_tokens = []
+    for label, text in residual:
+        tokens = [_strip_local_token(t) for t in _LOCAL_SPLIT_RE.split(text)]
+        tokens = [t for t in tokens if t]
+        if not tokens:
+            continue
+        if label in ('课程代码', '课程编号', '课程号', '代码'):
+            fields["code"] = tokens[0]
+            plain_tokens.extend(tokens[1:])
+        elif label in ('课程名称', '课程名', '名称'):
+            fields["name"] = tokens[0]
+            plain_tokens.extend(tokens[1:])
+        elif label in ('授课教师', '任课教师', '教师', '老师'):
+            fields["teachers"].append(tokens[0])
+            plain_tokens.extend(tokens[1:])
+        elif label in ('上课地点', '地点', '教室'):
+            fields["location"].extend(tokens)
+        else:
+            plain_tokens.extend(tokens)
+
+    for token in plain_tokens:
+        is_room = bool(_LOCAL_ROOM_RE.fullmatch(token))
+        if any(hint in token for hint in _LOCAL_LOCATION_HINTS) and not _LOCAL_CODE_IN_NAME_RE.match(token):
+            fields["location"].append(token)
+        elif not fields["name"] and not is_room:
+            fields["name"] = token
+        elif _LOCAL_TEACHER_RE.match(token):
+            fields["teachers"].append(token)
+        elif is_room:
+            fields["location"].append(token)
+        else:
+            return True, None  # 无法归类的内容，交给 AI
+
+    name = fields["name"]
+    code_match = _LOCAL_CODE_IN_NAME_RE.match(name)
+    if code_match:
+        name = code_match.group(1).strip()
+        fields["code"] = fields["code"] or code_match.group(2)
+    if not name:
+        return True, None
+
+    campus = building = classroom = ""
+    for token in fields["location"]:
+        if '校区' in token and not campus:
+            campus = token
+        elif _LOCAL_ROOM_RE.fullmatch(token) and not classroom:
+            classroom = token.rstrip('室')
+        elif not building:
+            building = token
+        else:
+            return True, None
+
+    schedules = []
+    for i, day in enumerate(days):
+        slot = slot_matches[i if len(slot_matches) == n else 0]
+        start_slot = int(slot.group(1))
+        end_slot = int(slot.group(2) or slot.group(1))
+        weeks_text = week_matches[i if len(week_matches) == n else 0].group(0)
+        weeks = compile_weeks(weeks_text)
+        if not weeks or exceeds_week_limit(weeks_text) or end_slot < start_slot:
+            return True, None
+        schedules.append({
+            "weeks": _format_week_set(weeks),
+            "day": str(day),
+            "time_slot": f"{start_slot}-{end_slot}",
+            "campus": campus,
+            "building": building,
+            "classroom": classroom,
+        })
+
+    return True, {"code": fields["code"], "name": name, "teachers": fields["teachers"], "schedules": schedules}
+
+@register_local_parser
+def parse_line_based_courses(text):
+    """每行一门课（或一门课的一个/多个上课安排）的常见教务系统导出格式。"""
+    course_like = 0
+    parsed = []
+    for line in str(text).splitlines():
+        line = unicodedata.normalize('NFKC', line).strip()
+        if not line:
+            continue
+        is_course_like, course = _parse_course_line(line)
+        if not is_course_like:
+            continue
+        course_like += 1
+        if course is not None:
+            parsed.append(course)
+    if not course_like or not parsed:
+        return None
+    return merge_course_lists(parsed), len(parsed) / course_like
+
+def parse_courses_locally(user_input):
+    """
+    依次尝试已注册的本地解析器，返回置信度最高的 (courses, confidence, parser_name)；
+    都无法处理时返回 None。
+    """
+    best = None
+    for parser in LOCAL_COURSE_PARSERS:
+        try:
+            result = parser(user_input)
+        except Exception as e:
+            logging.warning(f"Local parser {parser.__name__} failed: {e}")
+            continue
+        if result is None:
+            continue
+        courses, confidence = result
+        if courses and (best is None or confidence > best[1]):
+            best = (courses, confidence, parser.__name__)
+    return best
+
 def _build_ai_assistant_system_prompt():
     return """
 你是一个“课程表 AI 助手”，专门在现有课程表基础上，生成“逐课程”的修改建议。
@@ -985,44 +3900,191 @@ startDate (from user context):
 - 如果 alter 修改了 schedules：请输出“修改后的完整 schedules 列表”（包含未改动的项），避免把原有安排覆盖丢失。
 - 考试日程使用真实日期与 24 小时制时间，必须输出合法的 date/startTime/endTime。
 - 考试日程既可以独立（courseId=null），也可以关联课程（courseId=课程id）。
+- 如果提供了 otherCourses / otherExams：它们是与本次需求无关的课程/考试摘要（slots 为 "星期|节次|周数"），
+  只用于避免时间冲突和 id 重复，不要对它们生成 remove/alter。
 """
 
+# --- AI 助手上下文裁剪 ---
+# 未指定 targetCourseId 时，按 userInput 中出现的课程名称/代码/教师以及星期、节次挑出相关课程和考试，
+# 其余课程只发送 id、名称和上课时间的摘要；无法判断相关性时回退为完整上下文。
+
+AI_ASSISTANT_CONTEXT_PRUNING = os.getenv('AI_ASSISTANT_CONTEXT_PRUNING', 'true').lower() == 'true'
+AI_ASSISTANT_PRUNE_MIN_COURSES = int(os.getenv('AI_ASSISTANT_PRUNE_MIN_COURSES', 8))
+_ASSISTANT_GLOBAL_HINTS = ('所有', '全部', '每门', '整个', '都', '冲突', '重复')
+_ASSISTANT_EXAM_HINTS = ('考试', '期中', '期末', '测验', 'exam')
+_ASSISTANT_NAME_SUFFIX_RE = re.compile(r'[\(（【\[].*$')
+
+assistant_context_stats = {"requests": 0, "pruned": 0, "full_chars": 0, "sent_chars": 0}
+_assistant_context_lock = threading.Lock()
+
+def _assistant_terms(course):
+    """课程用于匹配的关键词：名称（含去掉括号后缀的简称）、代码和教师。"""
+    terms = []
+    name = str(course.get("name", "") or "").strip()
+    if name:
+        terms.append(name)
+        short = _ASSISTANT_NAME_SUFFIX_RE.sub('', name).strip()
+        if short and short != name:
+            terms.append(short)
+    code = str(course.get("code", "") or "").strip()
+    if code:
+        terms.append(code)
+    teachers = course.get("teachers", [])
+    if isinstance(teachers, list):
+        terms.extend(str(t).strip() for t in teachers if str(t or "").strip())
+    return [t.lower() for t in terms if len(t) >= 2]
+
+def _mentioned_slots(text):
+    """提取输入中提到的星期和节次：返回 (星期集合, 节次集合)。"""
+    days = set()
+    for match in _LOCAL_DAY_RE.finditer(text):
+        day = _parse_day_token(match.group(1))
+        if day is not None:
+            days.add(day)
+    sections = set()
+    for match in _LOCAL_SLOT_RE.finditer(text):
+        start = int(match.group(1))
+        end = int(match.group(2) or start)
+        if start <= end <= start + 12:
+            sections.update(range(start, end + 1))
+    return days, sections
+
+def _schedule_sections(schedule):
+    parts = str(schedule.get("time_slot", "")).split('-')
+    try:
+        start = int(parts[0])
+        end = int(parts[-1])
+    except ValueError:
+        return set()
+    return set(range(start, end + 1)) if start <= end else set()
+
+def _schedule_summary(schedule):
+    """把一条上课安排压缩为 "星期|节次|周数"。"""
+    return f"{schedule.get('day', '')}|{schedule.get('time_slot', '')}|{schedule.get('weeks', '')}"
+
+def _course_matches_slots(course, days, sections):
+    for schedule in course.get("schedules", []) or []:
+        if not isinstance(schedule, dict):
+            continue
+        if days and not (set(_expand_days(schedule.get("day"))) & days):
+            continue
+        if sections and not (_schedule_sections(schedule) & sections):
+            continue
+        return True
+    return False
+
+def select_assistant_context(courses, exams, user_input):
+    """
+    挑选与 userInput 相关的课程和考试。返回 (相关课程, 其余课程摘要, 相关考试, 其余考试摘要)，
+    无法可靠判断相关性（没有任何命中、涉及全部课程等）时返回 None，调用方应使用完整上下文。
+    """
+    text = unicodedata.normalize('NFKC', user_input or '').lower()
+    if not text or any(hint in text for hint in _ASSISTANT_GLOBAL_HINTS):
+        return None
+
+    days, sections = _mentioned_slots(text)
+    relevant, others = [], []
+    for course in courses:
+        if not isinstance(course, dict):
+            continue
+        named = any(term in text for term in _assistant_terms(course))
+        if named or ((days or sections) and _course_matches_slots(course, days, sections)):
+            relevant.append(course)
+        else:
+            others.append(course)
+    if not relevant and not (days or sections):
+        return None
+
+    relevant_ids = {_coerce_int(c.get("id")) for c in relevant}
+    mentions_exams = any(hint in text for hint in _ASSISTANT_EXAM_HINTS)
+    relevant_exams, other_exams = [], []
+    for exam in exams:
+        if not isinstance(exam, dict):
+            continue
+        title = str(exam.get("title", "") or "").strip().lower()
+        if mentions_exams and (
+            (title and title in text)
+            or _coerce_int(exam.get("courseId")) in relevant_ids
+            or not relevant
+        ):
+            relevant_exams.append(exam)
+        else:
+            other_exams.append(exam)
+
+    course_summary = [
+        {"id": c.get("id"), "name": c.get("name", ""),
+         "slots": [_schedule_summary(s) for s in c.get("schedules", []) or [] if isinstance(s, dict)]}
+        for c in others
+    ]
+    exam_summary = [
+        {"id": e.get("id"), "title": e.get("title", ""), "date": e.get("date", ""),
+         "time": f"{e.get('startTime', '')}-{e.get('endTime', '')}"}
+        for e in other_exams
+    ]
+    return relevant, course_summary, relevant_exams, exam_summary
+
+def _record_assistant_context(full_chars, sent_chars, pruned):
+    with _assistant_context_lock:
+        assistant_context_stats["requests"] += 1
+        assistant_context_stats["pruned"] += int(pruned)
+        assistant_context_stats["full_chars"] += full_chars
+        assistant_context_stats["sent_chars"] += sent_chars
+
 async def _call_ai_assistant(existing_courses, existing_exams, user_input, target_course_id, allow_time_config, time_config, start_date, images):
+    """返回 (模型输出的 JSON, 上下文大小报告)。"""
     system_prompt = _build_ai_assistant_system_prompt()
 
-    context_courses = existing_courses
-    if target_course_id is not None:
-        context_courses = [c for c in existing_courses if _coerce_int(c.get("id")) == target_course_id]
+    use_images = isinstance(images, list) and len(images) > 0
 
     user_context = {
         "targetCourseId": target_course_id,
         "allowTimeConfig": bool(allow_time_config),
-        "existingCourses": context_courses,
+        "existingCourses": existing_courses,
         "existingExams": existing_exams,
         "timeConfig": time_config if allow_time_config else None,
         "startDate": start_date,
         "userInput": user_input,
     }
-    user_text = json.dumps(user_context, ensure_ascii=False)
+    full_text = json.dumps(user_context, ensure_ascii=False)
+
+    selection = None
+    if target_course_id is not None:
+        user_context["existingCourses"] = [c for c in existing_courses if _coerce_int(c.get("id")) == target_course_id]
+    elif AI_ASSISTANT_CONTEXT_PRUNING and not use_images and len(existing_courses) >= AI_ASSISTANT_PRUNE_MIN_COURSES:
+        # 图片里可能提到任何课程，带图片时不裁剪
+        selection = select_assistant_context(existing_courses, existing_exams, user_input)
+    if selection is not None:
+        relevant_courses, other_courses, relevant_exams, other_exams = selection
+        user_context["existingCourses"] = relevant_courses
+        user_context["otherCourses"] = other_courses
+        user_context["existingExams"] = relevant_exams
+        user_context["otherExams"] = other_exams
+
+    user_text = full_text
+    if selection is not None or target_course_id is not None:
+        user_text = json.dumps(user_context, ensure_ascii=False)
     if len(user_text) > AI_ASSISTANT_MAX_CONTEXT_CHARS:
         raise ValueError("AI assistant context too large")
 
-    use_images = isinstance(images, list) and len(images) > 0
+    context_report = {
+        "fullChars": len(full_text),
+        "sentChars": len(user_text),
+        "pruned": selection is not None,
+        "relevantCourses": len(user_context["existingCourses"]),
+        "totalCourses": len(existing_courses),
+    }
+    _record_assistant_context(len(full_text), len(user_text), selection is not None)
+    print(f"AI 助手上下文：{context_report['fullChars']} -> {context_report['sentChars']} 字符"
+          f"（相关课程 {context_report['relevantCourses']}/{context_report['totalCourses']}）。")
     model = AI_MODEL
 
     if use_images:
-        content = []
-        for base64_image in images[:3]:
-            if not base64_image:
-                continue
-            if ',' in base64_image:
-                img_data = base64_image.split(',', 1)[1]
-            else:
-                img_data = base64_image
-            content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_data}"}})
+        image_urls, _ = await asyncio.to_thread(preprocess_images, [img for img in images[:3] if img])
+        content = [{"type": "image_url", "image_url": {"url": url}} for url in image_urls]
         content.append({"type": "text", "text": user_text})
 
-        completion = _safe_chat_completion(
+        completion = await _safe_chat_completion(
+            limiter=assistant_limiter,
             model=model,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -1031,7 +4093,8 @@ async def _call_ai_assistant(existing_courses, existing_exams, user_input, targe
             response_format={"type": "json_object"},
         )
     else:
-        completion = _safe_chat_completion(
+        completion = await _safe_chat_completion(
+            limiter=assistant_limiter,
             model=model,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -1042,13 +4105,13 @@ async def _call_ai_assistant(existing_courses, existing_exams, user_input, targe
 
     response_content = completion.choices[0].message.content
     try:
-        return json.loads(response_content)
+        return json.loads(response_content), context_report
     except Exception:
         cleaned = str(response_content).strip()
         cleaned = re.sub(r"^```json", "", cleaned, flags=re.IGNORECASE).strip()
         cleaned = re.sub(r"^```", "", cleaned, flags=re.IGNORECASE).strip()
         cleaned = re.sub(r"```$", "", cleaned, flags=re.IGNORECASE).strip()
-        return json.loads(cleaned)
+        return json.loads(cleaned), context_report
 
 def _normalize_assistant_result(raw, target_course_id, allow_time_config):
     if not isinstance(raw, dict):
@@ -1185,6 +4248,180 @@ def _normalize_assistant_result(raw, target_course_id, allow_time_config):
 
     return {"operations": normalized_ops, "examOperations": normalized_exam_ops, "timeConfigChange": time_config_change}
 
+# --- AI 助手会话 ---
+# 每次调用 AI 助手都要上传完整的课程与考试列表。会话在服务端保存最近一次的课程/考试状态，
+# 客户端之后只需上传相对于该状态的增量（按 id 新增/替换/删除），服务端据此还原完整上下文。
+#
+# 请求体中的 session 字段：
+#   {"id": 会话ID, "version": 上次返回的版本号,
+#    "courses": {"upsert": [...], "remove": [id, ...]}, "exams": {"upsert": [...], "remove": [id, ...]}}
+# 同时提供 existingCourses/existingExams 时以完整数据为准并覆盖会话状态。
+# 会话不存在、已过期或版本不一致时返回 409（code=session_resync），客户端应重新上传完整数据。
+
+AI_ASSISTANT_SESSIONS_ENABLED = os.getenv('AI_ASSISTANT_SESSIONS_ENABLED', 'true').lower() == 'true'
+AI_ASSISTANT_SESSION_TTL_SECONDS = int(os.getenv('AI_ASSISTANT_SESSION_TTL_SECONDS', 1800))
+AI_ASSISTANT_SESSION_MAX_ENTRIES = int(os.getenv('AI_ASSISTANT_SESSION_MAX_ENTRIES', 2000))
+AI_ASSISTANT_SESSION_MAX_MB = float(os.getenv('AI_ASSISTANT_SESSION_MAX_MB', 64))
+
+class AssistantSessionResync(Exception):
+    """会话状态无法用于还原上下文，客户端需要重新上传完整数据。"""
+
+def _context_version(courses, exams):
+    payload = json.dumps([courses, exams], ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+def _apply_id_delta(items, delta):
+    """按 id 把增量应用到列表上：upsert 中已有的 id 原位替换、新的 id 追加，remove 中的 id 删除。"""
+    if not delta:
+        return items
+    if not isinstance(delta, dict):
+        raise ValueError("Invalid session delta")
+    upsert = delta.get("upsert") or []
+    remove = delta.get("remove") or []
+    if not isinstance(upsert, list) or not isinstance(remove, list):
+        raise ValueError("Invalid session delta")
+
+    removed = {_coerce_int(v) for v in remove}
+    replacements = OrderedDict()
+    for item in upsert:
+        if not isinstance(item, dict) or _coerce_int(item.get("id")) is None:
+            raise ValueError("Session delta items must have an integer id")
+        replacements[_coerce_int(item["id"])] = item
+
+    result = []
+    for item in items:
+        item_id = _coerce_int(item.get("id"))
+        if item_id in removed:
+            continue
+        if item_id in replacements:
+            result.append(replacements.pop(item_id))
+        else:
+            result.append(item)
+    result.extend(replacements.values())
+    return result
+
+class AssistantSessionStore:
+    """
+    保存 AI 助手会话的课程/考试状态。按最近使用淘汰，受条目数、总字节数和 TTL 三重限制；
+    字节数按状态 JSON 的 UTF-8 编码长度加上冲突索引的估计内存（ConflictIndex.approximate_bytes）计算。
+    每个会话只保留最新状态，状态不可变，因此读出后无需拷贝。
+    每个会话还带有一个按课程 id 索引的 ConflictIndex（首次使用时建立），会话增量同步到索引上，
+    预览助手操作的冲突时只需检查被操作的课程。
+    """
+    def __init__(self, ttl_seconds, max_entries, max_bytes):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max_bytes
+        self._sessions = OrderedDict()  # id -> (expires_at, version, courses, exams, size, conflict_index)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.created = 0
+        self.delta_requests = 0
+        self.full_requests = 0
+        self.resyncs = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+
+    def _drop(self, session_id):
+        entry = self._sessions.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= entry[4]
+
+    def _evict(self):
+        now = time.time()
+        for session_id in [k for k, v in self._sessions.items() if v[0] <= now]:
+            self._drop(session_id)
+            self.evictions += 1
+        while self._sessions and (len(self._sessions) > self.max_entries or self._bytes > self.max_bytes):
+            self._drop(next(iter(self._sessions)))
+            self.evictions += 1
+
+    def _store(self, session_id, courses, exams, conflict_index=None):
+        size = len(json.dumps([courses, exams], ensure_ascii=False).encode("utf-8"))
+        if conflict_index is not None:
+            size += conflict_index.approximate_bytes()
+        version = _context_version(courses, exams)
+        self._drop(session_id)
+        self._sessions[session_id] = (time.time() + self.ttl_seconds, version, courses, exams, size, conflict_index)
+        self._bytes += size
+        self._evict()
+        return version
+
+    def resolve(self, session, full_courses, full_exams):
+        """
+        根据请求还原课程/考试上下文，返回 (session_id, version, courses, exams)。
+        full_courses/full_exams 为 None 表示客户端没有上传完整数据，只能使用会话状态加增量。
+        """
+        session = session if isinstance(session, dict) else {}
+        session_id = str(session.get("id") or "") or None
+        with self._lock:
+            if full_courses is not None or full_exams is not None:
+                self.full_requests += 1
+                if session_id is None or session_id not in self._sessions:
+                    session_id = uuid.uuid4().hex
+                    self.created += 1
+                courses = full_courses if full_courses is not None else []
+                exams = full_exams if full_exams is not None else []
+                return session_id, self._store(session_id, courses, exams), courses, exams
+
+            entry = self._sessions.get(session_id) if session_id else None
+            if entry is None or entry[0] <= time.time() or entry[1] != session.get("version"):
+                self.resyncs += 1
+                raise AssistantSessionResync("Assistant session expired or out of date")
+
+            courses = _apply_id_delta(entry[2], session.get("courses"))
+            exams = _apply_id_delta(entry[3], session.get("exams"))
+            conflict_index = entry[5]
+            payload_bytes = entry[4]
+            if conflict_index is not None:
+                payload_bytes -= conflict_index.approximate_bytes()
+                conflict_index.apply_id_delta(session.get("courses"))
+            self.delta_requests += 1
+            self.bytes_saved += max(0, payload_bytes - len(json.dumps(session, ensure_ascii=False).encode("utf-8")))
+            self._sessions.move_to_end(session_id)
+            return session_id, self._store(session_id, courses, exams, conflict_index), courses, exams
+
+    def preview_conflicts(self, session_id, version, operations):
+        """
+        用会话的冲突索引预览助手操作带来的冲突增量（见 ConflictIndex.preview）。
+        会话不存在或已更新到其他版本时返回 None。
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None or entry[1] != version:
+                return None
+            conflict_index = entry[5]
+            if conflict_index is None:
+                conflict_index = ConflictIndex(entry[2], key_field="id")
+                size = entry[4] + conflict_index.approximate_bytes()
+                self._sessions[session_id] = entry[:4] + (size, conflict_index)
+                self._bytes += size - entry[4]
+            deltas = conflict_index.preview(operations)
+            self._evict()
+            return deltas
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "created": self.created,
+                "full_requests": self.full_requests,
+                "delta_requests": self.delta_requests,
+                "resyncs": self.resyncs,
+                "evictions": self.evictions,
+                "bytes_saved": self.bytes_saved,
+            }
+
+assistant_sessions = AssistantSessionStore(
+    ttl_seconds=AI_ASSISTANT_SESSION_TTL_SECONDS,
+    max_entries=AI_ASSISTANT_SESSION_MAX_ENTRIES,
+    max_bytes=int(AI_ASSISTANT_SESSION_MAX_MB * 1024 * 1024),
+)
+
 @app.route('/api/ai-assistant', methods=['POST'])
 async def ai_assistant():
     req_data = request.get_json() or {}
@@ -1204,11 +4441,23 @@ async def ai_assistant():
         if total_image_chars > AI_ASSISTANT_MAX_IMAGE_CHARS:
             return jsonify({"success": False, "message": "Images are too large"}), 413
 
-    existing_courses = req_data.get("existingCourses", [])
+    existing_courses = req_data.get("existingCourses")
+    existing_exams = req_data.get("existingExams")
+    session = req_data.get("session")
+    session_info = None
+    if AI_ASSISTANT_SESSIONS_ENABLED and isinstance(session, dict):
+        full_courses = existing_courses if isinstance(existing_courses, list) else None
+        full_exams = existing_exams if isinstance(existing_exams, list) else None
+        try:
+            session_id, version, existing_courses, existing_exams = assistant_sessions.resolve(session, full_courses, full_exams)
+        except AssistantSessionResync as e:
+            return jsonify({"success": False, "code": "session_resync", "message": str(e)}), 409
+        except ValueError as e:
+            return jsonify({"success": False, "message": str(e)}), 400
+        session_info = {"id": session_id, "version": version}
+
     if not isinstance(existing_courses, list):
         existing_courses = []
-
-    existing_exams = req_data.get("existingExams", [])
     if not isinstance(existing_exams, list):
         existing_exams = []
 
@@ -1221,30 +4470,67 @@ async def ai_assistant():
     if start_date is not None:
         start_date = str(start_date).strip() or None
 
+    payload = {
+        "existing_courses": existing_courses,
+        "existing_exams": existing_exams,
+        "user_input": user_input,
+        "target_course_id": target_course_id,
+        "allow_time_config": allow_time_config,
+        "time_config": time_config,
+        "start_date": start_date,
+        "images": images,
+        "session": session_info,
+    }
+    return await _run_job_or_now("ai-assistant", payload, req_data)
+
+def _annotate_conflict_deltas(operations, existing_courses, session):
+    """
+    为每个助手操作附上 conflictDelta：该操作单独应用到当前课表时新增/消除的冲突（{"added": [...], "resolved": [...]}，
+    course 为课程 id，新增课程为 "new-<操作下标>"），编辑页在预览中逐项展示。
+    有会话时复用会话的冲突索引，否则按本次请求的课程临时建立。
+    """
+    if not operations:
+        return
+    deltas = None
+    if session is not None:
+        deltas = assistant_sessions.preview_conflicts(session["id"], session["version"], operations)
+    if deltas is None:
+        deltas = ConflictIndex(existing_courses, key_field="id").preview(operations)
+    for op, delta in zip(operations, deltas):
+        op["conflictDelta"] = delta
+
+@job_handler("ai-assistant")
+async def _ai_assistant_job(payload):
     try:
-        raw_result = await _call_ai_assistant(
-            existing_courses=existing_courses,
-            existing_exams=existing_exams,
-            user_input=user_input,
-            target_course_id=target_course_id,
-            allow_time_config=allow_time_config,
-            time_config=time_config,
-            start_date=start_date,
-            images=images,
+        raw_result, context_report = await _call_ai_assistant(
+            existing_courses=payload["existing_courses"],
+            existing_exams=payload["existing_exams"],
+            user_input=payload["user_input"],
+            target_course_id=payload["target_course_id"],
+            allow_time_config=payload["allow_time_config"],
+            time_config=payload["time_config"],
+            start_date=payload["start_date"],
+            images=payload["images"],
         )
         normalized = _normalize_assistant_result(
             raw=raw_result,
-            target_course_id=target_course_id,
-            allow_time_config=allow_time_config,
+            target_course_id=payload["target_course_id"],
+            allow_time_config=payload["allow_time_config"],
         )
-        return jsonify({"success": True, **normalized})
-
+        _annotate_conflict_deltas(normalized["operations"], payload["existing_courses"], payload["session"])
+        response = {"success": True, **normalized, "contextSize": context_report}
+        if payload["session"] is not None:
+            response["session"] = payload["session"]
+        return response, 200
+
+    except UpstreamBusyError:
+        raise
     except ValueError as e:
         logging.warning(f"AI assistant rejected input: {e}")
-        return jsonify({"success": False, "message": str(e)}), 400
+        return {"success": False, "message": str(e)}, 400
     except Exception as e:
         logging.exception("AI assistant failed")
-        return jsonify({"success": False, "message": f"AI assistant failed: {str(e)}"}), 500
+        return {"success": False, "message": f"AI assistant failed: {str(e)}"}, 500
 
 @app.route('/sw.js')
 def service_worker():
@@ -1325,6 +4611,207 @@ def serve_static(path):
     # 对于非核心文件，正常提供
     return send_from_directory(app.static_folder, path)
 
+# --- 批量冲突校验（向量化位集） ---
+# 管理端巡检所有分享课表、按群体统计课表负载时，一次要处理成百上千份课表。安装了 NumPy 时，
+# validate_timetables_bulk 把一批课表的 (课程, 星期) 占用打包成 64 位字的矩阵，用向量化的位运算
+# 一次算出每份课表的冲突单元格数、总课时和空闲节次；未安装 NumPy 时逐份用位集计算，结果相同。
+# 单个请求的冲突检测仍然走 detect_backend_conflicts。
+
+BULK_VALIDATION_NUMPY = os.getenv('BULK_VALIDATION_NUMPY', 'true').lower() == 'true'
+BULK_VALIDATION_CHUNK = int(os.getenv('BULK_VALIDATION_CHUNK', 512))  # 每个张量包含的课表数，限制内存占用
+
+def _bulk_entries(timetables):
+    """
+    展开一批课表中可参与冲突检测的上课安排。
+    返回 (entries, max_week, max_slot)，entries 按课表顺序排列，元素为
+    (timetable_index, group, day, start_slot, end_slot, weeks)。group 按 (课表, 课程名称) 顺序编号：
+    同名课程之间不算冲突，同一课表的 group 编号是连续的。
+    """
+    entries = []
+    groups = {}
+    max_week = max_slot = 0
+    for t, courses in enumerate(timetables):
+        for _, course_name, _, weeks_str, day, start_slot, end_slot in _iter_schedule_entries(courses):
+            weeks = compile_weeks(weeks_str)
+            if not weeks:
+                continue
+            key = (t, str(course_name))
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = len(groups)
+            entries.append((t, group, day, start_slot, end_slot, weeks))
+            if weeks.mask >> (max_week + 1):
+                max_week = weeks.intervals[-1][1]
+            if end_slot > max_slot:
+                max_slot = end_slot
+    return entries, max_week, max_slot
+
+def _popcount(value):
+    return bin(value).count("1")
+
+def _empty_validation(slots_per_day):
+    return {"has_conflict": False, "conflict_cells": 0, "load": 0, "free_slots": 7 * slots_per_day}
+
+def _validate_timetable_scalar(entries, slots_per_day):
+    """单份课表的位集实现，entries 来自 _bulk_entries，返回与 _validate_chunk_numpy 相同的统计。"""
+    stride = max(16, max((entry[4] for entry in entries), default=0) + 1)
+    by_day = {}
+    for _, group, day, start_slot, end_slot, weeks in entries:
+        cells = _week_cells(weeks, stride) * (((1 << (end_slot - start_slot + 1)) - 1) << start_slot)
+        day_groups = by_day.setdefault(day, {})
+        day_groups[group] = day_groups.get(group, 0) | cells
+
+    result = _empty_validation(slots_per_day)
+    for day, day_groups in by_day.items():
+        seen = multi = 0
+        for cells in day_groups.values():
+            multi |= seen & cells
+            seen |= cells
+        result["load"] += _popcount(seen)
+        result["conflict_cells"] += _popcount(multi)
+        if 1 <= day <= 7:
+            used_slots = 0
+            while seen:  # 把各周的节次位段折叠到一起
+                used_slots |= seen & ((1 << stride) - 1)
+                seen >>= stride
+            result["free_slots"] -= _popcount(used_slots & (((1 << slots_per_day) - 1) << 1))
+    result["has_conflict"] = result["conflict_cells"] > 0
+    return result
+
+def _popcount_u64(values):
+    if hasattr(np, "bitwise_count"):  # NumPy >= 2.0
+        return np.bitwise_count(values).astype(np.int64)
+    return np.unpackbits(values.view(np.uint8), axis=-1).reshape(values.shape + (64,)).sum(axis=-1, dtype=np.int64)
+
+def _validate_chunk_numpy(entries, first_timetable, count, slots_per_day):
+    """
+    entries 是课表 first_timetable .. first_timetable + count - 1 的安排。
+    与 _validate_timetable_scalar 相同的位集布局：每门课程每个星期的占用压成若干个 64 位字
+    （每周占 stride 位，按周依次排列），按 (课表, 星期) 分段后向量化计算段内的并集
+    （被占用的单元格）和每门课程与排在它之前的课程之并的交集（冲突的单元格）。
+    """
+    if not entries:
+        return [_empty_validation(slots_per_day) for _ in range(count)]
+    max_slot = max(entry[4] for entry in entries)
+    if max_slot >= 64:  # 一周的节次放不进一个 64 位字，逐份用位集计算
+        by_timetable = {}
+        for entry in entries:
+            by_timetable.setdefault(entry[0], []).append(entry)
+        return [_validate_timetable_scalar(by_timetable.get(t, []), slots_per_day)
+                for t in range(first_timetable, first_timetable + count)]
+
+    days_axis = sorted({entry[2] for entry in entries} | set(range(1, 8)))
+    day_index = {day: i for i, day in enumerate(days_axis)}
+    D = len(days_axis)
+    stride = 16 if max_slot < 16 else 32 if max_slot < 32 else 64
+    lanes = 64 // stride  # 每个字容纳的周数
+    max_week = max(entry[5].intervals[-1][1] for entry in entries)
+    K = max_week // lanes + 1  # 每行的字数
+
+    columns = np.array([(t, group, day_index[day], start_slot, end_slot) for t, group, day, start_slot, end_slot, _ in entries],
+                       dtype=np.int64)
+    timetable_of, group_of, day_of, start_of, end_of = columns.T
+    slot_masks = ((np.uint64(1) << (end_of - start_of + 1).astype(np.uint64)) - np.uint64(1)) << start_of.astype(np.uint64)
+
+    # 周位集按 64 位分段展开成 (安排, 周) 的 0/1 矩阵，再把每周的节次掩码放到对应的位段
+    words = (K * lanes - 1 >> 6) + 1
+    if words == 1:
+        masks = np.fromiter((entry[5].mask for entry in entries), dtype=np.uint64, count=len(entries)).reshape(-1, 1)
+    else:
+        word_mask = (1 << 64) - 1
+        masks = np.array([[entry[5].mask >> (64 * k) & word_mask for k in range(words)] for entry in entries], dtype=np.uint64)
+    week_bits = ((masks[:, :, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)).reshape(len(entries), words * 64)
+    lane_shift = np.uint64(stride) * np.arange(lanes, dtype=np.uint64)
+    cells = (week_bits[:, :K * lanes].reshape(-1, K, lanes) * (slot_masks[:, None, None] << lane_shift)).sum(axis=2, dtype=np.uint64)
+
+    # 按 (课表, 星期, 课程) 排序，同一课程在同一天的多条安排先合并
+    segment_key = timetable_of - first_timetable
+    segment_key = segment_key * D + day_of
+    order = np.lexsort((group_of, segment_key))
+    segment_key, group_of, cells = segment_key[order], group_of[order], cells[order]
+    merged = np.flatnonzero(np.r_[True, (segment_key[1:] != segment_key[:-1]) | (group_of[1:] != group_of[:-1])])
+    cells = np.bitwise_or.reduceat(cells, merged, axis=0)
+    segment_key = segment_key[merged]
+
+    # 段内前缀并集（倍增计算），earlier 是排在当前课程之前的课程占用的单元格
+    segment_starts = np.flatnonzero(np.r_[True, segment_key[1:] != segment_key[:-1]])
+    position = np.arange(len(segment_key)) - np.repeat(segment_starts, np.diff(np.r_[segment_starts, len(segment_key)]))
+    prefix = cells
+    step = 1
+    while step <= position.max():
+        shifted = np.zeros_like(prefix)
+        shifted[step:] = prefix[:-step]
+        prefix = np.where((position >= step)[:, None], prefix | shifted, prefix)
+        step *= 2
+    earlier = np.zeros_like(prefix)
+    earlier[1:] = np.where((position[1:] > 0)[:, None], prefix[:-1], np.uint64(0))
+
+    used = np.bitwise_or.reduceat(cells, segment_starts, axis=0)
+    multi = np.bitwise_or.reduceat(cells & earlier, segment_starts, axis=0)
+    segment_key = segment_key[segment_starts]
+    segment_timetable, segment_day = segment_key // D, segment_key % D
+    load = np.bincount(segment_timetable, weights=_popcount_u64(used).sum(axis=1), minlength=count).astype(np.int64)
+    conflict_cells = np.bincount(segment_timetable, weights=_popcount_u64(multi).sum(axis=1), minlength=count).astype(np.int64)
+
+    # 把各周的位段折叠到一起，统计周一到周日第 1..slots_per_day 节中被占用过的节次
+    folded = np.bitwise_or.reduce(used, axis=1)
+    lane_mask = np.uint64((1 << stride) - 1)
+    used_slots = np.bitwise_or.reduce((folded[:, None] >> lane_shift) & lane_mask, axis=1)
+    window = np.uint64((((1 << slots_per_day) - 1) << 1) & ((1 << stride) - 1))
+    weekday = np.isin(segment_day, [day_index[day] for day in range(1, 8)])
+    occupied_slots = np.bincount(segment_timetable, weights=_popcount_u64(used_slots & window) * weekday, minlength=count)
+
+    return [
+        {"has_conflict": bool(conflict_cells[i]), "conflict_cells": int(conflict_cells[i]),
+         "load": int(load[i]), "free_slots": 7 * slots_per_day - int(occupied_slots[i])}
+        for i in range(count)
+    ]
+
+def validate_timetables_bulk(timetables, slots_per_day=None, use_numpy=None):
+    """
+    批量校验课表。timetables 是课程列表的列表，返回与之一一对应的统计:
+        {"has_conflict": bool, "conflict_cells": 被两门及以上课程占用的 (周, 星期, 节次) 数,
+         "load": 被占用的 (周, 星期, 节次) 数, "free_slots": 周一到周日、第 1..slots_per_day 节中所有周都没课的节次数}
+    slots_per_day 默认取整批课表中最大的节次，使各课表的空闲节次可以比较。
+    冲突的具体位置请对有冲突的课表调用 find_backend_conflicts。
+    """
+    if use_numpy is None:
+        use_numpy = BULK_VALIDATION_NUMPY
+    entries, _, max_slot = _bulk_entries(timetables)
+    if slots_per_day is None:
+        slots_per_day = max_slot
+
+    if not (use_numpy and np is not None):
+        by_timetable = {}
+        for entry in entries:
+            by_timetable.setdefault(entry[0], []).append(entry)
+        return [_validate_timetable_scalar(by_timetable.get(t, []), slots_per_day) for t in range(len(timetables))]
+
+    results = []
+    chunk = max(1, BULK_VALIDATION_CHUNK)
+    position = 0
+    for first in range(0, len(timetables), chunk):
+        end = position
+        while end < len(entries) and entries[end][0] < first + chunk:
+            end += 1
+        count = min(chunk, len(timetables) - first)
+        results.extend(_validate_chunk_numpy(entries[position:end], first, count, slots_per_day))
+        position = end
+    return results
+
+def load_shared_timetables():
+    """读取所有分享文件，返回 [(filename, courses), ...]；损坏的文件被跳过。"""
+    timetables = []
+    for file_path in sorted(glob.glob(os.path.join(SHARE_CONFIG_DIR, "*.json"))):
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            continue
+        courses = data.get("courses", []) if isinstance(data, dict) else data
+        timetables.append((os.path.basename(file_path), courses if isinstance(courses, list) else []))
+    return timetables
+
 # --- 分享功能 ---
 
 def generate_share_code():
@@ -1494,6 +4981,8 @@ if __name__ == '__main__':
         scheduler = BackgroundScheduler(timezone="Asia/Shanghai")
         # For testing purposes, let's run it more frequently. In production, this can be hours=1.
         scheduler.add_job(func=cleanup_expired_files, trigger="interval", minutes=1)
+        scheduler.add_job(func=ai_jobs.cleanup, trigger="interval", minutes=1, id="ai_job_cleanup")
+        ai_jobs.recover()
         scheduler.add_job(
             func=write_heartbeat,
             trigger="interval",
@@ -1503,8 +4992,20 @@ if __name__ == '__main__':
             coalesce=True,
             misfire_grace_time=30
         )
+        if AI_KEEPWARM_INTERVAL_SECONDS > 0 and AI_PREWARM_CONNECTIONS > 0:
+            scheduler.add_job(
+                func=keep_upstream_warm,
+                trigger="interval",
+                seconds=max(5, AI_KEEPWARM_INTERVAL_SECONDS),
+                id="upstream_keepwarm",
+                max_instances=1,
+                coalesce=True,
+                misfire_grace_time=30
+            )
         scheduler.start()
         logging.info("Started background task for cleaning up expired share files (runs every 1 minute).")
+        # 启动时预热上游连接，不阻塞服务启动
+        threading.Thread(target=keep_upstream_warm, name="upstream-prewarm", daemon=True).start()
         # It's good practice to shut down the scheduler cleanly on exit
         atexit.register(lambda: scheduler.shutdown())
 
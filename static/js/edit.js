@@ -12,7 +12,8 @@ const aiAssistantState = {
     examProposals: [],
     timeConfigChange: null, // { timeConfig, reason, keep }
     imagesEnabled: false,
-    selectedImages: [] // [{ name, dataUrl }]
+    selectedImages: [], // [{ name, dataUrl }]
+    session: null // { id, version, courses: Map<id, json>, exams: Map<id, json> }，服务端会话保存的上下文快照
 };
 
 document.addEventListener('DOMContentLoaded', function() {
@@ -1041,6 +1042,70 @@ function renderAIAssistantImageThumbs() {
     });
 }
 
+function snapshotById(items) {
+    const snapshot = new Map();
+    (items || []).forEach(item => snapshot.set(item.id, JSON.stringify(item)));
+    return snapshot;
+}
+
+function diffAgainstSnapshot(snapshot, items) {
+    const upsert = [];
+    const seen = new Set();
+    (items || []).forEach(item => {
+        seen.add(item.id);
+        if (snapshot.get(item.id) !== JSON.stringify(item)) upsert.push(item);
+    });
+    const remove = [...snapshot.keys()].filter(id => !seen.has(id));
+    return { upsert, remove };
+}
+
+// 有服务端会话时只上传相对会话快照的增量，否则上传完整的课程/考试列表
+function buildAIAssistantContext(forceFull) {
+    const session = aiAssistantState.session;
+    if (!session || forceFull) {
+        return { existingCourses: coursesInMemory, existingExams: examsInMemory, session: session ? { id: session.id } : {} };
+    }
+    return {
+        session: {
+            id: session.id,
+            version: session.version,
+            courses: diffAgainstSnapshot(session.courses, coursesInMemory),
+            exams: diffAgainstSnapshot(session.exams, examsInMemory)
+        }
+    };
+}
+
+async function postAIAssistant(basePayload) {
+    let forceFull = false;
+    for (;;) {
+        const courses = snapshotById(coursesInMemory);
+        const exams = snapshotById(examsInMemory);
+        const response = await fetch('/api/ai-assistant', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ ...basePayload, ...buildAIAssistantContext(forceFull) })
+        });
+
+        let result;
+        try {
+            result = await response.json();
+        } catch (e) {
+            throw new Error('服务返回格式错误');
+        }
+
+        // 会话过期或不同步：重新上传完整数据
+        if (response.status === 409 && result?.code === 'session_resync' && !forceFull) {
+            aiAssistantState.session = null;
+            forceFull = true;
+            continue;
+        }
+        if (result?.session) {
+            aiAssistantState.session = { id: result.session.id, version: result.session.version, courses, exams };
+        }
+        return { response, result };
+    }
+}
+
 async function generateAIAssistantSuggestions() {
     const input = document.getElementById('ai-assistant-input');
     const allowTc = document.getElementById('ai-assistant-allow-timeconfig');
@@ -1061,8 +1126,6 @@ async function generateAIAssistantSuggestions() {
 
     const payload = {
         userInput,
-        existingCourses: coursesInMemory,
-        existingExams: examsInMemory,
         targetCourseId: Number.isFinite(targetCourseId) ? targetCourseId : null,
         allowTimeConfig,
         timeConfig: allowTimeConfig ? getTimeConfig() : null,
@@ -1077,18 +1140,7 @@ async function generateAIAssistantSuggestions() {
         }
         setAIAssistantStatus('正在生成建议，请稍候...', 'info');
 
-        const response = await fetch('/api/ai-assistant', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(payload)
-        });
-
-        let result;
-        try {
-            result = await response.json();
-        } catch (e) {
-            throw new Error('服务返回格式错误');
-        }
+        const { response, result } = await postAIAssistant(payload);
 
         if (!response.ok || !result?.success) {
             throw new Error(result?.message || `请求失败 (HTTP ${response.status})`);
@@ -1101,6 +1153,8 @@ async function generateAIAssistantSuggestions() {
             course: op.course,
             changes: op.changes,
             reason: op.reason || '',
+            index: idx,
+            conflictDelta: op.conflictDelta || null,
             keep: true
         }));
 
@@ -1212,6 +1266,7 @@ function renderAIAssistantResults() {
                             <div class="text-sm font-semibold">${escapeHtml(getProposalTitle(p, beforeCourse, afterCourse))}</div>
                         </div>
                         ${p.reason ? `<div class="text-xs text-gray-500 dark:text-gray-400 mt-1">${escapeHtml(p.reason)}</div>` : ''}
+                        ${renderConflictDelta(p)}
                     </div>
                     <label class="flex items-center gap-2 text-sm shrink-0">
                         <input type="checkbox" class="h-4 w-4 accent-indigo-600" data-ai-op-key="${escapeHtml(p.key)}" ${keep ? 'checked' : ''}>
@@ -1353,6 +1408,22 @@ function getProposalTitle(proposal, beforeCourse, afterCourse) {
     return beforeCourse?.name || afterCourse?.name || `修改课程 #${proposal.id}`;
 }
 
+// 服务器给出的 conflictDelta 是该操作单独应用到当前课表时新增/消除的冲突，与其他操作是否保留无关
+function renderConflictDelta(proposal) {
+    const delta = proposal.conflictDelta;
+    if (!delta) return '';
+    const selfKey = proposal.operation === 'add' ? `new-${proposal.index}` : proposal.id;
+    const describe = (conflict) => {
+        const other = conflict.entries?.[0]?.course === selfKey ? 1 : 0;
+        return `与「${escapeHtml(conflict.courses?.[other] ?? '')}」 第${escapeHtml(conflict.weeks)}周 星期${escapeHtml(String(conflict.day))} 第${escapeHtml(conflict.slots)}节`;
+    };
+    const lines = [
+        ...(delta.added || []).map(c => `<div class="text-xs text-red-600 dark:text-red-300">单独应用时新增冲突：${describe(c)}</div>`),
+        ...(delta.resolved || []).map(c => `<div class="text-xs text-green-700 dark:text-green-300">单独应用时消除冲突：${describe(c)}</div>`)
+    ];
+    return lines.length ? `<div class="mt-1 space-y-0.5">${lines.join('')}</div>` : '';
+}
+
 function buildAfterExamForPreview(proposal, beforeExam) {
     if (proposal.operation === 'add') {
         const draft = deepClone(proposal.exam || {});
@@ -0,0 +1,29 @@
+"""tools/ 下脚本共用的辅助函数。"""
+import atexit
+import os
+import sys
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TOOLS_DIR)
+
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+
+def import_app(base_url=None, **env):
+    """
+    以基准测试模式导入 app 模块。
+    会补齐必需的环境变量，并注销 app 的退出清理钩子，避免删除正在运行的主应用的
+    process_info.json。
+    """
+    if base_url:
+        os.environ["AI_BASE_URL"] = base_url
+    os.environ.setdefault("AI_MODEL", "mock-model")
+    os.environ.setdefault("DASHSCOPE_API_KEY", "mock")
+    for key, value in env.items():
+        os.environ[key] = str(value)
+
+    import app
+
+    atexit.unregister(app.remove_pid_file)
+    return app
@@ -0,0 +1,81 @@
+"""
+基准测试：同步上游客户端 vs. 异步上游客户端的并发吞吐量。
+
+使用本地模拟 AI 服务（tools/mock_ai_server.py），不需要真实的 DashScope 密钥。
+
+- before: 旧实现的方式，同步 OpenAI 客户端，每个进行中的请求占用一个工作线程
+  （线程池大小模拟 WSGI 服务器的工作线程数）。
+- after:  app.call_ai_model 在共享的 AI 事件循环上运行，所有请求同时挂起等待。
+
+用法:
+    python tools/bench_async_upstream.py --requests 200 --workers 16 --latency 0.5
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _common import import_app  # noqa: E402
+from mock_ai_server import start_mock_server  # noqa: E402
+
+SAMPLE_INPUT = "课程代码: CS101, 课程名称: 计算机科学导论, 教师: 张三, 上课安排: 1-16周, 周三, 3-4节"
+
+
+def bench_sync(base_url, total, workers):
+    from openai import OpenAI
+
+    client = OpenAI(api_key="mock", base_url=base_url, timeout=90)
+
+    def one_call(_):
+        client.chat.completions.create(
+            model="mock-model",
+            messages=[{"role": "user", "content": SAMPLE_INPUT}],
+        )
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(one_call, range(total)))
+    return time.perf_counter() - started
+
+
+def bench_async(base_url, total):
+    # 放开文本接口的并发限制（text_limiter），测的是共享事件循环本身能同时挂起多少请求
+    app = import_app(base_url, AI_TEXT_MAX_CONCURRENCY=total, AI_TEXT_MAX_QUEUE=total)
+
+    async def run_all():
+        await asyncio.gather(*[app.run_on_ai_loop(app.call_ai_model(SAMPLE_INPUT)) for _ in range(total)])
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(run_all())
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=16, help="worker threads for the synchronous baseline")
+    parser.add_argument("--latency", type=float, default=0.5, help="mock upstream latency in seconds")
+    args = parser.parse_args()
+
+    server, base_url = start_mock_server(latency=args.latency)
+
+    try:
+        sync_elapsed = bench_sync(base_url, args.requests, args.workers)
+        async_elapsed = bench_async(base_url, args.requests)
+    finally:
+        server.shutdown()
+
+    print(f"requests={args.requests} upstream_latency={args.latency}s sync_workers={args.workers}")
+    print(f"before (sync client, thread per request): {sync_elapsed:7.2f}s  {args.requests / sync_elapsed:8.1f} req/s")
+    print(f"after  (async client, shared AI loop):    {async_elapsed:7.2f}s  {args.requests / async_elapsed:8.1f} req/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+基准测试：批量校验大量课表。
+
+- per-request: 对每份课表调用 app.detect_backend_conflicts（单个请求走的标量路径）。
+- scalar bulk: app.validate_timetables_bulk(use_numpy=False)，逐份用位集统计冲突、课时和空闲节次。
+- numpy bulk:  app.validate_timetables_bulk(use_numpy=True)，整批打包成 (课程, 星期) 的 64 位字矩阵后向量化位运算。
+
+先校验两种批量实现的统计完全一致、且冲突判定与 find_backend_conflicts 一致，再计时。需要安装 NumPy。
+
+用法:
+    python tools/bench_bulk_validation.py --timetables 5000 --courses 30
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _common import import_app  # noqa: E402
+from bench_conflicts import random_timetable  # noqa: E402
+
+
+def timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--timetables", type=int, default=5000)
+    parser.add_argument("--courses", type=int, default=30)
+    parser.add_argument("--weeks", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        app = import_app()
+    if app.np is None:
+        raise SystemExit("NumPy is not installed")
+
+    rng = random.Random(args.seed)
+    # 课程数在 1..courses 之间变化，覆盖空课表和无冲突课表
+    timetables = [random_timetable(rng, rng.randint(1, args.courses), args.weeks) for _ in range(args.timetables)]
+
+    _, per_request = timed(lambda: [app.detect_backend_conflicts(courses) for courses in timetables])
+    scalar, scalar_elapsed = timed(lambda: app.validate_timetables_bulk(timetables, use_numpy=False))
+    vectorized, numpy_elapsed = timed(lambda: app.validate_timetables_bulk(timetables, use_numpy=True))
+
+    if scalar != vectorized:
+        mismatch = next(i for i, (a, b) in enumerate(zip(scalar, vectorized)) if a != b)
+        raise SystemExit(f"timetable {mismatch}: scalar {scalar[mismatch]} != numpy {vectorized[mismatch]}")
+    for i, courses in enumerate(timetables):
+        if vectorized[i]["has_conflict"] != bool(app.find_backend_conflicts(courses)):
+            raise SystemExit(f"timetable {i}: has_conflict disagrees with find_backend_conflicts")
+
+    conflicted = sum(1 for result in vectorized if result["has_conflict"])
+    print(f"timetables={args.timetables} courses<= {args.courses} weeks={args.weeks}: "
+          f"{conflicted} with conflicts, numpy and scalar statistics identical")
+    print(f"per-request detect_backend_conflicts: {per_request:7.2f}s")
+    print(f"scalar bulk (bitsets):                {scalar_elapsed:7.2f}s  {per_request / scalar_elapsed:6.1f}x")
+    print(f"numpy bulk (packed bitsets):          {numpy_elapsed:7.2f}s  {per_request / numpy_elapsed:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+基准测试：逐单元格字符串键的冲突检测 vs. 位集 / 扫描线冲突检测。
+
+- before: 旧实现，为每条安排的每个 周 x 节次 生成 "{week}-{day}-{slot}" 字符串键放入字典。
+- pairs:  app.find_backend_conflict_pairs，每门课程每天的安排合并为一个单元格位集，用按位与求冲突对。
+- structured: app.find_backend_conflicts，按星期沿节次扫描，用周数位集按位与求重叠，
+          给出每处冲突的重叠周数、节次和安排下标。
+- incremental: app.ConflictIndex.sync，每轮只改动一门课程时（修正轮次的典型情况）只重新检查这门课程。
+
+旧实现中每个单元格只归最先占用它的课程，第三门课程只与所有者比较，因此会漏报部分冲突对；
+新实现报告任意两条重叠的安排。先在大量随机课表上校验：结构化冲突与逐两两枚举的结果一致、
+冲突对与结构化冲突一致、旧实现的冲突对都被新实现报告，再在大型合成课表上计时。
+
+用法:
+    python tools/bench_conflicts.py --courses 30 --weeks 30 --rounds 200
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _common import import_app  # noqa: E402
+from bench_weeks import legacy_parse_weeks  # noqa: E402
+
+
+def legacy_conflict_pairs(parse_weeks, courses):
+    """旧实现的原样拷贝，作为正确性与性能基线。"""
+    calendar = {}
+    conflict_pairs = set()
+    if not isinstance(courses, list):
+        return conflict_pairs
+
+    for course in courses:
+        course_name = course.get("name", "未知课程")
+        schedules = course.get("schedules", [])
+        if not isinstance(schedules, list): continue
+        for schedule in schedules:
+            try:
+                weeks = parse_weeks(schedule.get("weeks", ""))
+                day = int(schedule.get("day", 0))
+                time_slot = schedule.get("time_slot", "")
+                if not time_slot or '-' not in time_slot:
+                    continue
+                start_slot, end_slot = map(int, time_slot.split('-'))
+
+                for week in weeks:
+                    for slot in range(start_slot, end_slot + 1):
+                        key = f"{week}-{day}-{slot}"
+                        if key in calendar:
+                            conflicting_course_name = calendar[key]
+                            if conflicting_course_name != course_name:
+                                pair = tuple(sorted((course_name, conflicting_course_name)))
+                                conflict_pairs.add(pair)
+                        else:
+                            calendar[key] = course_name
+            except (ValueError, TypeError, AttributeError):
+                continue
+    return conflict_pairs
+
+
+def brute_force_conflicts(parse_weeks, courses):
+    """逐单元格两两比较所有安排，得到 {(名称对, 星期, 安排下标对): (重叠周数, 重叠节次)}。"""
+    entries = []
+    for course_index, course in enumerate(courses):
+        for schedule_index, schedule in enumerate(course.get("schedules", [])):
+            try:
+                day = int(schedule.get("day", 0))
+                start_slot, end_slot = map(int, schedule.get("time_slot", "").split('-'))
+            except (ValueError, TypeError, AttributeError):
+                continue
+            weeks = parse_weeks(schedule.get("weeks", ""))
+            if weeks:
+                entries.append((course["name"], course_index, schedule_index, day, weeks, set(range(start_slot, end_slot + 1))))
+
+    found = {}
+    for i, a in enumerate(entries):
+        for b in entries[i + 1:]:
+            if a[0] == b[0] or a[3] != b[3]:
+                continue
+            weeks, slots = a[4] & b[4], a[5] & b[5]
+            if weeks and slots:
+                first, second = sorted((a, b), key=lambda entry: (entry[0], entry[1]))
+                key = (first[0], second[0], a[3], (first[1], first[2]), (second[1], second[2]))
+                found[key] = (weeks, (min(slots), max(slots)))
+    return found
+
+
+def structured_as_dict(app, conflicts):
+    found = {}
+    for conflict in conflicts:
+        first, second = conflict["entries"]
+        key = (*conflict["courses"], conflict["day"], (first["course"], first["schedule"]), (second["course"], second["schedule"]))
+        found[key] = (app.parse_weeks(conflict["weeks"]), app._slot_range(conflict["slots"]))
+    return found
+
+
+def _random_weeks(rng, max_week):
+    # 真实课表大多是贯穿大半个学期的长区间
+    start = rng.randint(1, max(1, max_week // 4))
+    end = rng.randint(max(start, max_week // 2), max_week)
+    kind = rng.random()
+    if kind < 0.5:
+        return f"{start}-{end}"
+    if kind < 0.65:
+        return f"{start}-{end}(单)"
+    if kind < 0.8:
+        return f"{start}-{end}(双)"
+    picks = sorted(rng.sample(range(1, max_week + 1), rng.randint(1, min(6, max_week))))
+    return ",".join(str(week) for week in picks)
+
+
+def _random_schedule(rng, max_week, max_slot):
+    start = rng.randint(1, max_slot - 1)
+    end = rng.randint(start, min(max_slot, start + 3))
+    schedule = {"weeks": _random_weeks(rng, max_week), "day": str(rng.randint(1, 7)), "time_slot": f"{start}-{end}"}
+    roll = rng.random()
+    # 少量畸形数据，两种实现都应跳过
+    if roll < 0.02:
+        schedule["time_slot"] = "3"
+    elif roll < 0.04:
+        schedule["day"] = "周三"
+    elif roll < 0.05:
+        schedule["weeks"] = None
+    return schedule
+
+
+def random_timetable(rng, courses, max_week, max_slot=12):
+    names = [f"课程{i}" for i in range(courses)]
+    timetable = []
+    for _ in range(courses):
+        timetable.append({
+            # 偶尔出现同名课程（同一门课拆成多条），同名不算冲突
+            "name": rng.choice(names) if rng.random() < 0.1 else names[len(timetable)],
+            "schedules": [_random_schedule(rng, max_week, max_slot) for _ in range(rng.randint(1, 3))],
+        })
+    return timetable
+
+
+def verify(app, seed, cases):
+    rng = random.Random(seed)
+    for case in range(cases):
+        timetable = random_timetable(rng, rng.randint(1, 60), rng.randint(1, 30))
+        expected = legacy_conflict_pairs(legacy_parse_weeks, timetable)
+        conflicts = app.find_backend_conflicts(timetable)
+        if structured_as_dict(app, conflicts) != brute_force_conflicts(app.parse_weeks, timetable):
+            raise SystemExit(f"structured conflicts differ from brute force in case {case}")
+        actual = app.find_backend_conflict_pairs(timetable)
+        if actual != app.conflict_pairs_of(conflicts) or bool(expected) != bool(actual) or not expected <= actual:
+            raise SystemExit(f"mismatch in case {case}: legacy {sorted(expected)}, got {sorted(actual)}")
+
+
+def edit_rounds(rng, timetable, rounds, max_week):
+    """模拟修正轮次：每轮替换一门课程的上课安排。"""
+    versions = []
+    current = timetable
+    for _ in range(rounds):
+        current = list(current)
+        index = rng.randrange(len(current))
+        current[index] = dict(current[index], schedules=[_random_schedule(rng, max_week, 12)])
+        versions.append(current)
+    return versions
+
+
+def bench_incremental(app, timetables, rounds, max_week, seed):
+    rng = random.Random(seed)
+    histories = [edit_rounds(rng, timetable, rounds, max_week) for timetable in timetables]
+    started = time.perf_counter()
+    for history in histories:
+        for version in history:
+            app.find_backend_conflicts(version)
+    full = time.perf_counter() - started
+
+    indexes = []
+    for timetable in timetables:
+        index = app.ConflictIndex()
+        index.sync(timetable)
+        indexes.append(index)
+    started = time.perf_counter()
+    for index, history in zip(indexes, histories):
+        for version in history:
+            index.sync(version)
+            index.conflicts()
+    incremental = time.perf_counter() - started
+
+    for index, history in zip(indexes, histories):
+        if index.conflicts() != app.find_backend_conflicts(history[-1]):
+            raise SystemExit("incremental index disagrees with find_backend_conflicts")
+    return full, incremental
+
+
+def bench(fn, timetables, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for timetable in timetables:
+            fn(timetable)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--courses", type=int, default=30)
+    parser.add_argument("--weeks", type=int, default=30)
+    parser.add_argument("--timetables", type=int, default=20, help="distinct synthetic timetables")
+    parser.add_argument("--rounds", type=int, default=50, help="passes over all timetables")
+    parser.add_argument("--verify-cases", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        app = import_app()
+
+    verify(app, args.seed, args.verify_cases)
+
+    rng = random.Random(args.seed)
+    timetables = [random_timetable(rng, args.courses, args.weeks) for _ in range(args.timetables)]
+    legacy = bench(lambda timetable: legacy_conflict_pairs(legacy_parse_weeks, timetable), timetables, args.rounds)
+    app._compile_weeks.cache_clear()
+    app._week_cells.cache_clear()
+    pairs_cold = bench(app.find_backend_conflict_pairs, timetables, 1) * args.rounds
+    pairs = bench(app.find_backend_conflict_pairs, timetables, args.rounds)
+    structured = bench(app.find_backend_conflicts, timetables, args.rounds)
+    full, incremental = bench_incremental(app, timetables, args.rounds, args.weeks, args.seed)
+
+    calls = args.timetables * args.rounds
+    print(f"verified {args.verify_cases} random timetables: structured conflicts match brute force, legacy pairs all reported")
+    print(f"courses={args.courses} weeks={args.weeks} timetables={args.timetables} rounds={args.rounds}")
+    print(f"before (string keys per cell):   {legacy / calls * 1e6:9.1f} us/call")
+    print(f"pairs  (bitsets, cold cache):    {pairs_cold / calls * 1e6:9.1f} us/call  {legacy / pairs_cold:6.1f}x")
+    print(f"pairs  (bitsets, warm cache):    {pairs / calls * 1e6:9.1f} us/call  {legacy / pairs:6.1f}x")
+    print(f"structured (sweep line):         {structured / calls * 1e6:9.1f} us/call  {legacy / structured:6.1f}x")
+    print(f"one course changed per round: full re-check {full / calls * 1e6:9.1f} us/round, "
+          f"incremental index {incremental / calls * 1e6:9.1f} us/round  {full / incremental:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
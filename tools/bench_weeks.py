@@ -0,0 +1,129 @@
+"""
+周数表达式解析的正确性校验与微基准。
+
+- 校验: tools/week_corpus.txt 中每条真实课表里的周数写法，compile_weeks 的结果都要与期望一致。
+- before: 旧的 parse_weeks，每个逗号分段跑三次 re.match，并把区间展开成 Python 集合。
+- after:  app.compile_weeks，预编译的记号正则 + 位集，结果按字符串缓存（分别测冷缓存与热缓存）。
+
+用法:
+    python tools/bench_weeks.py --rounds 200
+"""
+import argparse
+import contextlib
+import io
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _common import import_app  # noqa: E402
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "week_corpus.txt")
+
+
+def legacy_parse_weeks(weeks_str):
+    """旧实现的原样拷贝，作为性能基线。"""
+    if not isinstance(weeks_str, str):
+        return set()
+
+    weeks = set()
+    parts = weeks_str.replace('，', ',').split(',')
+    for part in parts:
+        part = part.strip()
+        single_match = re.match(r'(\d+)-(\d+)\(单\)', part)
+        double_match = re.match(r'(\d+)-(\d+)\(双\)', part)
+        range_match = re.match(r'(\d+)-(\d+)', part)
+
+        try:
+            if single_match:
+                start, end = map(int, single_match.groups())
+                for i in range(start, end + 1):
+                    if i % 2 != 0: weeks.add(i)
+            elif double_match:
+                start, end = map(int, double_match.groups())
+                for i in range(start, end + 1):
+                    if i % 2 == 0: weeks.add(i)
+            elif range_match:
+                start, end = map(int, range_match.groups())
+                for i in range(start, end + 1):
+                    weeks.add(i)
+            elif part.isdigit():
+                weeks.add(int(part))
+        except ValueError:
+            continue # 忽略无法解析的部分
+    return weeks
+
+
+def load_corpus(path=CORPUS_PATH):
+    corpus = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line or line.startswith("#"):
+                continue
+            expression, expected = line.split("\t")
+            corpus.append((expression, expected))
+    return corpus
+
+
+def verify(app, corpus):
+    failures = []
+    for expression, expected in corpus:
+        weeks = app.compile_weeks(expression)
+        if weeks.format() != expected:
+            failures.append(f"{expression!r}: expected {expected!r}, got {weeks.format()!r}")
+        elif app.compile_weeks(weeks.format()) is not weeks:
+            failures.append(f"{expression!r}: {weeks.format()!r} does not round-trip to the same WeekSet")
+    return failures
+
+
+def bench(fn, expressions, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for expression in expressions:
+            fn(expression)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=200, help="passes over the corpus")
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        app = import_app()
+
+    corpus = load_corpus()
+    failures = verify(app, corpus)
+    if failures:
+        raise SystemExit("corpus mismatches:\n" + "\n".join(failures))
+
+    expressions = [expression for expression, _ in corpus]
+    legacy = bench(legacy_parse_weeks, expressions, args.rounds)
+    cold = 0.0
+    for _ in range(args.rounds):
+        app._compile_weeks.cache_clear()
+        cold += bench(app.compile_weeks, expressions, 1)
+    plain = [expression for expression in expressions if app._PLAIN_WEEKS_RE.fullmatch(expression)]
+    legacy_plain = bench(legacy_parse_weeks, plain, args.rounds)
+    cold_plain = 0.0
+    for _ in range(args.rounds):
+        app._compile_weeks.cache_clear()
+        cold_plain += bench(app.compile_weeks, plain, 1)
+    warm = bench(app.compile_weeks, expressions, args.rounds)
+    warm_sets = bench(app.parse_weeks, expressions, args.rounds)
+
+    calls = len(expressions) * args.rounds
+    print(f"verified {len(corpus)} corpus expressions")
+    print(f"before (parse_weeks, re.match per part):  {legacy / calls * 1e6:7.2f} us/call")
+    print(f"after  (compile_weeks, cold cache):       {cold / calls * 1e6:7.2f} us/call  {legacy / cold:6.1f}x")
+    print(f"plain \"1-16\" / \"1,3,5\" forms only ({len(plain)}): before {legacy_plain / len(plain) / args.rounds * 1e6:.2f} us/call, "
+          f"after cold {cold_plain / len(plain) / args.rounds * 1e6:.2f} us/call  {legacy_plain / cold_plain:6.1f}x")
+    print(f"after  (compile_weeks, warm cache):       {warm / calls * 1e6:7.2f} us/call  {legacy / warm:6.1f}x")
+    print(f"after  (parse_weeks -> set, warm cache):  {warm_sets / calls * 1e6:7.2f} us/call  {legacy / warm_sets:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
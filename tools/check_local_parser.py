@@ -0,0 +1,87 @@
+"""
+本地规则解析器（/api/process-data 快速路径）的正确性校验。
+
+每条样例给出粘贴文本和期望结果：期望为课程列表时本地解析器必须以满置信度给出完全相同的
+(代码, 名称, 教师, [(周数, 星期, 节次), ...])；期望为 None 时本地解析器不能以满置信度接手，必须回退到 AI。
+
+用法:
+    python tools/check_local_parser.py
+"""
+import contextlib
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _common import import_app  # noqa: E402
+
+CASES = [
+    (
+        "课程代码: CS101, 课程名称: 计算机科学导论, 教师: 张三, 上课安排: 1-16周, 周三, 3-4节, 主校区, 教学楼A, 101室",
+        [("CS101", "计算机科学导论", ["张三"], [("1-16", "3", "3-4")])],
+    ),
+    (
+        "线性代数(MATH202), 李四, 1-8周(单), 周一, 1-2节, 东校区, 理科楼, 203",
+        [("MATH202", "线性代数", ["李四"], [("1,3,5,7", "1", "1-2")])],
+    ),
+    (
+        "大学物理, 王五, 周二5-6节(1-8周), 周四7-8节(1-8周), 西校区, 物理楼, 305",
+        [("", "大学物理", ["王五"], [("1-8", "2", "5-6"), ("1-8", "4", "7-8")])],
+    ),
+    # 括号里的分班/分册标记不是课程代码，要留在名称里
+    (
+        "高等数学(A) 周一 1-2节 1-16周 李明 主楼 301",
+        [("", "高等数学(A)", ["李明"], [("1-16", "1", "1-2")])],
+    ),
+    (
+        "大学物理(上) 周二 3-4节 1-16周",
+        [("", "大学物理(上)", [], [("1-16", "2", "3-4")])],
+    ),
+    (
+        "思想道德与法治（一） 周五 9-10节 2-17周",
+        [("", "思想道德与法治(一)", [], [("2-17", "5", "9-10")])],
+    ),
+    (
+        "高等数学 周一 1-2节 1-16周\n大学英语 周三 3-4节 1-16周 张老师",
+        [("", "高等数学", [], [("1-16", "1", "1-2")]), ("", "大学英语", ["张老师"], [("1-16", "3", "3-4")])],
+    ),
+    # 无法归类的内容交给 AI
+    (
+        "高等数学 周一 1-2节 1-16周 这门课期中要交报告",
+        None,
+    ),
+    (
+        "高等数学 周一 1-2节 1-200周",
+        None,
+    ),
+]
+
+
+def _summary(courses):
+    return [
+        (course["code"], course["name"], course["teachers"],
+         [(s["weeks"], s["day"], s["time_slot"]) for s in course["schedules"]])
+        for course in courses
+    ]
+
+
+def main():
+    with contextlib.redirect_stdout(io.StringIO()):
+        app = import_app()
+
+    failures = 0
+    for text, expected in CASES:
+        result = app.parse_courses_locally(text)
+        accepted = result is not None and result[1] >= 1.0
+        actual = _summary(result[0]) if accepted else None
+        if actual != expected:
+            failures += 1
+            print(f"FAIL {text!r}\n  expected {expected}\n  got      {actual}")
+    if failures:
+        raise SystemExit(f"{failures}/{len(CASES)} local parser cases failed")
+    print(f"all {len(CASES)} local parser cases passed")
+
+
+if __name__ == "__main__":
+    main()
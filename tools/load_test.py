@@ -0,0 +1,197 @@
+"""
+AI 接口与分享接口的端到端压测工具。
+
+以指定并发对运行中的主应用发起请求，按场景输出 p50/p95/p99 延迟、吞吐量和状态码分布。
+场景: process-data, process-image, ai-assistant, share（生成分享码 + 上传 + 下载）。
+
+用法:
+    # 压测已经运行的实例（AI_BASE_URL 应指向 tools/mock_ai_server.py）
+    python tools/load_test.py --target http://127.0.0.1:2000 --scenarios process-data,share -c 50 -n 500
+
+    # 在进程内同时启动模拟 AI 服务和主应用，无需任何配置
+    python tools/load_test.py --spawn -c 50 -n 500 --latency 0.5
+
+注意: 分享上传按 IP 限流（SHARE_RATE_LIMIT_SECONDS），压测 share 场景时应将其设为 0，
+否则大部分上传会返回 429。--spawn 模式会自动设置。
+"""
+import argparse
+import base64
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_ai_server import add_mock_arguments, mock_config_from_args, start_mock_server  # noqa: E402
+
+SCENARIOS = ("process-data", "process-image", "ai-assistant", "share")
+
+SAMPLE_INPUT = "课程代码: CS101, 课程名称: 计算机科学导论, 教师: 张三, 上课安排: 1-16周, 周三, 3-4节, 主校区, 教学楼A, 101室"
+# 1x1 像素的 PNG
+SAMPLE_IMAGE = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class Scenario:
+    def __init__(self, name, target, unique):
+        self.name = name
+        self.target = target.rstrip("/")
+        self.unique = unique
+        self.latencies = []
+        self.statuses = Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+
+    def _record(self, elapsed, status):
+        with self._lock:
+            self.latencies.append(elapsed)
+            self.statuses[status] += 1
+
+    def run_once(self, index):
+        started = time.perf_counter()
+        try:
+            status = self._request(index)
+        except requests.RequestException as e:
+            status = type(e).__name__
+        self._record(time.perf_counter() - started, status)
+
+    def _request(self, index):
+        session = self._session()
+        suffix = f" #{index}" if self.unique else ""
+        if self.name == "process-data":
+            r = session.post(f"{self.target}/api/process-data", json={"userInput": SAMPLE_INPUT + suffix, "startDate": "2025-02-24"}, timeout=300)
+            return r.status_code
+        if self.name == "process-image":
+            image = SAMPLE_IMAGE
+            if self.unique:
+                # 在 PNG 末尾追加字节，改变哈希但不影响模拟服务
+                raw = base64.b64decode(SAMPLE_IMAGE.split(",", 1)[1]) + str(index).encode()
+                image = "data:image/png;base64," + base64.b64encode(raw).decode()
+            r = session.post(f"{self.target}/api/process-image", json={"images": [image]}, timeout=300)
+            return r.status_code
+        if self.name == "ai-assistant":
+            r = session.post(f"{self.target}/api/ai-assistant", json={
+                "userInput": "每周五一二节加一门体育课" + suffix,
+                "existingCourses": [{"id": 1, "code": "CS101", "name": "计算机科学导论", "teachers": ["张三"],
+                                     "schedules": [{"weeks": "1-16", "day": "3", "time_slot": "3-4"}]}],
+                "existingExams": [],
+                "startDate": "2025-02-24",
+            }, timeout=300)
+            return r.status_code
+        if self.name == "share":
+            r = session.post(f"{self.target}/api/share/generate-code", timeout=60)
+            if r.status_code != 200:
+                return r.status_code
+            code = r.json()["share_code"]
+            payload = io.BytesIO(json.dumps([{"name": "计算机科学导论"}], ensure_ascii=False).encode("utf-8"))
+            r = session.post(f"{self.target}/api/share/upload", data={"share_code": code},
+                             files={"file": ("courses.json", payload, "application/json")}, timeout=60)
+            if r.status_code != 200:
+                return r.status_code
+            r = session.get(f"{self.target}/api/share/get/{code}", timeout=60)
+            return r.status_code
+        raise ValueError(f"unknown scenario: {self.name}")
+
+    def report(self, wall_seconds):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        statuses = ", ".join(f"{k}:{v}" for k, v in sorted(self.statuses.items(), key=lambda kv: str(kv[0])))
+        return (
+            f"{self.name:<14} n={count:<6} "
+            f"p50={_percentile(latencies, 50) * 1000:8.1f}ms "
+            f"p95={_percentile(latencies, 95) * 1000:8.1f}ms "
+            f"p99={_percentile(latencies, 99) * 1000:8.1f}ms "
+            f"throughput={count / wall_seconds if wall_seconds else 0:8.1f} req/s  [{statuses}]"
+        )
+
+
+def run_scenario(scenario, concurrency, total):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(scenario.run_once, range(total)))
+    return time.perf_counter() - started
+
+
+def spawn_app(args):
+    """在进程内启动模拟 AI 服务和主应用，返回 (target_url, shutdown)。"""
+    from werkzeug.serving import make_server
+    from _common import import_app
+
+    mock_server, base_url = start_mock_server(**mock_config_from_args(args))
+    app_module = import_app(base_url, ENABLE_IMAGE_PROCESSING="true", SHARE_RATE_LIMIT_SECONDS=0)
+    # 分享文件写到临时目录，不污染真实的 shared_configs
+    app_module.SHARE_CONFIG_DIR = tempfile.mkdtemp(prefix="next_class_share_")
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    server.socket.listen(1024)
+    thread = threading.Thread(target=server.serve_forever, name="app-under-test", daemon=True)
+    thread.start()
+
+    def shutdown():
+        server.shutdown()
+        mock_server.shutdown()
+
+    return f"http://127.0.0.1:{server.server_port}", shutdown
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", default="http://127.0.0.1:2000", help="base URL of a running app")
+    parser.add_argument("--spawn", action="store_true", help="start the mock AI server and the app in-process")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated: " + ", ".join(SCENARIOS))
+    parser.add_argument("-c", "--concurrency", type=int, default=20)
+    parser.add_argument("-n", "--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--unique", action="store_true", help="vary inputs so caches and coalescing do not apply")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    shutdown = None
+    target = args.target
+    if args.spawn:
+        target, shutdown = spawn_app(args)
+        # 应用的 print 输出会淹没报告
+        sys.stdout = open(os.devnull, "w", encoding="utf-8")
+
+    lines = [f"target={target} concurrency={args.concurrency} requests/scenario={args.requests} unique={args.unique}"]
+    try:
+        for name in names:
+            scenario = Scenario(name, target, args.unique)
+            wall = run_scenario(scenario, args.concurrency, args.requests)
+            lines.append(scenario.report(wall))
+    finally:
+        if shutdown is not None:
+            sys.stdout = sys.__stdout__
+            shutdown()
+
+    print("\n".join(lines))
+
+
+if __name__ == "__main__":
+    main()
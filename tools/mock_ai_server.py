@@ -0,0 +1,278 @@
+"""
+本地 OpenAI 兼容的模拟 AI 服务，用于在没有 DashScope 密钥时压测/基准测试 AI 接口。
+
+实现 POST /chat/completions 与 GET /models（也接受 /v1 前缀）。根据请求内容返回固定的
+课程 JSON 或 AI 助手的 operations JSON，支持普通响应和 stream=True 的 SSE 流式响应。
+延迟、流式分块速率和错误注入都可以配置。
+
+用法:
+    python tools/mock_ai_server.py --port 8600 --latency 0.5 --chunk-delay 0.02 --error-rate 0.05
+然后在 .env 中设置 AI_BASE_URL=http://127.0.0.1:8600/v1
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CANNED_COURSES = [
+    {
+        "code": "CS101",
+        "name": "计算机科学导论",
+        "teachers": ["张三"],
+        "schedules": [
+            {"weeks": "1-16", "day": "3", "time_slot": "3-4", "campus": "主校区", "building": "教学楼A", "classroom": "101"}
+        ],
+    },
+    {
+        "code": "MATH202",
+        "name": "线性代数",
+        "teachers": ["李四"],
+        "schedules": [
+            {"weeks": "1,3,5,7", "day": "1", "time_slot": "1-2", "campus": "东校区", "building": "理科楼", "classroom": "203"}
+        ],
+    },
+    {
+        "code": "PHY101",
+        "name": "大学物理",
+        "teachers": ["王五"],
+        "schedules": [
+            {"weeks": "1-8", "day": "2", "time_slot": "5-6", "campus": "西校区", "building": "物理楼", "classroom": "305"},
+            {"weeks": "1-8", "day": "4", "time_slot": "7-8", "campus": "西校区", "building": "物理楼", "classroom": "305"},
+        ],
+    },
+]
+
+CANNED_ASSISTANT_RESULT = {
+    "operations": [
+        {
+            "operation": "add",
+            "course": {
+                "code": "PE101",
+                "name": "体育",
+                "teachers": ["赵六"],
+                "schedules": [{"weeks": "1-16", "day": "5", "time_slot": "1-2", "campus": "主校区", "building": "体育馆", "classroom": ""}],
+            },
+            "reason": "mock",
+        }
+    ],
+    "examOperations": [],
+    "timeConfigChange": None,
+}
+
+
+class MockConfig:
+    """
+    latency:        收到请求到开始响应的秒数
+    jitter:         在 latency 基础上叠加的 [0, jitter) 随机秒数
+    chunk_size:     流式响应每个分块的字符数
+    chunk_delay:    流式响应相邻分块之间的秒数
+    error_rate:     以 error_status 直接失败的请求比例
+    error_status:   注入错误时返回的 HTTP 状态码（如 500 / 429 / 503）
+    truncate_rate:  流式响应在中途被截断的比例（用于测试前缀恢复）
+    """
+    def __init__(self, latency=0.5, jitter=0.0, chunk_size=16, chunk_delay=0.0,
+                 error_rate=0.0, error_status=500, truncate_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.truncate_rate = truncate_rate
+
+
+class MockStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.truncated = 0
+        self.disconnected = 0
+
+    def incr(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def snapshot(self):
+        with self._lock:
+            return {"requests": self.requests, "errors": self.errors, "truncated": self.truncated,
+                    "disconnected": self.disconnected}
+
+
+def _message_text(payload):
+    parts = []
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+        elif isinstance(content, list):
+            parts.extend(item.get("text", "") for item in content if isinstance(item, dict))
+    return "\n".join(parts)
+
+
+def _build_answer(payload):
+    if "课程表 AI 助手" in _message_text(payload):
+        return json.dumps(CANNED_ASSISTANT_RESULT, ensure_ascii=False)
+    return json.dumps(CANNED_COURSES, ensure_ascii=False)
+
+
+class MockAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = MockConfig()
+    stats = MockStats()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "mock-model", "object": "model", "owned_by": "mock"}]})
+        elif self.path.rstrip("/").endswith("/mock/stats"):
+            self._send_json(200, self.stats.snapshot())
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "invalid json"}})
+            return
+
+        config = self.config
+        self.stats.incr("requests")
+        time.sleep(config.latency + random.random() * config.jitter)
+
+        if config.error_rate and random.random() < config.error_rate:
+            self.stats.incr("errors")
+            self._send_json(config.error_status, {"error": {"message": "injected error", "type": "mock_error"}})
+            return
+
+        answer = _build_answer(payload)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        model = payload.get("model", "mock-model")
+
+        if not payload.get("stream"):
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": answer},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+            return
+
+        if config.truncate_rate and random.random() < config.truncate_rate:
+            self.stats.incr("truncated")
+            answer = answer[:random.randint(1, max(1, len(answer) - 1))]
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        step = max(1, config.chunk_size)
+        try:
+            for i in range(0, len(answer), step):
+                if i and config.chunk_delay:
+                    time.sleep(config.chunk_delay)
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": answer[i:i + step]}, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端中途取消（如落选的并行候选）
+            self.stats.incr("disconnected")
+
+
+class MockAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def start_mock_server(host="127.0.0.1", port=0, **config_kwargs):
+    """
+    在后台线程中启动模拟服务，返回 (server, base_url)。
+    port=0 时由系统分配空闲端口。调用 server.shutdown() 停止；
+    server.RequestHandlerClass.stats 记录收到的请求数。
+    """
+    handler = type("ConfiguredMockAIHandler", (MockAIHandler,), {
+        "config": MockConfig(**config_kwargs),
+        "stats": MockStats(),
+    })
+    server = MockAIServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, name="mock-ai-server", daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def add_mock_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds before the first byte")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency in [0, jitter) seconds")
+    parser.add_argument("--chunk-size", type=int, default=16, help="characters per streamed chunk")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP status used for injected errors")
+    parser.add_argument("--truncate-rate", type=float, default=0.0, help="fraction of streams cut off mid-answer")
+
+
+def mock_config_from_args(args):
+    return {
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "chunk_size": args.chunk_size,
+        "chunk_delay": args.chunk_delay,
+        "error_rate": args.error_rate,
+        "error_status": args.error_status,
+        "truncate_rate": args.truncate_rate,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible mock AI server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    server, base_url = start_mock_server(args.host, args.port, **mock_config_from_args(args))
+    print(f"Mock AI server listening on {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
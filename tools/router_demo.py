@@ -0,0 +1,97 @@
+"""
+多上游路由演示：启动三个本地模拟 AI 服务（快、慢、经常出错），观察路由器如何分配请求、
+熔断出错的上游，以及开启对冲请求后的尾延迟。
+
+用法:
+    python tools/router_demo.py --requests 200 --concurrency 10
+    python tools/router_demo.py --hedge --fast-jitter 2 --slow-latency 0.3 --slow-jitter 0
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _common import import_app  # noqa: E402
+from mock_ai_server import start_mock_server  # noqa: E402
+
+SAMPLE_INPUT = "课程代码: CS101, 课程名称: 计算机科学导论, 教师: 张三, 上课安排: 1-16周, 周三, 3-4节"
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--fast-latency", type=float, default=0.2)
+    parser.add_argument("--fast-jitter", type=float, default=0.2, help="extra random latency of the fast endpoint")
+    parser.add_argument("--slow-latency", type=float, default=0.8)
+    parser.add_argument("--slow-jitter", type=float, default=0.5, help="extra random latency of the slow endpoint")
+    parser.add_argument("--flaky-error-rate", type=float, default=0.6)
+    parser.add_argument("--hedge", action="store_true", help="enable hedged requests")
+    args = parser.parse_args()
+
+    servers = {
+        "fast": start_mock_server(latency=args.fast_latency, jitter=args.fast_jitter),
+        "slow": start_mock_server(latency=args.slow_latency, jitter=args.slow_jitter),
+        "flaky": start_mock_server(latency=args.fast_latency, error_rate=args.flaky_error_rate, error_status=503),
+    }
+    endpoints = [{"name": name, "base_url": base_url, "model": f"mock-{name}"} for name, (_, base_url) in servers.items()]
+    app = import_app(
+        AI_ENDPOINTS=json.dumps(endpoints),
+        AI_HEDGE_ENABLED="true" if args.hedge else "false",
+        AI_RESULT_CACHE_ENABLED="false",
+        AI_REQUEST_COALESCING_ENABLED="false",
+        LOCAL_PARSER_ENABLED="false",
+    )
+
+    latencies = []
+    failures = 0
+
+    async def one_call(index, semaphore):
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await app.call_ai_model(f"{SAMPLE_INPUT} #{index}")
+            except Exception:
+                failures += 1
+            latencies.append(time.perf_counter() - started)
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(args.concurrency)
+        await asyncio.gather(*[one_call(i, semaphore) for i in range(args.requests)])
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            future = asyncio.run_coroutine_threadsafe(run_all(), app._get_ai_loop())
+            future.result()
+    finally:
+        for server, _ in servers.values():
+            server.shutdown()
+
+    latencies.sort()
+    print(f"requests={args.requests} concurrency={args.concurrency} hedge={args.hedge} failures={failures}")
+    print(f"p50={_percentile(latencies, 50) * 1000:.0f}ms p95={_percentile(latencies, 95) * 1000:.0f}ms "
+          f"p99={_percentile(latencies, 99) * 1000:.0f}ms")
+    stats = app.upstream_router.stats()
+    print(f"hedged={stats['hedged']} hedge_wins={stats['hedge_wins']} failovers={stats['failovers']}")
+    for endpoint in stats["endpoints"]:
+        upstream_requests = servers[endpoint["name"]][0].RequestHandlerClass.stats.snapshot()["requests"]
+        print(f"  {endpoint['name']:<6} state={endpoint['state']:<9} routed={endpoint['requests']:<5} "
+              f"upstream_requests={upstream_requests:<5} ewma_latency={endpoint['ewma_latency_seconds']} "
+              f"ewma_error={endpoint['ewma_error_rate']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+巡检所有分享课表：一次批量校验 shared_configs 下的全部课表，输出冲突、课时和空闲节次统计，
+并列出有冲突的分享及其具体冲突位置。安装了 NumPy 时使用占用张量的向量化实现。
+
+用法:
+    python tools/validate_shares.py
+    python tools/validate_shares.py --dir /path/to/shared_configs --slots-per-day 12 --json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _common import import_app  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", help="share directory (defaults to the app's SHARE_CONFIG_DIR)")
+    parser.add_argument("--slots-per-day", type=int, help="slots per day used for free-slot counts")
+    parser.add_argument("--scalar", action="store_true", help="use the bitset implementation even if NumPy is installed")
+    parser.add_argument("--details", type=int, default=3, help="conflicts listed per conflicting share")
+    parser.add_argument("--json", action="store_true", help="print per-share results as JSON")
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        app = import_app()
+    if args.dir:
+        app.SHARE_CONFIG_DIR = args.dir
+
+    shares = app.load_shared_timetables()
+    timetables = [courses for _, courses in shares]
+    started = time.perf_counter()
+    results = app.validate_timetables_bulk(timetables, slots_per_day=args.slots_per_day, use_numpy=not args.scalar)
+    elapsed = time.perf_counter() - started
+
+    if args.json:
+        print(json.dumps([dict(result, filename=filename) for (filename, _), result in zip(shares, results)],
+                         ensure_ascii=False, indent=2))
+        return
+
+    mode = "numpy" if app.np is not None and not args.scalar else "scalar"
+    print(f"{len(shares)} shares validated in {elapsed * 1000:.1f} ms ({mode})")
+    if not shares:
+        return
+    loads = [result["load"] for result in results]
+    free = [result["free_slots"] for result in results]
+    conflicted = [(filename, courses) for (filename, courses), result in zip(shares, results) if result["has_conflict"]]
+    print(f"load (occupied week/day/slot cells): mean {statistics.mean(loads):.1f}, median {statistics.median(loads)}, max {max(loads)}")
+    print(f"free slots (never used in any week): mean {statistics.mean(free):.1f}, median {statistics.median(free)}")
+    print(f"shares with conflicts: {len(conflicted)}")
+    for filename, courses in conflicted:
+        conflicts = app.find_backend_conflicts(courses)
+        print(f"  {filename}: {len(conflicts)} conflicts")
+        for line in app.format_conflict_report(conflicts[:args.details]).splitlines()[1:]:
+            print(f"    {line}")
+
+
+if __name__ == "__main__":
+    main()